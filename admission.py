@@ -0,0 +1,305 @@
+import asyncio
+import contextvars
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Richiesta rifiutata per proteggere il servizio, con il tempo dopo cui riprovare."""
+
+    status_code = 503
+    reason = 'overloaded'
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        """Valore dell'header Retry-After (secondi interi, almeno 1)."""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class QueueFullError(Overloaded):
+    """Coda delle corsie di inferenza piena."""
+
+    reason = 'queue_full'
+
+
+class DeadlineExceeded(Overloaded):
+    """Scadenza della richiesta superata prima dell'inferenza."""
+
+    reason = 'deadline'
+
+
+class RateLimited(Overloaded):
+    """Limite di richieste al secondo della chiave superato."""
+
+    status_code = 429
+    reason = 'rate_limited'
+
+
+class InFlightLimited(Overloaded):
+    """Limite di richieste contemporanee della chiave superato."""
+
+    status_code = 429
+    reason = 'in_flight_limit'
+
+
+class RequestBudget:
+    """Scadenza di una richiesta, propagata alle corsie tramite il contesto."""
+
+    def __init__(self, timeout: float):
+        self.deadline = time.monotonic() + timeout
+
+    @property
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining <= 0
+
+
+_budget: contextvars.ContextVar[Optional[RequestBudget]] = contextvars.ContextVar(
+    'removebg_budget', default=None
+)
+
+
+def current_budget() -> Optional[RequestBudget]:
+    """Scadenza della richiesta corrente (None se non prevista)."""
+    return _budget.get()
+
+
+def clear_budget() -> None:
+    """Rimuove la scadenza dal contesto corrente (lavori condivisi tra più richieste)."""
+    _budget.set(None)
+
+
+class TokenBucket:
+    """Limite di frequenza: `rate` richieste al secondo con picchi fino a `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Consuma un token; restituisce 0 oppure i secondi da attendere."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Quote per API key e scadenza delle richieste di processamento.
+
+    Ogni chiave ha un limite di richieste contemporanee e un limite di
+    frequenza (token bucket). Le richieste ammesse ricevono una scadenza:
+    il lavoro ancora in coda quando scade viene scartato invece di occupare
+    una corsia per una risposta che il client non attende più. Va usato solo
+    dall'event loop.
+    """
+
+    def __init__(
+        self,
+        max_in_flight_per_key: int = 0,
+        rate_per_key: float = 0.0,
+        burst: float = 0.0,
+        deadline_seconds: float = 0.0
+    ):
+        self.max_in_flight_per_key = max_in_flight_per_key
+        self.rate_per_key = rate_per_key
+        self.burst = burst or max(1.0, rate_per_key)
+        self.deadline_seconds = deadline_seconds
+        self._in_flight: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def admit(self, key: str, deadline: bool = True) -> None:
+        """
+        Ammette una richiesta per la chiave e ne imposta la scadenza nel contesto.
+
+        Args:
+            key: API key della richiesta
+            deadline: False per le richieste senza scadenza (es. batch in streaming)
+
+        Raises:
+            InFlightLimited: Se la chiave ha troppe richieste in corso
+            RateLimited: Se la chiave supera il limite di frequenza
+        """
+        if self.max_in_flight_per_key and self._in_flight.get(key, 0) >= self.max_in_flight_per_key:
+            raise InFlightLimited(
+                f"Troppe richieste contemporanee (massimo {self.max_in_flight_per_key} per chiave)"
+            )
+        if self.rate_per_key:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate_per_key, self.burst)
+            wait = bucket.take()
+            if wait:
+                raise RateLimited(
+                    f"Limite di {self.rate_per_key:g} richieste al secondo superato",
+                    retry_after=wait
+                )
+
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        if deadline and self.deadline_seconds:
+            _budget.set(RequestBudget(self.deadline_seconds))
+
+    def release(self, key: str) -> None:
+        """Libera il posto occupato da una richiesta ammessa."""
+        remaining = self._in_flight.get(key, 0) - 1
+        if remaining > 0:
+            self._in_flight[key] = remaining
+        else:
+            self._in_flight.pop(key, None)
+
+
+class BodySizeLimit:
+    """
+    Middleware ASGI che limita la dimensione del corpo delle richieste di upload.
+
+    FastAPI legge tutto il form multipart prima di risolvere le dipendenze
+    dell'endpoint, quindi il limite va applicato prima: un Content-Length
+    oltre il limite viene rifiutato con 413 senza leggere il corpo, e un
+    corpo senza Content-Length (chunked) viene interrotto appena lo supera.
+    """
+
+    def __init__(self, app: Callable, limits: Dict[str, int], detail: str):
+        """
+        Args:
+            app: Applicazione ASGI
+            limits: Byte massimi del corpo per percorso
+            detail: Messaggio dell'errore 413
+        """
+        self.app = app
+        self.limits = limits
+        self.detail = detail
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        limit = self.limits.get(scope.get('path')) if scope['type'] == 'http' else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get('headers') or [])
+        content_length = headers.get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({'detail': self.detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Dict[str, Any]:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=self.detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class CancelOnDisconnect:
+    """
+    Middleware ASGI che annulla le richieste il cui client si è disconnesso.
+
+    Uvicorn segnala la disconnessione solo a chi legge il canale `receive`,
+    che dopo il corpo della richiesta nessuno legge più: il middleware lo
+    osserva fino all'inizio della risposta e, se il client se ne va, annulla
+    l'handler. Download e lavori ancora in coda per le corsie vengono
+    annullati con esso; un'inferenza già avviata termina comunque.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        app_task: Optional[asyncio.Task] = None
+        watcher: Optional[asyncio.Task] = None
+        watcher_stopped = asyncio.Event()
+        pending: List[Dict[str, Any]] = []
+        state = {'disconnected': False, 'response_started': False}
+
+        async def watch() -> None:
+            try:
+                while True:
+                    message = await receive()
+                    if message['type'] == 'http.disconnect':
+                        state['disconnected'] = True
+                        if not state['response_started']:
+                            app_task.cancel()
+                        return
+                    # Corpo vuoto letto prima dell'applicazione: le viene consegnato dopo
+                    pending.append(message)
+            finally:
+                watcher_stopped.set()
+
+        def start_watcher() -> None:
+            nonlocal watcher
+            if watcher is None and not state['response_started']:
+                watcher = asyncio.ensure_future(watch())
+
+        async def wrapped_receive() -> Dict[str, Any]:
+            while True:
+                if pending:
+                    return pending.pop(0)
+                if state['disconnected']:
+                    return {'type': 'http.disconnect'}
+                if watcher is None or watcher.done():
+                    message = await receive()
+                    if message['type'] == 'http.request' and not message.get('more_body', False):
+                        start_watcher()
+                    return message
+                # Il watcher è l'unico lettore finché la risposta non inizia
+                await watcher_stopped.wait()
+
+        async def wrapped_send(message: Dict[str, Any]) -> None:
+            nonlocal watcher
+            if message['type'] == 'http.response.start':
+                state['response_started'] = True
+                # Da qui in poi la disconnessione è gestita dalla risposta (es. streaming)
+                if watcher is not None:
+                    watcher.cancel()
+                    await asyncio.wait([watcher])
+                    watcher = None
+            await send(message)
+
+        headers = dict(scope.get('headers') or [])
+        has_body = headers.get(b'content-length', b'0') != b'0' or b'transfer-encoding' in headers
+
+        app_task = asyncio.ensure_future(self.app(scope, wrapped_receive, wrapped_send))
+        if not has_body:
+            start_watcher()
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not (state['disconnected'] and app_task.cancelled()):
+                raise
+            metrics.REJECTED.labels('disconnected').inc()
+            logger.info(f"Client disconnesso, richiesta annullata: {scope.get('path')}")
+        finally:
+            if watcher is not None:
+                watcher.cancel()
@@ -0,0 +1,106 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Scheduler di micro-batching per il modello di segmentazione.
+
+    Le richieste concorrenti vengono raccolte fino a `max_batch_size` elementi
+    o fino a `max_wait_ms` millisecondi, impilate in un unico tensore ed
+    eseguite con un solo forward pass. Le maschere vengono poi separate e
+    restituite a ciascuna richiesta. submit blocca il thread chiamante fino
+    alla predizione: un batch si riempie solo con almeno `max_batch_size`
+    thread (corsie) che chiamano submit insieme.
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[[torch.Tensor], torch.Tensor],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 10.0
+    ):
+        if max_batch_size < 1:
+            raise ValueError("La dimensione massima del batch deve essere almeno 1")
+
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0.0) / 1000.0
+
+        self._queue: "queue.Queue[Tuple[torch.Tensor, Future]]" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="micro-batcher",
+            daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            f"Micro-batching attivo (max batch: {max_batch_size}, "
+            f"attesa massima: {max_wait_ms}ms)"
+        )
+
+    def submit(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Accoda un tensore di input e attende la sua predizione.
+
+        Args:
+            input_tensor: Tensore di input con batch di dimensione 1
+
+        Returns:
+            torch.Tensor: Predizione con batch di dimensione 1
+        """
+        future: Future = Future()
+        self._queue.put((input_tensor, future))
+        return future.result()
+
+    def _collect(self) -> List[Tuple[torch.Tensor, Future]]:
+        """Raccoglie un batch rispettando dimensione massima e tempo di attesa."""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return items
+
+    def _run(self) -> None:
+        """Loop del thread di batching."""
+        while True:
+            items = self._collect()
+
+            # Solo tensori con la stessa forma possono essere impilati
+            groups: Dict[Tuple[int, ...], List[Tuple[torch.Tensor, Future]]] = {}
+            for tensor, future in items:
+                groups.setdefault(tuple(tensor.shape), []).append((tensor, future))
+
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group: List[Tuple[torch.Tensor, Future]]) -> None:
+        """Esegue un forward pass sul batch e distribuisce i risultati."""
+        try:
+            batch = torch.cat([tensor for tensor, _ in group], dim=0)
+            preds = self.predict_fn(batch)
+            if len(group) > 1:
+                logger.debug(f"Eseguito batch di {len(group)} immagini")
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+
+        for index, (_, future) in enumerate(group):
+            future.set_result(preds[index:index + 1])
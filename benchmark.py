@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline di ImageProcessor con un corpus di immagini locali.
+
+Genera un corpus sintetico deterministico (più eventuali immagini di fixture)
+a varie dimensioni e formati, lo serve da un server HTTP locale al posto della
+rete e processa ogni immagine direttamente con ImageProcessor, senza API né
+cache dei risultati. Per ogni immagine riporta i percentili delle durate per
+fase, il throughput, l'RSS di picco e (opzionale) le allocazioni Python, e
+salva i risultati in JSON per confrontarli con un'esecuzione precedente.
+
+La configurazione del processore usa le stesse variabili d'ambiente del
+server (PRECISION, INFERENCE_BACKEND, INFERENCE_RESOLUTION, BATCH_MAX_SIZE,
+TORCH_COMPILE, ...), sovrascrivibili dalla riga di comando.
+
+Esempi:
+    python benchmark.py --iterations 10 --output baseline.json
+    PRECISION=int8-dynamic python benchmark.py --output int8.json --compare baseline.json
+    python benchmark.py --concurrency 4 --batch-size 4 --sizes 1920x1080 --formats jpeg
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageFilter
+
+import metrics
+from cpu_layout import apply_layout, plan_layout
+from image_processor import ImageProcessor
+
+DEFAULT_CORPUS_DIR = './.cache/benchmark/corpus'
+DEFAULT_SIZES = '640x480,1280x960,1920x1080,4000x3000'
+DEFAULT_FORMATS = 'jpeg,png,webp'
+PERCENTILES = (50, 90, 95, 99)
+
+# Formato PIL ed estensione per ogni formato del corpus
+CORPUS_FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 90}),
+    'png': ('PNG', 'png', {}),
+    'webp': ('WEBP', 'webp', {'quality': 90}),
+}
+FIXTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tiff')
+
+
+def parse_size(text: str) -> Tuple[int, int]:
+    """Converte "LARGHEZZAxALTEZZA" in una tupla."""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """
+    Immagine sintetica simile a una foto di prodotto.
+
+    Sfondo a gradiente con rumore, un oggetto in primo piano con texture e
+    bordi sfumati: comprime e si segmenta in modo più realistico del rumore puro.
+    """
+    rng = np.random.RandomState(seed)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    top, bottom = rng.uniform(150, 240, 3), rng.uniform(60, 160, 3)
+    background = top * (1 - y) + bottom * y + 20 * x
+    background = background + rng.normal(0, 4, (height, width, 3))
+    image = Image.fromarray(np.clip(background, 0, 255).astype(np.uint8))
+
+    # Oggetto: ellisse con texture a bande, incollata con una maschera sfumata
+    texture = np.sin(np.arange(width, dtype=np.float32) / max(4, width / 60))[None, :, None]
+    color = rng.uniform(30, 220, 3)
+    foreground = np.clip(color + 35 * texture + rng.normal(0, 8, (height, width, 3)), 0, 255)
+    mask = Image.new('L', (width, height), 0)
+    ImageDraw.Draw(mask).ellipse(
+        (width * 0.25, height * 0.15, width * 0.75, height * 0.9),
+        fill=255
+    )
+    mask = mask.filter(ImageFilter.GaussianBlur(max(1, min(width, height) // 200)))
+    image.paste(Image.fromarray(foreground.astype(np.uint8)), (0, 0), mask)
+    return image
+
+
+def build_corpus(
+    directory: str,
+    sizes: List[Tuple[int, int]],
+    formats: List[str],
+    fixtures_dir: Optional[str] = None
+) -> List[str]:
+    """
+    Crea il corpus (solo i file mancanti) e restituisce i nomi dei file.
+
+    Le immagini sintetiche sono deterministiche: la stessa configurazione
+    produce sempre gli stessi byte, quindi due esecuzioni sono confrontabili.
+    """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for index, (width, height) in enumerate(sizes):
+        image = None
+        for format_name in formats:
+            pil_format, extension, options = CORPUS_FORMATS[format_name]
+            name = f"synthetic-{width}x{height}.{extension}"
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                if image is None:
+                    image = synthetic_image(width, height, seed=index)
+                image.save(path, pil_format, **options)
+            names.append(name)
+
+    if fixtures_dir:
+        for filename in sorted(os.listdir(fixtures_dir)):
+            if not filename.lower().endswith(FIXTURE_EXTENSIONS):
+                continue
+            name = f"fixture-{filename}"
+            shutil.copy2(os.path.join(fixtures_dir, filename), os.path.join(directory, name))
+            names.append(name)
+
+    return names
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Handler statico senza log per ogni richiesta."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_corpus(directory: str) -> Tuple[http.server.ThreadingHTTPServer, str]:
+    """Serve il corpus da un server HTTP locale su una porta libera."""
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, name="benchmark-http", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def current_rss_mb() -> Optional[float]:
+    """RSS attuale del processo in MB (solo Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb() -> float:
+    """RSS di picco del processo in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit() -> Optional[str]:
+    """Commit corrente del repository, se disponibile."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Percentili, media, minimo e massimo in millisecondi per ogni fase."""
+    stages = [name for name in metrics.STAGES + ('total',) if any(name in sample for sample in samples)]
+    summary = {}
+    for name in stages:
+        values = np.array([sample.get(name, 0.0) for sample in samples]) * 1000
+        summary[name] = {
+            **{f"p{p}": round(float(np.percentile(values, p)), 3) for p in PERCENTILES},
+            'mean': round(float(values.mean()), 3),
+            'min': round(float(values.min()), 3),
+            'max': round(float(values.max()), 3),
+        }
+    return summary
+
+
+def create_processor(args: argparse.Namespace) -> ImageProcessor:
+    """Crea il processore con la configurazione del benchmark (senza cache)."""
+    return ImageProcessor(
+        temp_dir=os.path.join(os.path.dirname(args.corpus_dir.rstrip(os.sep)), 'tmp'),
+        batch_max_size=args.batch_size,
+        batch_max_wait_ms=args.batch_wait_ms,
+        result_cache=None,
+        precision=args.precision,
+        inference_backend=args.backend,
+        onnx_model_path=os.getenv("ONNX_MODEL_PATH", "./.cache/onnx/model.onnx"),
+        stub_options={
+            "cost_ms": float(os.getenv("STUB_INFERENCE_MS", 50)),
+            "cost_mode": os.getenv("STUB_COST_MODE", "sleep").lower()
+        },
+        compile_mode=args.compile,
+        compile_cache_dir=os.getenv("TORCH_COMPILE_CACHE_DIR", "./.cache/torch"),
+        warmup_enabled=args.model_warmup,
+        inference_resolution=args.resolution,
+        resolutions=[int(r) for r in os.getenv("INFERENCE_RESOLUTIONS", "512,768,1024").split(",") if r.strip()],
+        letterbox=args.letterbox,
+        mask_upsample=args.mask_upsample,
+        output_format=args.format,
+        model_local_only=os.getenv("MODEL_LOCAL_ONLY", "False").lower() == "true",
+        model_artifact_dir=os.getenv("MODEL_ARTIFACT_DIR", "./.cache/model-artifact") or None
+    )
+
+
+class CaseRunner:
+    """Esegue le iterazioni di un'immagine del corpus e raccoglie le durate."""
+
+    def __init__(self, processor: ImageProcessor, args: argparse.Namespace, base_url: str):
+        self.processor = processor
+        self.args = args
+        self.base_url = base_url
+
+    def process_once(self, name: str, data: bytes) -> Tuple[Dict[str, float], int]:
+        """Processa un'immagine e restituisce le durate per fase e i byte prodotti."""
+        timings = metrics.start_timings()
+        start_time = time.perf_counter()
+        if self.args.source == 'http':
+            result, _ = self.processor.process_image_from_url_with_info(f"{self.base_url}/{name}")
+        elif self.args.source == 'file':
+            path = os.path.abspath(os.path.join(self.args.corpus_dir, name))
+            result, _ = self.processor.process_downloaded_image(path, f"file://{path}")
+        else:
+            result, _ = self.processor.process_uploaded_image(data, name)
+        timings['total'] = time.perf_counter() - start_time
+        return dict(timings), len(result)
+
+    def run(self, name: str) -> Tuple[Dict[str, Any], List[Dict[str, float]]]:
+        """Warmup e iterazioni misurate di un'immagine, eventualmente concorrenti."""
+        path = os.path.join(self.args.corpus_dir, name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with Image.open(path) as image:
+            width, height, image_format = image.width, image.height, image.format
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for _ in range(self.args.warmup):
+                self.process_once(name, data)
+
+            if self.args.tracemalloc:
+                tracemalloc.reset_peak()
+            start_time = time.perf_counter()
+            futures = [pool.submit(self.process_once, name, data) for _ in range(self.args.iterations)]
+            outcomes = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start_time
+
+        samples = [timings for timings, _ in outcomes]
+        result = {
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'input_bytes': len(data),
+            'output_bytes': int(np.mean([size for _, size in outcomes])),
+            'iterations': len(samples),
+            'seconds': round(elapsed, 4),
+            'throughput_ips': round(len(samples) / elapsed, 3),
+            'megapixels_per_second': round(len(samples) * width * height / 1e6 / elapsed, 3),
+            'stages': summarize(samples),
+        }
+        if self.args.tracemalloc:
+            result['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        return result, samples
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    """Tabella riassuntiva: p50/p95 totali e throughput per immagine."""
+    print(f"\n{'immagine':<32} {'p50 ms':>10} {'p95 ms':>10} {'img/s':>8} {'output KB':>10}")
+    print("-" * 74)
+    for name, case in results['cases'].items():
+        total = case['stages']['total']
+        print(
+            f"{name:<32} {total['p50']:>10.1f} {total['p95']:>10.1f} "
+            f"{case['throughput_ips']:>8.2f} {case['output_bytes'] / 1024:>10.1f}"
+        )
+
+    print(f"\n{'fase':<14} {'p50 ms':>10} {'p90 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    print("-" * 58)
+    for stage, values in results['overall']['stages'].items():
+        print(f"{stage:<14} {values['p50']:>10.1f} {values['p90']:>10.1f} {values['p95']:>10.1f} {values['p99']:>10.1f}")
+
+    memory = results['memory']
+    print(
+        f"\nThroughput complessivo: {results['overall']['throughput_ips']:.2f} img/s, "
+        f"RSS dopo il caricamento {memory['rss_after_load_mb']} MB, picco {memory['peak_rss_mb']} MB"
+    )
+
+
+def delta(baseline: float, current: float) -> str:
+    """Variazione percentuale rispetto al baseline."""
+    if not baseline:
+        return "n/d"
+    return f"{(current - baseline) / baseline * 100:+.1f}%"
+
+
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Confronta fasi, immagini e memoria con un'esecuzione precedente."""
+    print(f"\nConfronto con {baseline.get('git_commit') or 'baseline'} ({baseline.get('created', '')})")
+    config_changes = {
+        key: (baseline['config'].get(key), value)
+        for key, value in results['config'].items()
+        if baseline.get('config', {}).get(key) != value
+    }
+    for key, (old, new) in config_changes.items():
+        print(f"  {key}: {old} → {new}")
+
+    print(f"\n{'fase':<14} {'p50 base':>10} {'p50':>10} {'Δ':>8} {'p95 base':>10} {'p95':>10} {'Δ':>8}")
+    print("-" * 76)
+    base_stages = baseline['overall']['stages']
+    for stage, values in results['overall']['stages'].items():
+        if stage not in base_stages:
+            continue
+        old = base_stages[stage]
+        print(
+            f"{stage:<14} {old['p50']:>10.1f} {values['p50']:>10.1f} {delta(old['p50'], values['p50']):>8} "
+            f"{old['p95']:>10.1f} {values['p95']:>10.1f} {delta(old['p95'], values['p95']):>8}"
+        )
+
+    print(f"\n{'immagine':<32} {'p50 base':>10} {'p50':>10} {'Δ':>8} {'img/s Δ':>9}")
+    print("-" * 73)
+    for name, case in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        old_p50, new_p50 = old['stages']['total']['p50'], case['stages']['total']['p50']
+        print(
+            f"{name:<32} {old_p50:>10.1f} {new_p50:>10.1f} {delta(old_p50, new_p50):>8} "
+            f"{delta(old['throughput_ips'], case['throughput_ips']):>9}"
+        )
+
+    old_memory, memory = baseline['memory'], results['memory']
+    print(
+        f"\nThroughput: {delta(baseline['overall']['throughput_ips'], results['overall']['throughput_ips'])}, "
+        f"RSS di picco: {old_memory['peak_rss_mb']} → {memory['peak_rss_mb']} MB"
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Opzioni del benchmark (default dalle variabili d'ambiente del server)."""
+    parser = argparse.ArgumentParser(description="Benchmark offline di ImageProcessor")
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR, help="Directory del corpus generato")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Dimensioni sintetiche, es. 640x480,1920x1080")
+    parser.add_argument('--formats', default=DEFAULT_FORMATS, help="Formati del corpus: jpeg, png, webp")
+    parser.add_argument('--fixtures', default=None, help="Directory di immagini reali da aggiungere al corpus")
+    parser.add_argument('--source', choices=('http', 'file', 'bytes'), default='http',
+                        help="http: download dal server locale; file: percorso su disco; bytes: come un upload")
+    parser.add_argument('--iterations', type=int, default=5, help="Iterazioni misurate per immagine")
+    parser.add_argument('--warmup', type=int, default=1, help="Iterazioni scartate per immagine")
+    parser.add_argument('--concurrency', type=int, default=1, help="Iterazioni eseguite in parallelo")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Misura il picco delle allocazioni Python (rallenta l'esecuzione)")
+    parser.add_argument('--output', default=None, help="File JSON dei risultati")
+    parser.add_argument('--compare', default=None, help="File JSON di un'esecuzione precedente")
+
+    parser.add_argument('--precision', default=os.getenv("PRECISION", "fp32").lower())
+    parser.add_argument('--backend', default=os.getenv("INFERENCE_BACKEND", "torch").lower())
+    parser.add_argument('--resolution', default=os.getenv("INFERENCE_RESOLUTION", "1024").lower())
+    parser.add_argument('--letterbox', action='store_true',
+                        default=os.getenv("LETTERBOX", "False").lower() == "true")
+    parser.add_argument('--mask-upsample', default=os.getenv("MASK_UPSAMPLE", "bilinear").lower())
+    parser.add_argument('--compile', default=os.getenv("TORCH_COMPILE", "none").lower())
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv("BATCH_MAX_SIZE", 1)))
+    parser.add_argument('--batch-wait-ms', type=float, default=float(os.getenv("BATCH_MAX_WAIT_MS", 10)))
+    parser.add_argument('--format', default=os.getenv("OUTPUT_FORMAT", "png").lower(), help="Formato di output")
+    parser.add_argument('--no-model-warmup', dest='model_warmup', action='store_false',
+                        help="Salta il warmup del modello al caricamento")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    for format_name in args.formats.split(','):
+        if format_name not in CORPUS_FORMATS:
+            print(f"❌ Formato del corpus non supportato: {format_name}")
+            return 2
+
+    print("📁 Preparazione del corpus...")
+    names = build_corpus(
+        args.corpus_dir,
+        [parse_size(size) for size in args.sizes.split(',') if size.strip()],
+        [name for name in args.formats.split(',') if name],
+        args.fixtures
+    )
+    server, base_url = serve_corpus(args.corpus_dir)
+
+    # Stessa suddivisione dei thread del server con lo stesso parallelismo
+    layout = plan_layout(lanes=args.concurrency, batching=args.batch_size > 1)
+    apply_layout(layout)
+
+    print("🧠 Caricamento del modello...")
+    load_start = time.perf_counter()
+    processor = create_processor(args)
+    load_seconds = time.perf_counter() - load_start
+    rss_after_load = current_rss_mb()
+    print(f"✅ {processor.model_name} caricato in {load_seconds:.1f}s")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    runner = CaseRunner(processor, args, base_url)
+    cases = {}
+    all_samples = []
+    total_seconds = 0.0
+    try:
+        for name in names:
+            print(f"⏱️  {name}")
+            cases[name], samples = runner.run(name)
+            all_samples.extend(samples)
+            total_seconds += cases[name]['seconds']
+    finally:
+        server.shutdown()
+
+    results = {
+        'created': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpus': layout.cpus,
+            'cpu_source': layout.source,
+        },
+        'config': {
+            'source': args.source,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'precision': processor.precision,
+            'backend': processor.engine.name if processor.engine is not None else 'rembg',
+            'resolution': args.resolution,
+            'letterbox': args.letterbox,
+            'mask_upsample': args.mask_upsample,
+            'compile': processor.compile_mode,
+            'batch_size': args.batch_size,
+            'output_format': args.format,
+        },
+        'model': {
+            'name': processor.model_name,
+            'load_seconds': round(load_seconds, 3),
+        },
+        'memory': {
+            'rss_after_load_mb': round(rss_after_load, 1) if rss_after_load is not None else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        },
+        'cases': cases,
+        'overall': {
+            'images': len(all_samples),
+            'seconds': round(total_seconds, 4),
+            'throughput_ips': round(len(all_samples) / total_seconds, 3) if total_seconds else 0.0,
+            'stages': summarize(all_samples),
+        },
+    }
+    if args.tracemalloc:
+        results['memory']['tracemalloc_peak_mb'] = round(
+            max(case['tracemalloc_peak_mb'] for case in cases.values()), 2
+        )
+        tracemalloc.stop()
+
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Risultati salvati in {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+from engines import SegmentationWrapper
+
+logger = logging.getLogger(__name__)
+
+# Modalità di esecuzione del modello PyTorch
+COMPILE_MODES = ('none', 'compile', 'trace')
+
+
+def artifact_tag(model_name: str, precision: str) -> str:
+    """
+    Identificativo degli artefatti compilati per modello, precisione e versione di torch.
+
+    Returns:
+        str: Nome sicuro da usare come nome di file
+    """
+    raw = f"{model_name}-{precision}-torch{torch.__version__}"
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', raw)
+
+
+class ResolutionDispatch(torch.nn.Module):
+    """Sceglie il modulo TorchScript tracciato alla risoluzione dell'input."""
+
+    def __init__(self, modules: Dict[Tuple[int, int], torch.nn.Module]):
+        super().__init__()
+        self.resolutions = {size: str(index) for index, size in enumerate(modules)}
+        self.traced = torch.nn.ModuleDict({
+            self.resolutions[size]: module for size, module in modules.items()
+        })
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        size = (pixel_values.shape[-2], pixel_values.shape[-1])
+        if size not in self.resolutions:
+            raise ValueError(f"Nessun modulo tracciato per la risoluzione {size[0]}x{size[1]}")
+        return self.traced[self.resolutions[size]](pixel_values)
+
+
+def compile_model(
+    model: torch.nn.Module,
+    mode: str,
+    cache_dir: str,
+    tag: str,
+    shapes: List[Tuple[int, ...]]
+) -> torch.nn.Module:
+    """
+    Prepara il modello di segmentazione per l'esecuzione compilata.
+
+    Il modulo restituito produce direttamente la maschera normalizzata.
+    Con `compile` i kernel generati da Inductor vengono salvati in
+    `cache_dir/inductor` e riusati ai riavvii successivi; con `trace` un
+    modulo TorchScript per ogni risoluzione viene salvato in
+    `cache_dir/<tag>-<H>x<W>.pt` e ricaricato senza ripetere il tracing.
+
+    Args:
+        model: Modello PyTorch in modalità eval
+        mode: Una delle COMPILE_MODES diversa da `none`
+        cache_dir: Directory degli artefatti compilati
+        tag: Identificativo degli artefatti (vedi artifact_tag)
+        shapes: Forme degli input (N, 3, H, W) che il modello riceverà
+
+    Returns:
+        torch.nn.Module: Modulo compilato
+
+    Raises:
+        ValueError: Se la modalità non è supportata
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    wrapper = SegmentationWrapper(model).eval()
+
+    if mode == 'compile':
+        # Cache persistente dei grafi FX e dei kernel generati (letta da Inductor
+        # a ogni compilazione, quindi va impostata qui e non solo all'import)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(os.path.join(cache_dir, 'inductor'))
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+        # Un grafo specializzato per ogni forma, senza ricadere sull'eager
+        import torch._dynamo.config as dynamo_config
+        dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, len(shapes))
+        return torch.compile(wrapper, dynamic=False)
+
+    if mode == 'trace':
+        resolutions = sorted({(shape[-2], shape[-1]) for shape in shapes})
+        modules = {
+            (height, width): _load_or_trace(wrapper, cache_dir, f"{tag}-{height}x{width}", height, width)
+            for height, width in resolutions
+        }
+        if len(modules) == 1:
+            return next(iter(modules.values()))
+        return ResolutionDispatch(modules)
+
+    raise ValueError(f"Modalità di compilazione non supportata: {mode}")
+
+
+def _load_or_trace(
+    wrapper: torch.nn.Module,
+    cache_dir: str,
+    tag: str,
+    height: int,
+    width: int
+) -> torch.nn.Module:
+    """Carica dalla cache (o traccia e salva) il modulo TorchScript per una risoluzione."""
+    path = os.path.join(cache_dir, f"{tag}.pt")
+    if os.path.exists(path):
+        try:
+            traced = torch.jit.load(path, map_location='cpu')
+            logger.info(f"Modulo TorchScript caricato dalla cache: {path}")
+            return traced.eval()
+        except Exception as e:
+            logger.warning(f"Modulo TorchScript in cache non valido, ripeto il tracing: {e}")
+
+    example_input = torch.zeros(1, 3, height, width)
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, (example_input,), check_trace=False, strict=False)
+        traced = torch.jit.freeze(traced.eval())
+
+    tmp_path = f"{path}.tmp"
+    torch.jit.save(traced, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Modulo TorchScript salvato: {path}")
+    return traced
+
+
+def warmup(
+    predict_fn: Callable[[torch.Tensor], torch.Tensor],
+    shapes: List[Tuple[int, ...]]
+) -> float:
+    """
+    Esegue un'inferenza per ogni forma di input prevista.
+
+    Serve a pagare all'avvio, e non alla prima richiesta, la compilazione dei
+    grafi, l'allocazione dei buffer e l'inizializzazione dei thread pool.
+
+    Args:
+        predict_fn: Funzione di predizione del backend
+        shapes: Forme degli input (N, 3, H, W)
+
+    Returns:
+        float: Durata complessiva del warmup in secondi
+    """
+    start_time = time.time()
+    for shape in shapes:
+        shape_start = time.time()
+        predict_fn(torch.zeros(shape))
+        logger.info(f"Warmup {tuple(shape)}: {time.time() - shape_start:.2f}s")
+    return time.time() - start_time
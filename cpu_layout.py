@@ -0,0 +1,190 @@
+import logging
+import math
+import os
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _cgroup_path() -> str:
+    """Percorso del cgroup v2 del processo (relativo alla radice montata)."""
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return line[3:].strip().lstrip('/')
+    except OSError:
+        pass
+    return ''
+
+
+def _read_quota_v2() -> Optional[float]:
+    """Quota CPU da cpu.max (cgroup v2), None se illimitata o assente."""
+    relative = _cgroup_path()
+    candidates = [os.path.join(CGROUP_ROOT, relative, 'cpu.max')] if relative else []
+    candidates.append(os.path.join(CGROUP_ROOT, 'cpu.max'))
+    for path in candidates:
+        try:
+            with open(path) as f:
+                quota, period = f.read().split()[:2]
+        except (OSError, ValueError):
+            continue
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    return None
+
+
+def _read_quota_v1() -> Optional[float]:
+    """Quota CPU da cpu.cfs_quota_us / cpu.cfs_period_us (cgroup v1)."""
+    for directory in ('cpu', 'cpu,cpuacct'):
+        base = os.path.join(CGROUP_ROOT, directory)
+        try:
+            with open(os.path.join(base, 'cpu.cfs_quota_us')) as f:
+                quota = int(f.read())
+            with open(os.path.join(base, 'cpu.cfs_period_us')) as f:
+                period = int(f.read())
+        except (OSError, ValueError):
+            continue
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    return None
+
+
+def detect_cpus() -> Tuple[int, str]:
+    """
+    CPU effettivamente utilizzabili dal processo.
+
+    Considera l'affinità (cpuset) e la quota CFS del cgroup, che in un
+    container con `cpus: '2.0'` è più bassa del numero di core dell'host.
+    Una quota frazionaria viene arrotondata per difetto: un thread in più
+    della quota viene sospeso dal throttling a ogni periodo.
+
+    Returns:
+        Tuple[int, str]: Numero di CPU e origine del limite
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+        source = 'affinity'
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+        source = 'cpu_count'
+
+    quota = _read_quota_v2()
+    quota_source = 'cgroup cpu.max'
+    if quota is None:
+        quota = _read_quota_v1()
+        quota_source = 'cgroup cfs_quota_us'
+
+    if quota is not None and math.floor(quota) < cpus:
+        cpus = math.floor(quota)
+        source = f"{quota_source} ({quota:g})"
+
+    return max(1, cpus), source
+
+
+class CpuLayout:
+    """
+    Suddivisione delle CPU tra processi worker, corsie di inferenza e thread.
+
+    Ogni corsia che esegue il modello usa un proprio team di thread intra-op:
+    per non superare le CPU disponibili ciascuna riceve la sua quota. Con il
+    micro-batching il forward pass avviene in un solo thread e riceve tutte le
+    CPU del worker. ONNX Runtime condivide invece un unico pool tra le
+    esecuzioni concorrenti, a cui si aggiunge il thread chiamante di ogni corsia.
+    """
+
+    def __init__(
+        self,
+        cpus: int,
+        source: str,
+        workers: int = 1,
+        lanes: int = 1,
+        batching: bool = False,
+        intra_op_threads: Optional[int] = None
+    ):
+        self.cpus = max(1, cpus)
+        self.source = source
+        self.workers = max(1, workers)
+        self.lanes = max(1, lanes)
+
+        self.cpus_per_worker = max(1, self.cpus // self.workers)
+        # Forward pass che possono essere in esecuzione contemporaneamente
+        self.concurrent_forwards = 1 if batching else self.lanes
+        self.intra_op_threads = intra_op_threads or max(1, self.cpus_per_worker // self.concurrent_forwards)
+        self.inter_op_threads = 1
+        self.ort_intra_op_threads = intra_op_threads or max(
+            1, self.cpus_per_worker - self.concurrent_forwards + 1
+        )
+
+    @property
+    def oversubscribed(self) -> bool:
+        """True se i thread di calcolo superano le CPU disponibili."""
+        return self.workers * self.concurrent_forwards * self.intra_op_threads > self.cpus
+
+    def describe(self) -> str:
+        """Descrizione leggibile del layout, per il log di avvio."""
+        return (
+            f"{self.cpus} CPU ({self.source}): {self.workers} worker × "
+            f"{self.concurrent_forwards} forward concorrenti × {self.intra_op_threads} thread intra-op "
+            f"(inter-op {self.inter_op_threads}, ONNX Runtime {self.ort_intra_op_threads})"
+        )
+
+
+def plan_layout(
+    workers: int = 1,
+    lanes: int = 1,
+    batching: bool = False,
+    cpus: Optional[int] = None,
+    intra_op_threads: Optional[int] = None
+) -> CpuLayout:
+    """
+    Calcola il layout dei thread a partire dalle CPU del cgroup.
+
+    Args:
+        workers: Processi worker
+        lanes: Corsie di inferenza per worker
+        batching: True se il micro-batching serializza i forward pass
+        cpus: CPU da usare al posto di quelle rilevate
+        intra_op_threads: Thread intra-op da usare al posto di quelli calcolati
+
+    Returns:
+        CpuLayout: Layout scelto
+    """
+    if cpus:
+        source = 'CPU_LIMIT'
+    else:
+        cpus, source = detect_cpus()
+    return CpuLayout(cpus, source, workers, lanes, batching, intra_op_threads)
+
+
+def apply_layout(layout: CpuLayout, intra_op_threads: Optional[int] = None) -> None:
+    """
+    Applica il layout a torch e alle sessioni ONNX Runtime create in seguito.
+
+    `OMP_NUM_THREADS` viene letto da rembg per configurare le proprie sessioni.
+
+    Args:
+        layout: Layout da applicare
+        intra_op_threads: Thread intra-op di torch se diversi dal layout
+            (es. 1 nel supervisore prima del fork)
+    """
+    import torch
+
+    os.environ['OMP_NUM_THREADS'] = str(layout.ort_intra_op_threads)
+    torch.set_num_threads(intra_op_threads or layout.intra_op_threads)
+    try:
+        torch.set_num_interop_threads(layout.inter_op_threads)
+    except RuntimeError:
+        # Già impostati o pool inter-op già avviato
+        pass
+
+    logger.info(f"Layout CPU: {layout.describe()}")
+    if layout.oversubscribed:
+        logger.warning(
+            f"Thread di calcolo oltre le {layout.cpus} CPU disponibili: "
+            f"riduci WORKERS o INFERENCE_WORKERS"
+        )
@@ -0,0 +1,165 @@
+import asyncio
+import io
+import logging
+import os
+from typing import Optional, Union
+
+import httpx
+import requests
+
+import metrics
+from image_processor import ImageProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncImageDownloader:
+    """
+    Downloader asincrono con un pool di connessioni condiviso.
+
+    Un solo client HTTP con keep-alive (e HTTP/2 opzionale) tiene le
+    connessioni aperte per host, così le immagini dagli stessi CDN riusano
+    connessioni già aperte invece di ripetere DNS, TCP e TLS a ogni richiesta;
+    il numero totale di connessioni è limitato qualunque sia il numero di
+    host richiesti. Il download gira sull'event loop:
+    mentre il modello processa un'immagine, quelle delle richieste successive
+    vengono già scaricate.
+    """
+
+    def __init__(
+        self,
+        image_processor: ImageProcessor,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        total_timeout: float = 60.0,
+        max_connections: int = 64,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False
+    ):
+        self.image_processor = image_processor
+        self.total_timeout = total_timeout
+        self._timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=read_timeout,
+            pool=connect_timeout
+        )
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Pacchetto h2 non disponibile, HTTP/2 disattivato")
+                http2 = False
+        self.http2 = http2
+
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Restituisce il client condiviso, creandolo al primo download."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self._timeout,
+                limits=self._limits,
+                http2=self.http2,
+                follow_redirects=True
+            )
+        return self._client
+
+    async def download(self, url: str) -> Union[bytes, str]:
+        """
+        Scarica un'immagine in memoria (o su disco oltre la soglia di spill).
+
+        Args:
+            url: URL dell'immagine da scaricare
+
+        Returns:
+            bytes | str: Byte dell'immagine oppure percorso del file temporaneo
+
+        Raises:
+            ValueError: Se l'URL non è valido, non punta a un'immagine o supera la dimensione massima
+            requests.RequestException: Se il download fallisce o va in timeout
+        """
+        if not self.image_processor.is_valid_image_url(url):
+            raise ValueError("URL dell'immagine non valido")
+
+        try:
+            with metrics.stage('download'):
+                source = await asyncio.wait_for(self._download(url), timeout=self.total_timeout)
+        except asyncio.TimeoutError:
+            raise requests.RequestException(
+                f"Errore nel download dell'immagine: timeout totale di {self.total_timeout}s superato"
+            )
+        except httpx.HTTPError as e:
+            raise requests.RequestException(f"Errore nel download dell'immagine: {str(e)}")
+
+        size = os.path.getsize(source) if isinstance(source, str) else len(source)
+        metrics.RECEIVED_BYTES.labels('download').inc(size)
+        return source
+
+    async def _download(self, url: str) -> Union[bytes, str]:
+        """Download effettivo, senza il timeout totale."""
+        client = self._get_client()
+        spill_threshold = self.image_processor.spill_threshold_bytes
+        temp_path = None
+
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+
+            # Verifica il content-type
+            content_type = response.headers.get('content-type', '').lower()
+            if not content_type.startswith('image/'):
+                raise ValueError("L'URL non punta a un'immagine valida")
+
+            # Limite di dimensione: prima dal Content-Length, poi sui byte ricevuti
+            content_length = response.headers.get('content-length', '')
+            if content_length.isdigit():
+                self.image_processor.check_download_size(int(content_length))
+
+            buffer = io.BytesIO()
+            spill_file = None
+            received = 0
+
+            try:
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    received += len(chunk)
+                    self.image_processor.check_download_size(received)
+                    if spill_file is not None:
+                        await asyncio.to_thread(spill_file.write, chunk)
+                        continue
+
+                    buffer.write(chunk)
+
+                    # Spill su disco solo per input molto grandi (opt-in)
+                    if spill_threshold is not None and buffer.tell() > spill_threshold:
+                        temp_path = self.image_processor.new_temp_path(content_type)
+                        spill_file = open(temp_path, 'wb')
+                        await asyncio.to_thread(spill_file.write, buffer.getvalue())
+                        buffer = io.BytesIO()
+            except BaseException:
+                if spill_file is not None:
+                    spill_file.close()
+                    spill_file = None
+                if temp_path:
+                    self.image_processor.cleanup_file(temp_path)
+                raise
+            finally:
+                if spill_file is not None:
+                    spill_file.close()
+
+        if temp_path is not None:
+            logger.info(f"Immagine di grandi dimensioni scritta su disco: {temp_path}")
+            return temp_path
+
+        return buffer.getvalue()
+
+    async def aclose(self) -> None:
+        """Chiude tutte le connessioni aperte."""
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
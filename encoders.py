@@ -0,0 +1,312 @@
+import io
+import json
+import logging
+import struct
+import zlib
+from typing import Any, Dict, Iterable, Optional, Union
+from xml.sax.saxutils import escape
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+from postprocessing import StripComposite
+
+logger = logging.getLogger(__name__)
+
+# Formati di output selezionabili per richiesta
+OUTPUT_FORMATS = ('png', 'webp', 'webp-lossless', 'mask')
+
+MEDIA_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'webp-lossless': 'image/webp',
+    'mask': 'image/png',
+}
+
+FILE_EXTENSIONS = {
+    'png': 'png',
+    'webp': 'webp',
+    'webp-lossless': 'webp',
+    'mask': 'png',
+}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Byte di righe filtrati insieme dall'encoder PNG a strisce
+FILTER_BLOCK_BYTES = 1 << 18
+
+
+class OutputFormat:
+    """Formato di output di una richiesta, con il relativo livello di compressione."""
+
+    def __init__(self, name: str = 'png', compress_level: int = 6, quality: int = 90, method: int = 4):
+        if name not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Formato di output non supportato: {name} (valori ammessi: {', '.join(OUTPUT_FORMATS)})"
+            )
+        if not 0 <= compress_level <= 9:
+            raise ValueError("compress_level deve essere compreso tra 0 e 9")
+        if not 0 <= quality <= 100:
+            raise ValueError("quality deve essere compresa tra 0 e 100")
+
+        self.name = name
+        self.compress_level = compress_level
+        self.quality = quality
+        self.method = method
+
+    @property
+    def media_type(self) -> str:
+        """Content-Type della risposta."""
+        return MEDIA_TYPES[self.name]
+
+    @property
+    def extension(self) -> str:
+        """Estensione del file restituito."""
+        return FILE_EXTENSIONS[self.name]
+
+    @property
+    def streamable(self) -> bool:
+        """Se il formato si può codificare a strisce (PNG e maschera)."""
+        return self.media_type == 'image/png'
+
+    def for_strips(self) -> 'OutputFormat':
+        """
+        Formato usato per un'immagine composta a strisce.
+
+        libwebp richiede l'immagine RGBA completa in memoria: oltre la soglia
+        della composizione a strisce i formati WebP diventano PNG, con lo
+        stesso livello zlib, invece di ricostruire il buffer a piena risoluzione.
+        """
+        if self.streamable:
+            return self
+        return OutputFormat('png', self.compress_level, self.quality, self.method)
+
+    def variant(self) -> str:
+        """Identificativo del formato e dei parametri che cambiano i byte prodotti."""
+        if self.name == 'webp':
+            return f"webp:q{self.quality}:m{self.method}"
+        if self.name == 'webp-lossless':
+            return f"webp-lossless:q{self.quality}:m{self.method}"
+        return f"{self.name}:z{self.compress_level}"
+
+
+def negotiate_format(accept: Optional[str]) -> Optional[str]:
+    """
+    Sceglie il formato dall'header Accept, se il client chiede esplicitamente WebP.
+
+    Args:
+        accept: Valore dell'header Accept
+
+    Returns:
+        Optional[str]: 'webp' o 'png' se richiesti esplicitamente, altrimenti None
+    """
+    if not accept:
+        return None
+
+    preferences = {}
+    for item in accept.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        media_type = parts[0].lower()
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        preferences[media_type] = quality
+
+    webp = preferences.get('image/webp', 0.0)
+    png = preferences.get('image/png', 0.0)
+    if webp > 0 and webp >= png:
+        return 'webp'
+    if png > 0:
+        return 'png'
+    return None
+
+
+def build_xmp(metadata: Dict[str, Any]) -> bytes:
+    """
+    Costruisce un pacchetto XMP con i metadata di processamento (per WebP).
+
+    Args:
+        metadata: Metadata strutturati (serializzati in JSON)
+
+    Returns:
+        bytes: Pacchetto XMP in UTF-8
+    """
+    payload = escape(json.dumps(metadata, separators=(',', ':')))
+    return (
+        '<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:removebg="urn:removebg:ns:1.0" '
+        'xmlns:xmp="http://ns.adobe.com/xap/1.0/">'
+        '<xmp:CreatorTool>RemoveBG API v1.0.0</xmp:CreatorTool>'
+        f'<removebg:ProcessingInfo>{payload}</removebg:ProcessingInfo>'
+        '</rdf:Description>'
+        '</rdf:RDF>'
+        '</x:xmpmeta>'
+        '<?xpacket end="w"?>'
+    ).encode('utf-8')
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    """Chunk PNG: lunghezza, tipo, dati e CRC."""
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+def _filter_rows(rows: np.ndarray, previous: np.ndarray, bpp: int) -> np.ndarray:
+    """
+    Applica i filtri PNG a un blocco di righe, scegliendo il migliore per riga.
+
+    Tutti i filtri dipendono solo dai byte originali, quindi vengono calcolati
+    insieme sull'intero blocco; per ogni riga vince quello con la somma minima
+    dei valori con segno (la stessa euristica di libpng e di PIL).
+
+    Args:
+        rows: Righe (n, stride) in uint8
+        previous: Riga precedente al blocco (zeri per la prima)
+        bpp: Byte per pixel
+
+    Returns:
+        np.ndarray: Righe (n, 1 + stride) con il tipo di filtro in testa
+    """
+    up = np.concatenate([previous[None], rows[:-1]])
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    up_left = np.zeros_like(rows)
+    up_left[:, bpp:] = up[:, :-bpp]
+
+    # Paeth: il predittore più vicino a left + up - up_left
+    a, b, c = left.astype(np.int16), up.astype(np.int16), up_left.astype(np.int16)
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    average = ((a + b) >> 1).astype(np.uint8)
+
+    candidates = np.stack([rows, rows - left, rows - up, rows - average, rows - paeth])
+    # Valore assoluto del byte con segno calcolato in uint8: min(x, 256 - x)
+    scores = np.minimum(candidates, 0 - candidates).sum(axis=2, dtype=np.int64)
+    best = scores.argmin(axis=0)
+
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = best
+    filtered[:, 1:] = candidates[best, np.arange(rows.shape[0])]
+    return filtered
+
+
+def encode_png_strips(
+    size: tuple,
+    mode: str,
+    strips: Iterable[np.ndarray],
+    compress_level: int = 6,
+    pnginfo: Optional[PngImagePlugin.PngInfo] = None
+) -> bytes:
+    """
+    Codifica un PNG a strisce, senza l'immagine completa in memoria.
+
+    Ogni striscia viene filtrata e passata a uno stream zlib appena prodotta,
+    così il picco di memoria è quello di una striscia più l'output compresso.
+
+    Args:
+        size: (larghezza, altezza)
+        mode: 'RGBA' oppure 'L'
+        strips: Strisce dall'alto verso il basso, (righe, W, 4) oppure (righe, W)
+        compress_level: Livello zlib (0-9)
+        pnginfo: Chunk di testo da includere
+
+    Returns:
+        bytes: PNG completo
+    """
+    width, height = size
+    channels, color_type = (4, 6) if mode == 'RGBA' else (1, 0)
+    chunks = pnginfo.chunks if pnginfo is not None else []
+
+    output = io.BytesIO()
+    output.write(PNG_SIGNATURE)
+    output.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+    for chunk in chunks:
+        if not (len(chunk) > 2 and chunk[2]):
+            output.write(_png_chunk(chunk[0], chunk[1]))
+
+    stride = width * channels
+    # I filtri lavorano su blocchi di righe piccoli: i candidati sono 5 copie del blocco
+    block_rows = max(1, FILTER_BLOCK_BYTES // stride)
+    compressor = zlib.compressobj(compress_level)
+    previous = np.zeros(stride, dtype=np.uint8)
+    for strip in strips:
+        strip_rows = np.ascontiguousarray(strip).reshape(len(strip), stride)
+        for start in range(0, len(strip_rows), block_rows):
+            rows = strip_rows[start:start + block_rows]
+            if compress_level == 0:
+                filtered = np.zeros((rows.shape[0], stride + 1), dtype=np.uint8)
+                filtered[:, 1:] = rows
+            else:
+                filtered = _filter_rows(rows, previous, channels)
+            data = compressor.compress(filtered)
+            if data:
+                output.write(_png_chunk(b'IDAT', data))
+            previous = rows[-1]
+    output.write(_png_chunk(b'IDAT', compressor.flush()))
+
+    for chunk in chunks:
+        if len(chunk) > 2 and chunk[2]:
+            output.write(_png_chunk(chunk[0], chunk[1]))
+    output.write(_png_chunk(b'IEND', b''))
+    return output.getvalue()
+
+
+def encode(
+    image: Union[Image.Image, StripComposite],
+    output_format: OutputFormat,
+    pnginfo: Optional[PngImagePlugin.PngInfo] = None,
+    metadata: Optional[Dict[str, Any]] = None
+) -> bytes:
+    """
+    Codifica l'immagine RGBA nel formato richiesto, metadata inclusi, in un solo encoding.
+
+    Una StripComposite viene codificata a strisce e solo nei formati PNG
+    (vedi OutputFormat.for_strips).
+
+    Args:
+        image: Immagine RGBA processata (anche composta a strisce)
+        output_format: Formato e parametri di compressione
+        pnginfo: Chunk di testo per i formati PNG
+        metadata: Metadata strutturati da scrivere come XMP nei formati WebP
+
+    Returns:
+        bytes: Dati codificati pronti per la risposta
+
+    Raises:
+        ValueError: Se una StripComposite viene richiesta in un formato non PNG
+    """
+    if isinstance(image, StripComposite):
+        if output_format.name == 'png':
+            return encode_png_strips(image.size, 'RGBA', image.strips(), output_format.compress_level, pnginfo)
+        if output_format.name == 'mask':
+            return encode_png_strips(
+                image.size, 'L', image.strips(alpha_only=True), output_format.compress_level, pnginfo
+            )
+        raise ValueError(f"Formato {output_format.name} non disponibile per un'immagine composta a strisce")
+
+    output = io.BytesIO()
+
+    if output_format.name == 'png':
+        image.save(output, 'PNG', pnginfo=pnginfo, compress_level=output_format.compress_level)
+    elif output_format.name == 'mask':
+        # Solo il canale alpha, PNG in scala di grigi a 8 bit
+        image.getchannel('A').save(
+            output, 'PNG', pnginfo=pnginfo, compress_level=output_format.compress_level
+        )
+    else:
+        image.save(
+            output,
+            'WEBP',
+            lossless=output_format.name == 'webp-lossless',
+            quality=output_format.quality,
+            method=output_format.method,
+            exact=True,
+            xmp=build_xmp(metadata) if metadata else None
+        )
+
+    return output.getvalue()
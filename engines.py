@@ -0,0 +1,278 @@
+import contextlib
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Backend di inferenza selezionabili tramite INFERENCE_BACKEND
+INFERENCE_BACKENDS = ('torch', 'onnx', 'stub')
+# Modalità di costo del backend stub
+STUB_COST_MODES = ('sleep', 'cpu')
+
+
+def normalize_outputs(outputs: Any) -> torch.Tensor:
+    """
+    Riduce i diversi formati di output dei modelli a una maschera tra 0 e 1.
+
+    Args:
+        outputs: Output del modello (tensore oppure lista/tupla di tensori)
+
+    Returns:
+        torch.Tensor: Maschere (N, 1, H, W) con valori tra 0 e 1
+    """
+    # Gestisci diversi formati di output
+    if isinstance(outputs, (list, tuple)):
+        # Se è una lista, prendi l'ultimo elemento
+        preds = outputs[-1]
+    else:
+        # Se è un tensor diretto
+        preds = outputs
+
+    # Applica sigmoid se necessario
+    if hasattr(preds, 'sigmoid'):
+        return preds.sigmoid()
+    # Clamp tra 0 e 1 se sigmoid non è disponibile
+    return torch.clamp(preds, 0, 1)
+
+
+class SegmentationWrapper(torch.nn.Module):
+    """Modulo che restituisce direttamente la maschera normalizzata (usato per l'export)."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return normalize_outputs(self.model(pixel_values))
+
+
+class InferenceEngine(ABC):
+    """Interfaccia comune dei backend di inferenza."""
+
+    name = 'base'
+
+    @abstractmethod
+    def predict(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Esegue il modello su un batch di tensori preprocessati.
+
+        Args:
+            input_tensor: Tensore di input (N, 3, H, W)
+
+        Returns:
+            torch.Tensor: Maschere float32 (N, 1, H, W) con valori tra 0 e 1
+        """
+
+    def after_fork(self) -> None:
+        """Ricrea nel processo figlio le risorse che non sopravvivono al fork."""
+
+
+class TorchEngine(InferenceEngine):
+    """Backend PyTorch eager, con autocast opzionale."""
+
+    name = 'torch'
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        autocast_dtype: Optional[torch.dtype] = None,
+        normalized: bool = False
+    ):
+        self.model = model
+        self.autocast_dtype = autocast_dtype
+        # True se il modello restituisce già la maschera (es. modulo compilato)
+        self.normalized = normalized
+
+    def predict(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        autocast = (
+            torch.autocast('cpu', dtype=self.autocast_dtype)
+            if self.autocast_dtype is not None else contextlib.nullcontext()
+        )
+        with torch.no_grad(), autocast:
+            outputs = self.model(input_tensor)
+            if self.normalized:
+                return outputs.float().cpu()
+
+            # Debug: vediamo cosa restituisce il modello
+            logger.debug(f"Tipo output modello: {type(outputs)}")
+            if isinstance(outputs, (list, tuple)):
+                logger.debug(f"Lunghezza lista output: {len(outputs)}")
+                logger.debug(f"Tipo ultimo elemento: {type(outputs[-1])}")
+
+            return normalize_outputs(outputs).float().cpu()
+
+
+class OnnxEngine(InferenceEngine):
+    """Backend ONNX Runtime su un grafo esportato e salvato su disco."""
+
+    name = 'onnx'
+
+    def __init__(
+        self,
+        model_path: str,
+        graph_optimization_level: str = 'all',
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0
+    ):
+        import onnxruntime as ort
+
+        levels = {
+            'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }
+        if graph_optimization_level not in levels:
+            raise ValueError(f"Livello di ottimizzazione ONNX non valido: {graph_optimization_level}")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = levels[graph_optimization_level]
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+
+        self.model_path = model_path
+        self.options = options
+        self.session = self._open_session()
+        self.input_name = self.session.get_inputs()[0].name
+        self.metadata = read_export_metadata(model_path)
+
+    def _open_session(self):
+        import onnxruntime as ort
+
+        return ort.InferenceSession(
+            self.model_path,
+            sess_options=self.options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def after_fork(self) -> None:
+        # Il thread pool di ONNX Runtime non esiste nel processo figlio
+        self.session = self._open_session()
+
+    def predict(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(None, {self.input_name: input_tensor.numpy()})
+        return torch.from_numpy(outputs[-1]).float()
+
+
+class StubEngine(InferenceEngine):
+    """
+    Backend deterministico senza modello, per misurare il solo livello di serving.
+
+    Restituisce sempre la stessa maschera (un'ellisse centrata a bordi sfumati)
+    dopo un costo fisso per forward pass: con `sleep` il thread attende senza
+    usare CPU, con `cpu` esegue moltiplicazioni di matrici fino allo scadere
+    del tempo. In entrambi i casi il GIL viene rilasciato, come nel forward
+    pass di torch.
+    """
+
+    name = 'stub'
+
+    def __init__(self, cost_ms: float = 50.0, cost_mode: str = 'sleep'):
+        if cost_mode not in STUB_COST_MODES:
+            raise ValueError(f"Modalità di costo dello stub non supportata: {cost_mode}")
+        self.cost_seconds = max(0.0, cost_ms) / 1000
+        self.cost_mode = cost_mode
+        self._masks: Dict[Tuple[int, int], torch.Tensor] = {}
+
+    def _mask(self, height: int, width: int) -> torch.Tensor:
+        """Maschera per una dimensione di input, calcolata una sola volta."""
+        mask = self._masks.get((height, width))
+        if mask is None:
+            y = torch.linspace(-1, 1, height).view(-1, 1)
+            x = torch.linspace(-1, 1, width).view(1, -1)
+            distance = (x / 0.6) ** 2 + (y / 0.8) ** 2
+            mask = torch.clamp((1.0 - distance) * 8, 0, 1).view(1, 1, height, width)
+            self._masks[(height, width)] = mask
+        return mask
+
+    def _spend(self) -> None:
+        """Consuma il costo configurato del forward pass."""
+        if self.cost_mode == 'sleep':
+            time.sleep(self.cost_seconds)
+            return
+        deadline = time.perf_counter() + self.cost_seconds
+        matrix = torch.ones(256, 256)
+        while time.perf_counter() < deadline:
+            matrix = torch.mm(matrix, matrix).clamp_(0, 1)
+
+    def predict(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        self._spend()
+        batch, _, height, width = input_tensor.shape
+        return self._mask(height, width).expand(batch, -1, -1, -1).clone()
+
+
+def export_metadata_path(model_path: str) -> str:
+    """Percorso del file JSON che descrive il grafo esportato."""
+    return f"{model_path}.json"
+
+
+def read_export_metadata(model_path: str) -> Dict[str, Any]:
+    """Legge i metadata del grafo esportato (vuoti se assenti)."""
+    try:
+        with open(export_metadata_path(model_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export_onnx(
+    model: torch.nn.Module,
+    model_path: str,
+    model_name: str,
+    resolution: int = 1024,
+    opset: int = 17
+) -> str:
+    """
+    Esporta il modello di segmentazione in ONNX e lo salva su disco.
+
+    Il grafo restituisce direttamente la maschera normalizzata e ha batch e
+    risoluzione dinamici. Accanto al file viene scritto un JSON con il nome del
+    modello sorgente, così il servizio può riusare l'export senza ricaricarlo.
+
+    Args:
+        model: Modello PyTorch in modalità eval
+        model_path: Percorso del file .onnx da scrivere
+        model_name: Nome del modello sorgente (es. briaai/RMBG-2.0)
+        resolution: Risoluzione dell'input di esempio
+        opset: Versione dell'opset ONNX
+
+    Returns:
+        str: Percorso del file esportato
+    """
+    directory = os.path.dirname(os.path.abspath(model_path))
+    os.makedirs(directory, exist_ok=True)
+
+    wrapper = SegmentationWrapper(model).eval()
+    dummy_input = torch.randn(1, 3, resolution, resolution)
+    tmp_path = f"{model_path}.tmp"
+
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            (dummy_input,),
+            tmp_path,
+            input_names=['pixel_values'],
+            output_names=['mask'],
+            dynamic_axes={
+                'pixel_values': {0: 'batch', 2: 'height', 3: 'width'},
+                'mask': {0: 'batch', 2: 'height', 3: 'width'}
+            },
+            opset_version=opset,
+            # Exporter TorchScript: più robusto con il codice remoto dei modelli HF
+            dynamo=False
+        )
+    os.replace(tmp_path, model_path)
+
+    with open(export_metadata_path(model_path), 'w') as f:
+        json.dump({'model_name': model_name, 'opset': opset, 'resolution': resolution}, f)
+
+    logger.info(f"Modello {model_name} esportato in ONNX: {model_path}")
+    return model_path
@@ -1,35 +1,191 @@
 import os
 import tempfile
 import uuid
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, Union
 from urllib.parse import urlparse
 import requests
 from PIL import Image, PngImagePlugin
 import io
 import logging
+import math
 import warnings
+import numpy as np
 import torch
-from transformers import AutoModelForImageSegmentation
-import torchvision.transforms as transforms
 from datetime import datetime
 import json
+from batching import MicroBatcher
+from result_cache import ResultCache
+from precision import prepare_model, load_parity_images, check_parity
+from engines import INFERENCE_BACKENDS, TorchEngine, OnnxEngine, StubEngine, export_onnx
+from model_artifact import artifact_exists, load_artifact
+from compilation import COMPILE_MODES, artifact_tag, compile_model, warmup
+from postprocessing import MASK_UPSAMPLE_MODES, StripComposite, upsample_mask, compose_rgba
+from encoders import PNG_SIGNATURE, OutputFormat, negotiate_format, encode
+from metrics import IMAGES_PROCESSED, stage
 
 # Sopprimi i warning di deprecazione da timm
 warnings.filterwarnings("ignore", category=FutureWarning, module="timm")
 
 logger = logging.getLogger(__name__)
 
+# Normalizzazione dell'input del modello (statistiche ImageNet)
+NORMALIZE_MEAN = [0.485, 0.456, 0.406]
+NORMALIZE_STD = [0.229, 0.224, 0.225]
+# Stessa normalizzazione sui pixel 0-255: x * scale + bias
+NORMALIZE_SCALE = (1.0 / (255.0 * torch.tensor(NORMALIZE_STD))).view(1, 3, 1, 1)
+NORMALIZE_BIAS = (-torch.tensor(NORMALIZE_MEAN) / torch.tensor(NORMALIZE_STD)).view(1, 3, 1, 1)
+
+# Risoluzioni di inferenza selezionabili per richiesta
+DEFAULT_RESOLUTIONS = (512, 768, 1024)
+
 class ImageProcessor:
     """Classe per gestire il download, processamento e rimozione delle immagini."""
     
-    def __init__(self, temp_dir: Optional[str] = None):
+    def __init__(
+        self,
+        temp_dir: Optional[str] = None,
+        batch_max_size: int = 1,
+        batch_max_wait_ms: float = 10.0,
+        result_cache: Optional[ResultCache] = None,
+        spill_threshold_bytes: Optional[int] = None,
+        max_download_bytes: Optional[int] = None,
+        max_image_pixels: Optional[int] = None,
+        strip_composite_pixels: Optional[int] = None,
+        precision: str = 'fp32',
+        parity_images_dir: Optional[str] = None,
+        parity_max_mae: float = 0.02,
+        parity_min_iou: float = 0.95,
+        inference_backend: str = 'torch',
+        onnx_model_path: Optional[str] = None,
+        onnx_options: Optional[Dict[str, Any]] = None,
+        stub_options: Optional[Dict[str, Any]] = None,
+        compile_mode: str = 'none',
+        compile_cache_dir: Optional[str] = None,
+        warmup_enabled: bool = True,
+        inference_resolution: Union[int, str] = 1024,
+        resolutions: Optional[List[int]] = None,
+        letterbox: bool = False,
+        mask_upsample: str = 'bilinear',
+        output_format: str = 'png',
+        png_compress_level: int = 6,
+        webp_quality: int = 90,
+        webp_method: int = 4,
+        prefork: bool = False,
+        model_local_only: bool = False,
+        model_artifact_dir: Optional[str] = None,
+        load_model: bool = True
+    ):
         self.temp_dir = temp_dir or tempfile.gettempdir()
         # Crea la directory temporanea se non esiste
         os.makedirs(self.temp_dir, exist_ok=True)
         
+        # Oltre questa dimensione i download vengono scritti su disco (None = mai)
+        self.spill_threshold_bytes = spill_threshold_bytes
+        # Dimensione massima di un download, prima di qualunque decodifica (None = nessun limite)
+        self.max_download_bytes = max_download_bytes
+        
+        # Pixel massimi dell'immagine decodificata (None = solo il controllo di PIL)
+        self.max_image_pixels = max_image_pixels
+        # Oltre questa dimensione la composizione avviene a strisce (None = mai)
+        self.strip_composite_pixels = strip_composite_pixels
+        
         # Forza CPU-only per compatibilità
         self.device = "cpu"
         
+        # Micro-batching delle richieste concorrenti (disattivo con batch 1)
+        self.batcher = None
+        
+        # Cache dei risultati (opzionale)
+        self.result_cache = result_cache
+        self.model_name = None
+        
+        # Precisione di inferenza effettivamente in uso
+        self.precision = 'fp32'
+        
+        # Backend di inferenza (TorchEngine, OnnxEngine); None con il fallback rembg
+        self.engine = None
+        self.model = None
+        
+        if inference_backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Backend di inferenza non supportato: {inference_backend}")
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Modalità di compilazione non supportata: {compile_mode}")
+        
+        # Risoluzioni di inferenza ammesse (lato dell'input quadrato del modello)
+        self.resolutions = sorted(set(resolutions or DEFAULT_RESOLUTIONS))
+        if str(inference_resolution).isdigit() and int(inference_resolution) not in self.resolutions:
+            self.resolutions = sorted(self.resolutions + [int(inference_resolution)])
+        self.default_resolution = self.resolution_spec(str(inference_resolution) or 'auto')
+        # Ridimensionamento con padding che preserva le proporzioni
+        self.letterbox = letterbox
+        
+        # Upsampling della maschera alla risoluzione originale
+        if mask_upsample not in MASK_UPSAMPLE_MODES:
+            raise ValueError(f"Modalità di upsampling della maschera non supportata: {mask_upsample}")
+        self.mask_upsample = mask_upsample
+        
+        # Formato di output di default (sovrascrivibile per richiesta)
+        self.default_output = OutputFormat(output_format, png_compress_level, webp_quality, webp_method)
+        # Modalità di esecuzione effettiva del modello PyTorch
+        self.compile_mode = 'none'
+        
+        # Con più processi il modello viene caricato nel supervisore e condiviso
+        # con i worker tramite fork: warmup e batcher partono in after_fork
+        self.prefork = prefork
+        self.batch_max_size = batch_max_size
+        self.batch_max_wait_ms = batch_max_wait_ms
+        self.warmup_enabled = warmup_enabled
+        
+        # Modelli caricati solo dalla cache locale, senza accessi alla rete
+        self.model_local_only = model_local_only
+        # Artefatto prodotto da preload_models.py (pesi mappati in memoria)
+        self.model_artifact_dir = model_artifact_dir
+        # Sessione rembg del fallback (None con il modello Transformers)
+        self.session = None
+        
+        # Stato del caricamento: loading, ready o failed
+        self.status = 'loading'
+        self.load_error = None
+        self._load_options = {
+            'inference_backend': inference_backend,
+            'onnx_model_path': onnx_model_path,
+            'onnx_options': onnx_options or {},
+            'stub_options': stub_options or {},
+            'precision': precision,
+            'parity_images_dir': parity_images_dir,
+            'parity_max_mae': parity_max_mae,
+            'parity_min_iou': parity_min_iou,
+            'compile_mode': compile_mode,
+            'compile_cache_dir': compile_cache_dir,
+        }
+        
+        if load_model:
+            self.load()
+    
+    @property
+    def ready(self) -> bool:
+        """True quando il modello è caricato e pronto a servire richieste."""
+        return self.status == 'ready'
+    
+    def load(self) -> None:
+        """
+        Carica il modello di segmentazione (o il fallback rembg).
+        
+        Può essere eseguito in un thread in background: fino al termine lo
+        stato resta `loading`. Con prefork lo stato diventa `ready` solo in
+        after_fork, dopo il warmup nel worker.
+        
+        Raises:
+            Exception: Se nessun modello può essere inizializzato
+        """
+        inference_backend = self._load_options['inference_backend']
+        onnx_model_path = self._load_options['onnx_model_path']
+        onnx_options = self._load_options['onnx_options']
+        precision = self._load_options['precision']
+        compile_mode = self._load_options['compile_mode']
+        compile_cache_dir = self._load_options['compile_cache_dir']
+        batch_max_size = self.batch_max_size
+        
         try:
             logger.info("Caricamento modello background removal (CPU-only)...")
             
@@ -41,34 +197,59 @@ class ImageProcessor:
                 'Xenova/modnet'
             ]
             
+            # Un grafo ONNX già esportato evita di caricare il modello PyTorch
             model_loaded = False
-            for model_name in models_to_try:
-                try:
-                    logger.info(f"Tentativo caricamento: {model_name}")
-                    self.model = AutoModelForImageSegmentation.from_pretrained(
-                        model_name,
-                        trust_remote_code=True,
-                        dtype=torch.float32
-                    ).to(self.device)
-                    self.model.eval()
-                    logger.info(f"✅ Caricato con successo: {model_name}")
-                    model_loaded = True
-                    break
-                except Exception as model_error:
-                    logger.warning(f"❌ Fallito {model_name}: {model_error}")
-                    continue
+            if inference_backend == 'stub':
+                # Nessun modello: maschera fissa e costo simulato (test di carico)
+                self.engine = StubEngine(**self._load_options['stub_options'])
+                self.model_name = 'stub'
+                model_loaded = True
+            elif inference_backend == 'onnx' and onnx_model_path and os.path.exists(onnx_model_path):
+                model_loaded = self._load_onnx_engine(onnx_model_path, onnx_options)
+            
+            if not model_loaded and artifact_exists(self.model_artifact_dir):
+                model_loaded = self._load_model_artifact(self.model_artifact_dir)
+            
+            if not model_loaded:
+                model_loaded = self._load_transformers_model(models_to_try)
             
             if not model_loaded:
                 raise Exception("Nessun modello disponibile")
             
-            # Transform per preprocessing
-            self.transform = transforms.Compose([
-                transforms.Resize((1024, 1024)),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            ])
+            # Export ONNX al primo avvio se il grafo non è stato prodotto al build
+            if inference_backend == 'onnx' and isinstance(self.engine, TorchEngine):
+                self._export_and_load_onnx(onnx_model_path, onnx_options)
             
-            logger.info("RMBG-2.0 caricato con successo per foto prodotti (CPU)")
+            if precision != 'fp32':
+                if isinstance(self.engine, TorchEngine):
+                    self.apply_precision(
+                        precision,
+                        self._load_options['parity_images_dir'],
+                        self._load_options['parity_max_mae'],
+                        self._load_options['parity_min_iou']
+                    )
+                else:
+                    logger.warning(f"Precisione {precision} disponibile solo con il backend torch, resto in fp32")
+            
+            if compile_mode != 'none':
+                if isinstance(self.engine, TorchEngine):
+                    self.apply_compile(
+                        compile_mode,
+                        compile_cache_dir or os.path.join('.cache', 'torch'),
+                        self.warmup_shapes(batch_max_size)
+                    )
+                else:
+                    logger.warning(f"Compilazione {compile_mode} disponibile solo con il backend torch")
+            
+            # Paga all'avvio il costo della prima inferenza per ogni forma di input
+            # (la compilazione esegue già un'inferenza per ciascuna)
+            if not self.prefork:
+                if self.warmup_enabled and self.compile_mode == 'none':
+                    self.run_warmup()
+                self.start_batcher()
+                self.status = 'ready'
+            
+            logger.info(f"RMBG-2.0 caricato con successo per foto prodotti (CPU, backend {self.engine.name})")
             
         except Exception as e:
             logger.error(f"Errore nel caricamento modelli Transformers: {e}")
@@ -76,6 +257,7 @@ class ImageProcessor:
             try:
                 from rembg import new_session
                 self.model = None
+                self.engine = None
                 
                 # Prova i migliori modelli rembg per prodotti
                 models_to_try = ['birefnet-general', 'isnet-general-use', 'silueta']
@@ -84,6 +266,7 @@ class ImageProcessor:
                     try:
                         logger.info(f"Tentativo rembg: {model_name}")
                         self.session = new_session(model_name)
+                        self.model_name = f"rembg/{model_name}"
                         logger.info(f"✅ rembg caricato: {model_name}")
                         break
                     except Exception as model_error:
@@ -93,9 +276,15 @@ class ImageProcessor:
                     # Se nessun modello specifico funziona, usa il default
                     logger.info("Uso modello rembg default")
                     self.session = new_session()
+                    self.model_name = "rembg/default"
+                
+                if not self.prefork:
+                    self.status = 'ready'
                     
             except Exception as fallback_error:
                 logger.error(f"Errore anche nel fallback rembg: {fallback_error}")
+                self.status = 'failed'
+                self.load_error = str(fallback_error)
                 raise Exception("Impossibile inizializzare nessun modello di background removal")
     
     def is_valid_image_url(self, url: str) -> bool:
@@ -113,26 +302,44 @@ class ImageProcessor:
         except Exception:
             return False
     
-    def download_image(self, url: str) -> str:
+    def check_download_size(self, size: int) -> None:
         """
-        Scarica un'immagine dall'URL e la salva temporaneamente.
+        Rifiuta un download oltre max_download_bytes.
+        
+        Viene chiamata con il Content-Length dichiarato e poi con i byte
+        ricevuti, così un file enorme (o senza Content-Length) viene interrotto
+        prima di occupare memoria o disco.
+        
+        Raises:
+            ValueError: Se la dimensione supera il limite
+        """
+        if self.max_download_bytes is not None and size > self.max_download_bytes:
+            raise ValueError(
+                f"Immagine troppo grande da scaricare (massimo {self.max_download_bytes / (1024 * 1024):g} MB)"
+            )
+    
+    def download_image(self, url: str) -> Union[bytes, str]:
+        """
+        Scarica un'immagine dall'URL in memoria.
+        
+        Se è configurata una soglia di spill e l'immagine la supera, il download
+        viene scritto in un file temporaneo invece di restare in memoria.
         
         Args:
             url: URL dell'immagine da scaricare
             
         Returns:
-            str: Percorso del file temporaneo
+            bytes | str: Byte dell'immagine oppure percorso del file temporaneo
             
         Raises:
-            ValueError: Se l'URL non è valido
+            ValueError: Se l'URL non è valido o l'immagine supera la dimensione massima
             requests.RequestException: Se il download fallisce
             IOError: Se non è possibile salvare il file
         """
         if not self.is_valid_image_url(url):
             raise ValueError("URL dell'immagine non valido")
         
-        # Genera un nome file univoco
-        file_id = str(uuid.uuid4())
+        temp_path = None
         
         try:
             # Scarica l'immagine
@@ -144,128 +351,685 @@ class ImageProcessor:
             if not content_type.startswith('image/'):
                 raise ValueError("L'URL non punta a un'immagine valida")
             
-            # Determina l'estensione del file dal content-type
-            extension_map = {
-                'image/jpeg': '.jpg',
-                'image/png': '.png',
-                'image/gif': '.gif',
-                'image/bmp': '.bmp',
-                'image/tiff': '.tiff',
-                'image/webp': '.webp'
-            }
-            
-            extension = extension_map.get(content_type, '.jpg')
-            temp_path = os.path.join(self.temp_dir, f"{file_id}_original{extension}")
+            content_length = response.headers.get('content-length', '')
+            if content_length.isdigit():
+                self.check_download_size(int(content_length))
             
-            # Salva il file
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            buffer = io.BytesIO()
+            spill_file = None
+            received = 0
             
-            # Verifica che il file sia effettivamente un'immagine valida
             try:
-                with Image.open(temp_path) as img:
-                    img.verify()
-            except Exception:
-                os.remove(temp_path)
-                raise ValueError("File scaricato non è un'immagine valida")
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    self.check_download_size(received)
+                    if spill_file is not None:
+                        spill_file.write(chunk)
+                        continue
+                    
+                    buffer.write(chunk)
+                    
+                    # Spill su disco solo per input molto grandi (opt-in)
+                    if (self.spill_threshold_bytes is not None
+                            and buffer.tell() > self.spill_threshold_bytes):
+                        temp_path = self.new_temp_path(content_type)
+                        spill_file = open(temp_path, 'wb')
+                        spill_file.write(buffer.getbuffer())
+                        buffer = io.BytesIO()
+            finally:
+                if spill_file is not None:
+                    spill_file.close()
             
-            return temp_path
+            if temp_path is not None:
+                logger.info(f"Immagine di grandi dimensioni scritta su disco: {temp_path}")
+                return temp_path
             
+            return buffer.getvalue()
+            
+        except ValueError:
+            if temp_path:
+                self.cleanup_file(temp_path)
+            raise
         except requests.RequestException as e:
+            if temp_path:
+                self.cleanup_file(temp_path)
             raise requests.RequestException(f"Errore nel download dell'immagine: {str(e)}")
         except Exception as e:
+            if temp_path:
+                self.cleanup_file(temp_path)
             raise IOError(f"Errore nel salvataggio dell'immagine: {str(e)}")
     
-    def remove_background_rmbg2(self, input_path: str) -> tuple[str, Dict[str, Any]]:
+    def new_temp_path(self, content_type: str) -> str:
+        """Genera un percorso univoco nella directory temporanea per uno spill."""
+        # Determina l'estensione del file dal content-type
+        extension_map = {
+            'image/jpeg': '.jpg',
+            'image/png': '.png',
+            'image/gif': '.gif',
+            'image/bmp': '.bmp',
+            'image/tiff': '.tiff',
+            'image/webp': '.webp'
+        }
+        
+        extension = extension_map.get(content_type, '.jpg')
+        return os.path.join(self.temp_dir, f"{uuid.uuid4()}_original{extension}")
+    
+    def decode_image(self, source: Union[bytes, str]) -> tuple[Image.Image, Dict[str, Any]]:
+        """
+        Decodifica l'immagine sorgente una sola volta, direttamente dal buffer.
+        
+        Args:
+            source: Byte dell'immagine oppure percorso di uno spill su disco
+            
+        Returns:
+            tuple: (Immagine RGB, informazioni sull'originale)
+            
+        Raises:
+            ValueError: Se i dati non sono un'immagine valida o sono troppo grandi
+        """
+        image, source_info = self.open_image(source)
+        return self.load_image(image), source_info
+    
+    def open_image(self, source: Union[bytes, str]) -> tuple[Image.Image, Dict[str, Any]]:
+        """
+        Apre l'immagine sorgente leggendo solo l'header, senza decodificare i pixel.
+        
+        Le dimensioni dichiarate nell'header vengono controllate prima di
+        decodificare i pixel: un JPEG oltre il limite viene decodificato
+        ridotto (draft mode, 1/2, 1/4 o 1/8) fino a rientrarci, gli altri
+        formati vengono rifiutati. Le immagini oltre il controllo di PIL sulle
+        decompression bomb vengono sempre rifiutate.
+        
+        Args:
+            source: Byte dell'immagine oppure percorso di uno spill su disco
+            
+        Returns:
+            tuple: (Immagine da decodificare con load_image, informazioni sull'originale)
+            
+        Raises:
+            ValueError: Se i dati non sono un'immagine valida o sono troppo grandi
+        """
+        try:
+            with warnings.catch_warnings():
+                if self.max_image_pixels:
+                    # Il limite configurato, applicato qui sotto, è più stretto dell'avviso di PIL
+                    warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+                if isinstance(source, str):
+                    original_bytes = os.path.getsize(source)
+                    image = Image.open(source)
+                else:
+                    original_bytes = len(source)
+                    image = Image.open(io.BytesIO(source))
+        except Image.DecompressionBombError as e:
+            raise ValueError(f"Immagine troppo grande: {e}")
+        except Exception:
+            raise ValueError("File scaricato non è un'immagine valida")
+        
+        original_format = image.format or 'unknown'
+        original_width, original_height = image.size
+        self.check_pixel_budget(image)
+        
+        source_info = {
+            'original_format': original_format,
+            'original_width': original_width,
+            'original_height': original_height,
+            'original_size': original_bytes
+        }
+        return image, source_info
+    
+    def load_image(self, image: Image.Image) -> Image.Image:
+        """
+        Decodifica i pixel di un'immagine aperta con open_image, in RGB.
+        
+        Args:
+            image: Immagine aperta (anche già decodificata)
+            
+        Returns:
+            Image.Image: Immagine RGB decodificata
+            
+        Raises:
+            ValueError: Se i dati non sono un'immagine valida
+        """
+        try:
+            image.load()
+            return image if image.mode == 'RGB' else image.convert('RGB')
+        except Exception:
+            raise ValueError("File scaricato non è un'immagine valida")
+    
+    def check_pixel_budget(self, image: Image.Image) -> None:
+        """
+        Applica il limite di pixel a un'immagine aperta ma non ancora decodificata.
+        
+        Args:
+            image: Immagine appena aperta (solo header letto)
+            
+        Raises:
+            ValueError: Se l'immagine supera il limite e non può essere ridotta
+        """
+        width, height = image.size
+        if not self.max_image_pixels or width * height <= self.max_image_pixels:
+            return
+        
+        if image.format == 'JPEG':
+            # Scala DCT più piccola che rientra nel limite
+            for scale in (2, 4, 8):
+                size = (math.ceil(width / scale), math.ceil(height / scale))
+                if size[0] * size[1] <= self.max_image_pixels:
+                    image.draft('RGB', size)
+                    logger.info(f"JPEG {width}x{height} decodificato a {image.width}x{image.height}")
+                    return
+        
+        raise ValueError(
+            f"Immagine troppo grande: {width}x{height} "
+            f"({width * height / 1e6:.1f} MP, massimo {self.max_image_pixels / 1e6:.1f} MP)"
+        )
+    
+    def apply_precision(
+        self,
+        mode: str,
+        parity_images_dir: Optional[str] = None,
+        max_mae: float = 0.02,
+        min_iou: float = 0.95
+    ) -> bool:
+        """
+        Attiva una modalità di precisione ridotta, se supera il controllo di parità.
+        
+        Le maschere prodotte nella nuova modalità vengono confrontate con quelle
+        fp32 su un set fisso di immagini locali; se l'errore supera la tolleranza
+        la modalità viene rifiutata e si resta in fp32.
+        
+        Args:
+            mode: Modalità richiesta (vedi precision.PRECISION_MODES)
+            parity_images_dir: Directory con le immagini di riferimento
+            max_mae: Errore assoluto medio massimo sull'alpha
+            min_iou: IoU minima delle maschere binarizzate
+            
+        Returns:
+            bool: True se la modalità è stata attivata
+        """
+        try:
+            candidate_model, autocast_dtype = prepare_model(self.model, mode)
+            candidate_engine = TorchEngine(candidate_model, autocast_dtype)
+            
+            inputs = [
+                self.preprocess(image, max(self.resolutions))[0]
+                for image in load_parity_images(parity_images_dir)
+            ]
+            metrics = check_parity(
+                TorchEngine(self.model).predict,
+                candidate_engine.predict,
+                inputs
+            )
+        except Exception as e:
+            logger.warning(f"Precisione {mode} non disponibile, resto in fp32: {e}")
+            return False
+        
+        if metrics['mae'] > max_mae or metrics['iou'] < min_iou:
+            logger.warning(
+                f"Precisione {mode} rifiutata (MAE {metrics['mae']:.4f}, IoU {metrics['iou']:.4f}; "
+                f"tolleranza MAE <= {max_mae}, IoU >= {min_iou}), resto in fp32"
+            )
+            return False
+        
+        self.model = candidate_model
+        self.engine = candidate_engine
+        self.precision = mode
+        logger.info(f"✅ Precisione {mode} attiva (MAE {metrics['mae']:.4f}, IoU {metrics['iou']:.4f})")
+        return True
+    
+    def run_warmup(self) -> None:
+        """Esegue il warmup per ogni forma di input (un errore non blocca l'avvio)."""
+        try:
+            elapsed = warmup(self.engine.predict, self.warmup_shapes(self.batch_max_size))
+            logger.info(f"Warmup completato in {elapsed:.2f}s")
+        except Exception as warmup_error:
+            logger.warning(f"Warmup non riuscito: {warmup_error}")
+    
+    def start_batcher(self) -> None:
+        """Avvia il thread di micro-batching se il batch massimo è maggiore di 1."""
+        if self.batch_max_size > 1:
+            self.batcher = MicroBatcher(
+                self._predict,
+                max_batch_size=self.batch_max_size,
+                max_wait_ms=self.batch_max_wait_ms
+            )
+    
+    def after_fork(self) -> None:
+        """
+        Prepara il processo worker dopo il fork dal supervisore.
+        
+        I pesi del modello restano condivisi in copy-on-write; vengono invece
+        ricreati i thread, che non sopravvivono al fork: le sessioni ONNX
+        Runtime (anche quella di rembg) e il thread di batching. Il warmup viene eseguito qui, con il
+        numero di thread del worker.
+        """
+        if self.engine is not None:
+            self.engine.after_fork()
+            if self.warmup_enabled:
+                self.run_warmup()
+            self.start_batcher()
+        elif self.session is not None:
+            from rembg import new_session
+            
+            rembg_model = self.model_name.removeprefix('rembg/')
+            self.session = new_session() if rembg_model == 'default' else new_session(rembg_model)
+        self.status = 'ready'
+    
+    def warmup_shapes(self, batch_max_size: int = 1) -> List[Tuple[int, int, int, int]]:
+        """Forme di input che il modello riceverà in produzione (risoluzioni per dimensioni di batch)."""
+        return [
+            (batch_size, 3, resolution, resolution)
+            for resolution in self.resolutions
+            for batch_size in range(1, max(batch_max_size, 1) + 1)
+        ]
+    
+    def apply_compile(self, mode: str, cache_dir: str, shapes: List[Tuple[int, int, int, int]]) -> bool:
+        """
+        Passa all'esecuzione compilata del modello PyTorch (torch.compile o TorchScript).
+        
+        Gli artefatti compilati vengono salvati in `cache_dir` e riusati ai
+        riavvii. Il modulo compilato viene eseguito su tutte le forme di input
+        previste (che fa anche da warmup): se fallisce si resta sul modello eager.
+        
+        Args:
+            mode: Modalità richiesta (vedi compilation.COMPILE_MODES)
+            cache_dir: Directory degli artefatti compilati
+            shapes: Forme degli input (N, 3, H, W) da compilare e verificare
+            
+        Returns:
+            bool: True se la modalità è stata attivata
+        """
+        import time
+        try:
+            start_time = time.time()
+            compiled = compile_model(
+                self.model,
+                mode,
+                cache_dir,
+                artifact_tag(self.model_name, self.precision),
+                shapes
+            )
+            candidate_engine = TorchEngine(compiled, self.engine.autocast_dtype, normalized=True)
+            warmup(candidate_engine.predict, shapes)
+        except Exception as e:
+            logger.warning(f"Compilazione {mode} non disponibile, resto sul modello eager: {e}")
+            return False
+        
+        self.engine = candidate_engine
+        self.compile_mode = mode
+        logger.info(f"✅ Modello compilato ({mode}) in {time.time() - start_time:.2f}s")
+        return True
+    
+    def _load_model_artifact(self, directory: str) -> bool:
+        """
+        Carica il modello dall'artefatto pre-serializzato, senza from_pretrained.
+        
+        Args:
+            directory: Directory dell'artefatto
+        
+        Returns:
+            bool: True se il modello è stato caricato
+        """
+        import time
+        
+        try:
+            start_time = time.time()
+            self.model, manifest = load_artifact(directory)
+            self.model_name = manifest['model_name']
+            self.engine = TorchEngine(self.model)
+            logger.info(
+                f"✅ Caricato dall'artefatto: {self.model_name} "
+                f"({time.time() - start_time:.2f}s, pesi mappati da {directory})"
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"Artefatto del modello non utilizzabile, uso from_pretrained: {e}")
+            self.model = None
+            self.engine = None
+            return False
+    
+    def _load_transformers_model(self, model_names: List[str]) -> bool:
+        """
+        Carica il primo modello Transformers disponibile.
+        
+        Il primo passaggio cerca i modelli solo nella cache locale, senza
+        richieste di rete; se nessuno è presente (e MODEL_LOCAL_ONLY non è
+        attivo) segue un secondo passaggio che li scarica.
+        
+        Args:
+            model_names: Modelli in ordine di preferenza
+        
+        Returns:
+            bool: True se un modello è stato caricato
+        """
+        # Import pesante rimandato al caricamento, fuori dall'avvio dell'app
+        from transformers import AutoModelForImageSegmentation
+        
+        passes = [True] if self.model_local_only else [True, False]
+        for local_files_only in passes:
+            for model_name in model_names:
+                try:
+                    logger.info(
+                        f"Tentativo caricamento: {model_name}"
+                        f"{' (cache locale)' if local_files_only else ''}"
+                    )
+                    self.model = AutoModelForImageSegmentation.from_pretrained(
+                        model_name,
+                        trust_remote_code=True,
+                        dtype=torch.float32,
+                        local_files_only=local_files_only
+                    ).to(self.device)
+                    self.model.eval()
+                    self.model_name = model_name
+                    self.engine = TorchEngine(self.model)
+                    logger.info(f"✅ Caricato con successo: {model_name}")
+                    return True
+                except Exception as model_error:
+                    if local_files_only:
+                        logger.info(f"{model_name} non presente nella cache locale")
+                    else:
+                        logger.warning(f"❌ Fallito {model_name}: {model_error}")
+        return False
+    
+    def _load_onnx_engine(self, onnx_model_path: str, onnx_options: Dict[str, Any]) -> bool:
+        """
+        Carica il backend ONNX Runtime da un grafo già esportato.
+        
+        Args:
+            onnx_model_path: Percorso del file .onnx
+            onnx_options: Opzioni della sessione (livello di ottimizzazione, thread)
+            
+        Returns:
+            bool: True se il backend è stato caricato
+        """
+        try:
+            self.engine = OnnxEngine(onnx_model_path, **onnx_options)
+            self.model_name = self.engine.metadata.get('model_name', 'onnx')
+            logger.info(f"✅ Backend ONNX caricato: {onnx_model_path} ({self.model_name})")
+            return True
+        except Exception as e:
+            logger.warning(f"❌ Impossibile caricare il grafo ONNX {onnx_model_path}: {e}")
+            self.engine = None
+            return False
+    
+    def _export_and_load_onnx(self, onnx_model_path: Optional[str], onnx_options: Dict[str, Any]) -> None:
+        """Esporta il modello PyTorch in ONNX e passa al backend ONNX Runtime."""
+        if not onnx_model_path:
+            logger.warning("ONNX_MODEL_PATH non configurato, uso il backend torch")
+            return
+        
+        torch_engine = self.engine
+        try:
+            export_onnx(self.model, onnx_model_path, self.model_name)
+        except Exception as e:
+            logger.warning(f"Export ONNX fallito, uso il backend torch: {e}")
+            return
+        
+        if self._load_onnx_engine(onnx_model_path, onnx_options):
+            # Il modello PyTorch non serve più: libera la memoria
+            self.model = None
+        else:
+            self.engine = torch_engine
+    
+    def resolution_spec(self, requested: Optional[str] = None) -> str:
+        """
+        Valida la risoluzione richiesta e la riduce a una forma canonica.
+        
+        Args:
+            requested: Lato in pixel (es. "768"), "auto" oppure None per il default
+            
+        Returns:
+            str: "auto" oppure il lato in pixel
+            
+        Raises:
+            ValueError: Se la risoluzione non è tra quelle ammesse
+        """
+        if requested is None or str(requested).strip() == '':
+            return self.default_resolution
+        requested = str(requested).strip().lower()
+        if requested == 'auto':
+            return requested
+        if requested.isdigit() and int(requested) in self.resolutions:
+            return str(int(requested))
+        allowed = ', '.join(str(r) for r in self.resolutions)
+        raise ValueError(f"Risoluzione non supportata: {requested} (valori ammessi: auto, {allowed})")
+    
+    def select_resolution(self, spec: str, image_size: Tuple[int, int]) -> int:
+        """
+        Sceglie il lato dell'input del modello per un'immagine.
+        
+        Con "auto" usa la risoluzione più piccola che non riduce il lato lungo
+        dell'immagine (la più grande se l'immagine le supera tutte).
+        
+        Args:
+            spec: Risoluzione canonica (vedi resolution_spec)
+            image_size: Dimensioni (larghezza, altezza) dell'immagine sorgente
+            
+        Returns:
+            int: Lato dell'input in pixel
+        """
+        if spec != 'auto':
+            return int(spec)
+        long_side = max(image_size)
+        for resolution in self.resolutions:
+            if resolution >= long_side:
+                return resolution
+        return self.resolutions[-1]
+    
+    def content_box(self, image_size: Tuple[int, int], resolution: int) -> Tuple[int, int, int, int]:
+        """
+        Area dell'input del modello occupata dall'immagine.
+        
+        Senza letterbox l'immagine viene stirata sull'intero quadrato; con
+        letterbox viene ridimensionata preservando le proporzioni e centrata.
+        
+        Returns:
+            tuple: (x, y, larghezza, altezza) in pixel dell'input del modello
+        """
+        if not self.letterbox:
+            return 0, 0, resolution, resolution
+        width, height = image_size
+        scale = resolution / max(width, height)
+        new_width = max(1, min(resolution, round(width * scale)))
+        new_height = max(1, min(resolution, round(height * scale)))
+        return (resolution - new_width) // 2, (resolution - new_height) // 2, new_width, new_height
+    
+    def preprocess(
+        self,
+        image: Image.Image,
+        resolution: int,
+        source_size: Optional[Tuple[int, int]] = None
+    ) -> tuple[torch.Tensor, Tuple[int, int, int, int]]:
+        """
+        Prepara il tensore di input del modello a una data risoluzione.
+        
+        I pixel vengono ridimensionati con un'unica interpolazione vettoriale
+        e normalizzati con una sola operazione scritta direttamente nel tensore
+        di input; con letterbox il bordo resta a zero (neutro dopo la
+        normalizzazione). Le immagini molto più grandi dell'input vengono prima
+        ridotte di un fattore intero con PIL; la conversione in float avviene
+        solo alla risoluzione finale.
+        
+        Args:
+            image: Immagine RGB (anche già ridotta in fase di decodifica)
+            resolution: Lato dell'input quadrato del modello
+            source_size: Dimensioni dell'originale, per le proporzioni (default: quelle di image)
+            
+        Returns:
+            tuple: (Tensore (1, 3, R, R), area utile come (x, y, larghezza, altezza))
+        """
+        left, top, new_width, new_height = self.content_box(source_size or image.size, resolution)
+        
+        factor = min(image.width // new_width, image.height // new_height)
+        if factor >= 2:
+            image = image.reduce(factor)
+        
+        # I pixel vengono solo letti: niente copia del buffer di PIL. Il layout
+        # HWC resta channels-last e uint8, il percorso vettoriale più rapido
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            pixels = torch.from_numpy(np.asarray(image))
+        pixels = pixels.permute(2, 0, 1).unsqueeze(0)
+        if pixels.shape[-2:] != (new_height, new_width):
+            pixels = torch.nn.functional.interpolate(
+                pixels,
+                size=(new_height, new_width),
+                mode='bilinear',
+                align_corners=False,
+                antialias=True
+            )
+        
+        if self.letterbox:
+            tensor = torch.zeros(1, 3, resolution, resolution)
+        else:
+            tensor = torch.empty(1, 3, resolution, resolution)
+        # Conversione in float e (x / 255 - mean) / std in un solo passaggio
+        torch.addcmul(
+            NORMALIZE_BIAS,
+            pixels,
+            NORMALIZE_SCALE,
+            out=tensor[:, :, top:top + new_height, left:left + new_width]
+        )
+        return tensor.to(self.device), (left, top, new_width, new_height)
+    
+    def decode_model_image(self, source: Union[bytes, str], resolution: int) -> Optional[Image.Image]:
+        """
+        Decodifica un JPEG direttamente a dimensione ridotta per l'input del modello.
+        
+        Usa il draft mode di PIL (scalatura nel dominio DCT di 1/2, 1/4 o 1/8),
+        così i JPEG molto grandi non vengono decodificati a piena risoluzione
+        solo per essere ridotti a pochi megapixel.
+        
+        Args:
+            source: Byte dell'immagine oppure percorso di uno spill su disco
+            resolution: Lato dell'input del modello
+            
+        Returns:
+            Optional[Image.Image]: Immagine RGB ridotta, oppure None se la
+            sorgente non è un JPEG o non può essere ridotta
+        """
+        try:
+            image = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+            if image.format != 'JPEG':
+                return None
+            
+            full_size = image.size
+            _, _, new_width, new_height = self.content_box(full_size, resolution)
+            # Il draft sceglie la scala più piccola che resta sopra la dimensione richiesta
+            image.draft('RGB', (new_width, new_height))
+            if image.size == full_size:
+                return None
+            
+            image.load()
+            return image if image.mode == 'RGB' else image.convert('RGB')
+        except Exception as e:
+            logger.debug(f"Decodifica ridotta non disponibile: {e}")
+            return None
+    
+    def _predict(self, input_tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Esegue il modello su un batch di tensori preprocessati.
+        
+        Args:
+            input_tensor: Tensore di input (N, 3, H, W)
+            
+        Returns:
+            torch.Tensor: Maschere con valori tra 0 e 1, una per elemento del batch
+        """
+        return self.engine.predict(input_tensor)
+    
+    def remove_background_rmbg2(
+        self,
+        image: Image.Image,
+        resolution: Optional[str] = None,
+        model_image: Optional[Image.Image] = None
+    ) -> tuple[Image.Image, Dict[str, Any]]:
         """
         Rimuove lo sfondo usando RMBG-2.0 di BriaAI (CPU-only).
         
+        Con model_image l'originale viene decodificato a piena risoluzione solo
+        dopo l'inferenza, quando serve per la composizione.
+        
         Args:
-            input_path: Percorso dell'immagine di input
+            image: Immagine RGB, ancora da decodificare se è presente model_image
+            resolution: Risoluzione di inferenza richiesta (vedi resolution_spec)
+            model_image: Stessa immagine già decodificata a dimensione ridotta (opzionale)
             
         Returns:
-            tuple: (Percorso dell'immagine processata, informazioni di processamento)
+            tuple: (Immagine RGBA processata, composta a strisce oltre
+            strip_composite_pixels, informazioni di processamento)
         """
         import time
         start_time = time.time()
         
         try:
-            # Carica e preprocessa l'immagine
-            image = Image.open(input_path).convert('RGB')
             original_size = image.size
-            original_format = image.format or 'unknown'
+            input_resolution = self.select_resolution(self.resolution_spec(resolution), original_size)
             
             # Applica le trasformazioni
-            input_tensor = self.transform(image).unsqueeze(0).to(self.device)
+            with stage('preprocess'):
+                input_tensor, (left, top, content_width, content_height) = self.preprocess(
+                    model_image if model_image is not None else image,
+                    input_resolution,
+                    original_size
+                )
             
-            # Inferenza (CPU-only)
-            with torch.no_grad():
-                outputs = self.model(input_tensor)
+            # Inferenza (CPU-only), raggruppata in batch se abilitato
+            # (con il batching include l'attesa del batch)
+            with stage('inference'):
+                if self.batcher is not None:
+                    preds = self.batcher.submit(input_tensor)
+                else:
+                    preds = self._predict(input_tensor)
+            
+            # Decodifica a piena risoluzione rimandata fino alla composizione
+            with stage('decode'):
+                image = self.load_image(image)
+            
+            # Post-processing
+            with stage('postprocess'):
+                pred = preds[0].squeeze()
                 
-                # Debug: vediamo cosa restituisce il modello
-                logger.info(f"Tipo output modello: {type(outputs)}")
-                if isinstance(outputs, (list, tuple)):
-                    logger.info(f"Lunghezza lista output: {len(outputs)}")
-                    logger.info(f"Tipo ultimo elemento: {type(outputs[-1])}")
+                if pred.dim() == 3:
+                    pred = pred[0]  # Prendi il primo canale se ci sono più canali
                 
-                # Gestisci diversi formati di output
-                if isinstance(outputs, (list, tuple)):
-                    # Se è una lista, prendi l'ultimo elemento
-                    preds = outputs[-1]
-                else:
-                    # Se è un tensor diretto
-                    preds = outputs
+                # Rimuovi il padding del letterbox prima di riportare la maschera alle dimensioni originali
+                pred = pred[top:top + content_height, left:left + content_width]
                 
-                # Applica sigmoid se necessario
-                if hasattr(preds, 'sigmoid'):
-                    preds = preds.sigmoid()
+                if self.strip_composite_pixels and image.width * image.height >= self.strip_composite_pixels:
+                    # Immagini molto grandi: maschera alla risoluzione del modello,
+                    # composta a strisce direttamente durante l'encoding
+                    output_image = StripComposite(image, pred, self.mask_upsample)
                 else:
-                    # Clamp tra 0 e 1 se sigmoid non è disponibile
-                    preds = torch.clamp(preds, 0, 1)
-                
-                preds = preds.cpu()
-            
-            # Post-processing
-            pred = preds[0].squeeze()
-            
-            # Converti in PIL Image
-            if pred.dim() == 3:
-                pred = pred[0]  # Prendi il primo canale se ci sono più canali
-            
-            pred_pil = transforms.ToPILImage()(pred)
-            mask = pred_pil.resize(original_size)
-            
-            # Applica la maschera all'immagine originale
-            image.putalpha(mask)
-            
-            # Genera il percorso di output
-            base_name = os.path.splitext(os.path.basename(input_path))[0]
-            output_path = os.path.join(self.temp_dir, f"{base_name}_nobg.png")
-            
-            # Salva l'immagine
-            image.save(output_path, 'PNG')
+                    # Maschera float portata direttamente alla risoluzione originale e
+                    # quantizzata una sola volta, poi un unico buffer RGBA
+                    alpha = upsample_mask(pred, image, self.mask_upsample)
+                    output_image = compose_rgba(image, alpha)
             
             processing_time = time.time() - start_time
             
             # Raccogli informazioni di processamento
             processing_info = {
                 'model_used': 'RMBG-2.0 (Transformers)',
+                'backend': self.engine.name,
                 'device': self.device,
-                'processing_time': processing_time,
-                'original_format': original_format,
-                'original_width': original_size[0],
-                'original_height': original_size[1],
-                'original_size': os.path.getsize(input_path) if os.path.exists(input_path) else 0
+                'precision': self.precision,
+                'resolution': input_resolution,
+                'letterbox': self.letterbox,
+                'mask_upsample': self.mask_upsample,
+                'processing_time': processing_time
             }
             
-            logger.info(f"Sfondo rimosso con RMBG-2.0: {output_path} (tempo: {processing_time:.2f}s)")
-            return output_path, processing_info
+            logger.info(f"Sfondo rimosso con RMBG-2.0 (tempo: {processing_time:.2f}s)")
+            return output_image, processing_info
             
+        except ValueError:
+            # Dati dell'immagine non validi, emersi alla decodifica completa
+            raise
         except Exception as e:
             raise IOError(f"Errore con RMBG-2.0: {str(e)}")
     
-    def remove_background_fallback(self, input_path: str) -> tuple[str, Dict[str, Any]]:
+    def remove_background_fallback(self, image: Image.Image) -> tuple[Image.Image, Dict[str, Any]]:
         """Fallback usando rembg se RMBG-2.0 non è disponibile."""
         import time
         start_time = time.time()
@@ -273,21 +1037,11 @@ class ImageProcessor:
         try:
             from rembg import remove
             
-            # Ottieni informazioni sull'immagine originale
-            with Image.open(input_path) as original_img:
-                original_size = original_img.size
-                original_format = original_img.format or 'unknown'
-            
-            with open(input_path, 'rb') as f:
-                input_data = f.read()
-            
-            output_data = remove(input_data, session=self.session)
-            
-            base_name = os.path.splitext(os.path.basename(input_path))[0]
-            output_path = os.path.join(self.temp_dir, f"{base_name}_nobg.png")
-            
-            with open(output_path, 'wb') as f:
-                f.write(output_data)
+            # rembg accetta e restituisce direttamente immagini PIL
+            with stage('inference'):
+                output_image = remove(image, session=self.session)
+            if output_image.mode != 'RGBA':
+                output_image = output_image.convert('RGBA')
             
             processing_time = time.time() - start_time
             
@@ -295,113 +1049,188 @@ class ImageProcessor:
             processing_info = {
                 'model_used': 'rembg (fallback)',
                 'device': 'cpu',
-                'processing_time': processing_time,
-                'original_format': original_format,
-                'original_width': original_size[0],
-                'original_height': original_size[1],
-                'original_size': os.path.getsize(input_path) if os.path.exists(input_path) else 0
+                'processing_time': processing_time
             }
             
-            logger.info(f"Sfondo rimosso con rembg fallback: {output_path} (tempo: {processing_time:.2f}s)")
-            return output_path, processing_info
+            logger.info(f"Sfondo rimosso con rembg fallback (tempo: {processing_time:.2f}s)")
+            return output_image, processing_info
             
         except Exception as e:
             raise IOError(f"Errore con fallback rembg: {str(e)}")
     
-    def remove_background(self, input_path: str) -> tuple[str, Dict[str, Any]]:
+    def remove_background(
+        self,
+        image: Image.Image,
+        resolution: Optional[str] = None,
+        model_image: Optional[Image.Image] = None
+    ) -> tuple[Image.Image, Dict[str, Any]]:
         """
         Rimuove lo sfondo dall'immagine usando RMBG-2.0 o fallback.
         
         Args:
-            input_path: Percorso dell'immagine di input
+            image: Immagine RGB, ancora da decodificare se è presente model_image
+            resolution: Risoluzione di inferenza richiesta (ignorata dal fallback rembg)
+            model_image: Immagine ridotta per l'input del modello (ignorata dal fallback rembg)
             
         Returns:
-            tuple: (Percorso dell'immagine processata, informazioni di processamento)
+            tuple: (Immagine RGBA processata, informazioni di processamento)
             
         Raises:
             IOError: Se non è possibile processare l'immagine
         """
-        if hasattr(self, 'model') and self.model is not None:
+        if self.engine is not None:
             # Usa RMBG-2.0
-            return self.remove_background_rmbg2(input_path)
+            return self.remove_background_rmbg2(image, resolution, model_image)
         else:
             # Fallback a rembg
-            return self.remove_background_fallback(input_path)
+            return self.remove_background_fallback(self.load_image(image))
     
-    def add_metadata_to_image(self, image_path: str, original_url: str, processing_info: Dict[str, Any]) -> None:
+    def build_processing_metadata(
+        self,
+        image: Image.Image,
+        original_url: str,
+        processing_info: Dict[str, Any],
+        output: OutputFormat
+    ) -> Dict[str, Any]:
         """
-        Aggiunge metadata dettagliati all'immagine PNG processata.
+        Costruisce i metadata strutturati del processamento.
         
         Args:
-            image_path: Percorso dell'immagine PNG
+            image: Immagine processata
             original_url: URL originale dell'immagine
             processing_info: Informazioni sul processamento
+            output: Formato di output
+            
+        Returns:
+            dict: Metadata su processamento, originale e output
+        """
+        return {
+            "processing": {
+                "timestamp": datetime.now().isoformat(),
+                "model": processing_info.get('model_used', 'unknown'),
+                "device": processing_info.get('device', 'cpu'),
+                "precision": processing_info.get('precision', 'fp32'),
+                "resolution": processing_info.get('resolution'),
+                "letterbox": processing_info.get('letterbox', False),
+                "mask_upsample": processing_info.get('mask_upsample'),
+                "processing_time_seconds": processing_info.get('processing_time', 0),
+                "success": True
+            },
+            "original": {
+                "url": original_url,
+                "format": processing_info.get('original_format', 'unknown'),
+                "width": processing_info.get('original_width', 0),
+                "height": processing_info.get('original_height', 0),
+                "file_size_bytes": processing_info.get('original_size', 0)
+            },
+            "output": {
+                "format": output.name.upper(),
+                "has_alpha": output.name != 'mask',
+                "width": image.width,
+                "height": image.height
+            }
+        }
+    
+    def build_metadata(
+        self,
+        image: Image.Image,
+        original_url: str,
+        processing_info: Dict[str, Any],
+        output: Optional[OutputFormat] = None
+    ) -> PngImagePlugin.PngInfo:
+        """
+        Costruisce i metadata dettagliati da scrivere nell'immagine PNG.
+        
+        Args:
+            image: Immagine processata
+            original_url: URL originale dell'immagine
+            processing_info: Informazioni sul processamento
+            output: Formato di output (default: PNG)
+            
+        Returns:
+            PngInfo: Chunk di testo da includere nell'encoding
+        """
+        output = output or OutputFormat('png')
+        
+        # Crea i metadata personalizzati
+        metadata = PngImagePlugin.PngInfo()
+        
+        # Informazioni base
+        metadata.add_text("Title", "Background Removed Image")
+        metadata.add_text("Description", "Image processed with AI background removal")
+        metadata.add_text("Software", "RemoveBG API v1.0.0")
+        metadata.add_text("Creation Time", datetime.now().isoformat())
+        
+        # Informazioni sulla sorgente
+        metadata.add_text("Source URL", original_url)
+        metadata.add_text("Original Format", processing_info.get('original_format', 'unknown'))
+        metadata.add_text("Original Size", f"{processing_info.get('original_width', 0)}x{processing_info.get('original_height', 0)}")
+        
+        # Informazioni sul processamento
+        metadata.add_text("Processing Model", processing_info.get('model_used', 'unknown'))
+        metadata.add_text("Processing Device", processing_info.get('device', 'cpu'))
+        metadata.add_text("Processing Time", f"{processing_info.get('processing_time', 0):.2f}s")
+        
+        # Informazioni tecniche
+        if output.name == 'mask':
+            metadata.add_text("Output Format", "PNG (mask)")
+            metadata.add_text("Alpha Channel", "No")
+            metadata.add_text("Color Space", "Grayscale")
+        else:
+            metadata.add_text("Output Format", "PNG")
+            metadata.add_text("Alpha Channel", "Yes")
+            metadata.add_text("Color Space", "RGB+Alpha")
+        
+        # Informazioni sul processore
+        metadata.add_text("Processor", "AI Background Removal Service")
+        metadata.add_text("API Version", "1.0.0")
+        
+        # Metadata strutturati in JSON
+        processing_metadata = self.build_processing_metadata(image, original_url, processing_info, output)
+        
+        metadata.add_text("Processing Info JSON", json.dumps(processing_metadata, indent=2))
+        return metadata
+    
+    def encode_image(
+        self,
+        image: Image.Image,
+        original_url: str,
+        processing_info: Dict[str, Any],
+        output: Optional[OutputFormat] = None
+    ) -> bytes:
         """
+        Codifica l'immagine processata con i metadata, in un solo passaggio.
+        
+        I formati PNG ricevono i metadata come chunk di testo, WebP come XMP.
+        Le immagini composte a strisce vengono sempre codificate in PNG.
+        
+        Args:
+            image: Immagine RGBA processata
+            original_url: URL originale dell'immagine
+            processing_info: Informazioni sul processamento
+            output: Formato di output (default: quello configurato)
+            
+        Returns:
+            bytes: Dati pronti per la risposta
+        """
+        output = output or self.default_output
+        if isinstance(image, StripComposite) and not output.streamable:
+            logger.info(f"Immagine composta a strisce ({image.width}x{image.height}): output PNG invece di {output.name}")
+            output = output.for_strips()
+        pnginfo = None
+        metadata = None
         try:
-            # Apri l'immagine esistente
-            with Image.open(image_path) as img:
-                # Crea i metadata personalizzati
-                metadata = PngImagePlugin.PngInfo()
-                
-                # Informazioni base
-                metadata.add_text("Title", "Background Removed Image")
-                metadata.add_text("Description", "Image processed with AI background removal")
-                metadata.add_text("Software", "RemoveBG API v1.0.0")
-                metadata.add_text("Creation Time", datetime.now().isoformat())
-                
-                # Informazioni sulla sorgente
-                metadata.add_text("Source URL", original_url)
-                metadata.add_text("Original Format", processing_info.get('original_format', 'unknown'))
-                metadata.add_text("Original Size", f"{processing_info.get('original_width', 0)}x{processing_info.get('original_height', 0)}")
-                
-                # Informazioni sul processamento
-                metadata.add_text("Processing Model", processing_info.get('model_used', 'unknown'))
-                metadata.add_text("Processing Device", processing_info.get('device', 'cpu'))
-                metadata.add_text("Processing Time", f"{processing_info.get('processing_time', 0):.2f}s")
-                
-                # Informazioni tecniche
-                metadata.add_text("Output Format", "PNG")
-                metadata.add_text("Alpha Channel", "Yes")
-                metadata.add_text("Color Space", "RGB+Alpha")
-                
-                # Informazioni sul processore
-                metadata.add_text("Processor", "AI Background Removal Service")
-                metadata.add_text("API Version", "1.0.0")
-                
-                # Metadata strutturati in JSON
-                processing_metadata = {
-                    "processing": {
-                        "timestamp": datetime.now().isoformat(),
-                        "model": processing_info.get('model_used', 'unknown'),
-                        "device": processing_info.get('device', 'cpu'),
-                        "processing_time_seconds": processing_info.get('processing_time', 0),
-                        "success": True
-                    },
-                    "original": {
-                        "url": original_url,
-                        "format": processing_info.get('original_format', 'unknown'),
-                        "width": processing_info.get('original_width', 0),
-                        "height": processing_info.get('original_height', 0),
-                        "file_size_bytes": processing_info.get('original_size', 0)
-                    },
-                    "output": {
-                        "format": "PNG",
-                        "has_alpha": True,
-                        "width": img.width,
-                        "height": img.height
-                    }
-                }
-                
-                metadata.add_text("Processing Info JSON", json.dumps(processing_metadata, indent=2))
-                
-                # Salva l'immagine con i metadata
-                img.save(image_path, "PNG", pnginfo=metadata, optimize=True)
-                
-                logger.info(f"Metadata aggiunti all'immagine: {image_path}")
-                
+            with stage('metadata'):
+                if output.media_type == 'image/png':
+                    pnginfo = self.build_metadata(image, original_url, processing_info, output)
+                else:
+                    metadata = self.build_processing_metadata(image, original_url, processing_info, output)
         except Exception as e:
             logger.warning(f"Errore nell'aggiunta dei metadata: {e}")
             # Non interrompe l'esecuzione se i metadata falliscono
+        
+        with stage('encode'):
+            return encode(image, output, pnginfo=pnginfo, metadata=metadata)
 
     def cleanup_file(self, file_path: str) -> None:
         """
@@ -417,12 +1246,77 @@ class ImageProcessor:
             # Log dell'errore ma non interrompe l'esecuzione
             pass
     
-    def process_image_from_url(self, url: str) -> bytes:
+    def output_format(
+        self,
+        name: Optional[str] = None,
+        compress_level: Optional[int] = None,
+        quality: Optional[int] = None,
+        accept: Optional[str] = None
+    ) -> OutputFormat:
+        """
+        Risolve il formato di output di una richiesta.
+        
+        Il parametro esplicito ha la precedenza sull'header Accept, che a sua
+        volta ha la precedenza sul formato configurato.
+        
+        Args:
+            name: Formato richiesto (png, webp, webp-lossless, mask)
+            compress_level: Livello zlib per i formati PNG (0-9)
+            quality: Qualità per WebP (0-100)
+            accept: Header Accept della richiesta
+            
+        Returns:
+            OutputFormat: Formato validato
+            
+        Raises:
+            ValueError: Se formato o parametri non sono validi
+        """
+        default = self.default_output
+        name = (name or '').strip().lower() or negotiate_format(accept) or default.name
+        return OutputFormat(
+            name,
+            default.compress_level if compress_level is None else compress_level,
+            default.quality if quality is None else quality,
+            default.method
+        )
+    
+    def cache_variant(self, resolution: Optional[str] = None, output: Optional[OutputFormat] = None) -> str:
+        """
+        Identifica modello e parametri che influenzano il risultato in cache.
+        
+        Args:
+            resolution: Risoluzione di inferenza richiesta (vedi resolution_spec)
+            output: Formato di output (default: quello configurato)
+            
+        Raises:
+            ValueError: Se la risoluzione non è tra quelle ammesse
+        """
+        encoding = (output or self.default_output).variant()
+        if self.engine is None:
+            return f"{self.model_name or 'unknown'}|rembg|{self.precision}|{encoding}"
+        # Con "auto" la risoluzione dipende solo dal contenuto, già incluso nella chiave
+        geometry = f"{self.resolution_spec(resolution)}{'|letterbox' if self.letterbox else ''}"
+        if self.max_image_pixels:
+            # Con il limite i JPEG grandi vengono ridotti: cambia il risultato
+            geometry += f"|max{self.max_image_pixels}"
+        return (
+            f"{self.model_name or 'unknown'}|{self.engine.name}|{self.precision}|"
+            f"{geometry}|{self.mask_upsample}|{encoding}"
+        )
+    
+    def process_image_from_url(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> bytes:
         """
         Processo completo: scarica, processa e pulisce.
         
         Args:
             url: URL dell'immagine da processare
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
             
         Returns:
             bytes: Dati dell'immagine processata con metadata
@@ -432,28 +1326,212 @@ class ImageProcessor:
             requests.RequestException: Se il download fallisce
             IOError: Se il processamento fallisce
         """
-        input_path = None
-        output_path = None
+        result_data, _ = self.process_image_from_url_with_info(url, resolution, output)
+        return result_data
+    
+    def process_image_from_url_with_info(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Come process_image_from_url, ma restituisce anche informazioni sulla cache.
+        
+        Args:
+            url: URL dell'immagine da processare
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
+            
+        Returns:
+            tuple: (Dati dell'immagine processata, informazioni con 'etag' e 'cache')
+            
+        Raises:
+            ValueError: Se l'URL non è valido
+            requests.RequestException: Se il download fallisce
+            IOError: Se il processamento fallisce
+        """
+        cached = self.get_cached_result_for_url(url, resolution, output)
+        if cached is not None:
+            return cached
+        
+        source = None
         
         try:
-            # Download dell'immagine
-            input_path = self.download_image(url)
+            # Download dell'immagine (in memoria, o su disco se molto grande)
+            with stage('download'):
+                source = self.download_image(url)
+            return self.process_downloaded_image(source, url, resolution, output)
+            
+        finally:
+            # Pulizia dell'eventuale spill su disco
+            if isinstance(source, str):
+                self.cleanup_file(source)
+    
+    def get_cached_result_for_url(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> Optional[tuple[bytes, Dict[str, Any]]]:
+        """
+        Cerca in cache il risultato per un URL, senza scaricare l'immagine.
+        
+        Args:
+            url: URL dell'immagine
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
             
-            # Rimozione dello sfondo con informazioni di processamento
-            output_path, processing_info = self.remove_background(input_path)
+        Returns:
+            Optional[tuple]: (Dati dell'immagine processata, informazioni) oppure None
+        """
+        if self.result_cache is None:
+            return None
+        
+        cached = self.result_cache.get_by_url(url, self.cache_variant(resolution, output))
+        if cached is None:
+            return None
+        
+        result_data, cache_key = cached
+        return result_data, self.result_info(cache_key, 'hit', output, result_data)
+    
+    def process_downloaded_image(
+        self,
+        source: Union[bytes, str],
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Processa un'immagine già scaricata, usando la cache per contenuto.
+        
+        Args:
+            source: Byte dell'immagine oppure percorso di uno spill su disco
+            url: URL originale dell'immagine
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
+            
+        Returns:
+            tuple: (Dati dell'immagine processata, informazioni con 'etag' e 'cache')
+        """
+        return self._process_with_cache(source, url, url, resolution, output)
+    
+    def process_uploaded_image(
+        self,
+        data: bytes,
+        filename: Optional[str] = None,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Processa un'immagine caricata direttamente dal client, senza download.
+        
+        Args:
+            data: Byte dell'immagine caricata
+            filename: Nome del file caricato, riportato nei metadata
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
             
-            # Aggiungi metadata dettagliati all'immagine
-            self.add_metadata_to_image(output_path, url, processing_info)
+        Returns:
+            tuple: (Dati dell'immagine processata, informazioni con 'etag' e 'cache')
             
-            # Leggi i dati dell'immagine processata con metadata
-            with open(output_path, 'rb') as f:
-                result_data = f.read()
+        Raises:
+            ValueError: Se i dati non sono un'immagine valida
+            IOError: Se il processamento fallisce
+        """
+        return self._process_with_cache(data, f"upload://{filename or 'image'}", None, resolution, output)
+    
+    def _process_with_cache(
+        self,
+        source: Union[bytes, str],
+        source_label: str,
+        url: Optional[str],
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """Processa una sorgente consultando e aggiornando la cache per contenuto."""
+        cache = self.result_cache
+        variant = self.cache_variant(resolution, output)
+        
+        # Hit sul contenuto: stessa immagine già processata. La sorgente fa parte
+        # della chiave perché finisce nei metadata (Source URL) del risultato
+        cache_key = None
+        if cache is not None:
+            content_variant = f"{variant}|{source_label}"
+            if isinstance(source, str):
+                cache_key = cache.key_for_file(source, content_variant)
+            else:
+                cache_key = cache.make_key(source, content_variant)
+            result_data = cache.get(cache_key)
+            if result_data is not None:
+                if url:
+                    cache.link_url(url, variant, cache_key)
+                return result_data, self.result_info(cache_key, 'hit', output, result_data)
+        
+        result_data = self.process_image_source(source, source_label, resolution, output)
+        
+        if cache is not None:
+            cache.put(cache_key, result_data)
+            if url:
+                cache.link_url(url, variant, cache_key)
+        
+        return result_data, self.result_info(cache_key, 'miss' if cache is not None else None, output, result_data)
+    
+    def result_info(
+        self,
+        etag: Optional[str],
+        cache_status: Optional[str],
+        output: Optional[OutputFormat],
+        data: bytes
+    ) -> Dict[str, Any]:
+        """Informazioni sul risultato restituite insieme ai dati (ETag, cache, formato)."""
+        output = output or self.default_output
+        if not output.streamable and data.startswith(PNG_SIGNATURE):
+            # Richiesto WebP, codificato in PNG perché composto a strisce (vedi encode_image)
+            output = output.for_strips()
+        return {
+            'etag': etag,
+            'cache': cache_status,
+            'content_type': output.media_type,
+            'extension': output.extension
+        }
+    
+    def process_image_source(
+        self,
+        source: Union[bytes, str],
+        original_url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> bytes:
+        """
+        Pipeline in memoria: decodifica, rimozione sfondo e un solo encoding.
+        
+        Args:
+            source: Byte dell'immagine oppure percorso di uno spill su disco
+            original_url: URL originale, riportato nei metadata
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
             
-            return result_data
+        Returns:
+            bytes: Dati dell'immagine processata con metadata
+        """
+        with stage('decode'):
+            image, source_info = self.open_image(source)
             
-        finally:
-            # Pulizia dei file temporanei
-            if input_path:
-                self.cleanup_file(input_path)
-            if output_path:
-                self.cleanup_file(output_path)
\ No newline at end of file
+            # I JPEG grandi vengono decodificati a dimensione ridotta per il modello:
+            # l'originale a piena risoluzione viene decodificato una sola volta,
+            # dopo l'inferenza, e serve solo per la composizione
+            model_image = None
+            if self.engine is not None and image.format == 'JPEG':
+                input_resolution = self.select_resolution(self.resolution_spec(resolution), image.size)
+                model_image = self.decode_model_image(source, input_resolution)
+            if model_image is None:
+                image = self.load_image(image)
+        
+        # Rimozione dello sfondo con informazioni di processamento
+        output_image, processing_info = self.remove_background(image, resolution, model_image)
+        processing_info.update(source_info)
+        IMAGES_PROCESSED.labels(self.model_name or 'unknown', processing_info.get('backend', 'rembg')).inc()
+        
+        # Encoding finale con metadata direttamente nel corpo della risposta
+        return self.encode_image(output_image, original_url, processing_info, output)
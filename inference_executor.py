@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from admission import DeadlineExceeded, QueueFullError, clear_budget, current_budget
+from downloader import AsyncImageDownloader
+import metrics
+from encoders import OutputFormat
+from image_processor import ImageProcessor
+from result_cache import normalize_url
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceExecutor:
+    """
+    Esegue il lavoro bloccante di ImageProcessor fuori dall'event loop.
+
+    Il download, l'inferenza e l'encoding girano su un pool di thread dedicato
+    con un numero limitato di "corsie" di inferenza, così l'event loop resta
+    libero di servire /health e gli endpoint leggeri anche sotto carico.
+    Le richieste ammesse oltre le corsie libere attendono in una coda limitata
+    a `max_queue` posti: oltre quella soglia vengono rifiutate subito
+    (reserve) invece di accumulare latenza fino al timeout dei client.
+    """
+
+    def __init__(
+        self,
+        image_processor: ImageProcessor,
+        workers: int = 1,
+        coalesce: bool = True,
+        downloader: Optional[AsyncImageDownloader] = None,
+        max_queue: int = 0
+    ):
+        if workers < 1:
+            raise ValueError("Il numero di corsie di inferenza deve essere almeno 1")
+
+        self.image_processor = image_processor
+        self.workers = workers
+        # Posti in coda oltre le corsie prima di rifiutare (0 = illimitata)
+        self.max_queue = max_queue
+        self._admitted = 0
+        # Media mobile della durata di un lavoro, per stimare il Retry-After
+        self._service_time = 0.0
+        # Download asincroni sull'event loop, sovrapposti all'inferenza
+        self.downloader = downloader
+        # Deduplica le richieste concorrenti per lo stesso URL
+        self._single_flight = SingleFlight() if coalesce else None
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="inference"
+        )
+        logger.info(
+            f"Executor di inferenza avviato con {workers} corsie"
+            + (f" e coda massima di {max_queue} lavori" if max_queue else "")
+        )
+
+    @property
+    def admitted(self) -> int:
+        """Richieste ammesse e non ancora completate in questo processo."""
+        return self._admitted
+
+    def reserve(self) -> None:
+        """
+        Riserva un posto per una richiesta (da chiamare sull'event loop).
+
+        Raises:
+            QueueFullError: Se corsie e coda sono piene, con una stima del tempo di smaltimento
+        """
+        waiting = self._admitted - self.workers
+        if self.max_queue and waiting >= self.max_queue:
+            retry_after = (self._service_time or 1.0) * (waiting + 1) / self.workers
+            raise QueueFullError(
+                f"Servizio sovraccarico: {waiting} richieste in coda",
+                retry_after=retry_after
+            )
+        self._admitted += 1
+
+    def release(self) -> None:
+        """Libera il posto riservato da reserve."""
+        self._admitted -= 1
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Esegue una funzione bloccante su una corsia di inferenza.
+
+        Args:
+            func: Funzione sincrona da eseguire
+            *args: Argomenti posizionali per la funzione
+
+        Returns:
+            Il valore restituito dalla funzione
+
+        Raises:
+            DeadlineExceeded: Se la richiesta scade prima di ottenere una corsia
+        """
+        loop = asyncio.get_running_loop()
+        # Il contesto porta nella corsia le durate per fase e la scadenza della richiesta
+        context = contextvars.copy_context()
+        work = metrics.QueuedWork()
+
+        def task():
+            if work.leave():
+                metrics.observe_stage('queue', time.perf_counter() - work.submitted)
+            budget = current_budget()
+            if budget is not None and budget.expired:
+                # Il client ha già smesso di aspettare: la corsia passa al lavoro successivo
+                raise DeadlineExceeded("Scadenza della richiesta superata in coda")
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self._service_time = elapsed if not self._service_time else 0.8 * self._service_time + 0.2 * elapsed
+
+        try:
+            return await loop.run_in_executor(self._pool, context.run, task)
+        finally:
+            # Annullata prima di partire: esce comunque dalla coda
+            work.leave()
+
+    async def process_image_from_url(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> bytes:
+        """
+        Versione awaitable di ImageProcessor.process_image_from_url.
+
+        Args:
+            url: URL dell'immagine da processare
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
+
+        Returns:
+            bytes: Dati dell'immagine processata con metadata
+        """
+        result_data, _ = await self.process_image_from_url_with_info(url, resolution, output)
+        return result_data
+
+    async def process_image_from_url_with_info(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Versione awaitable di ImageProcessor.process_image_from_url_with_info.
+
+        Args:
+            url: URL dell'immagine da processare
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
+
+        Returns:
+            tuple: (Dati dell'immagine processata, informazioni su cache ed ETag)
+        """
+        if self._single_flight is None:
+            return await self._process_url(url, resolution, output)
+
+        # Le richieste identiche concorrenti condividono risultato ed errori
+        key = f"{self.image_processor.cache_variant(resolution, output)}|{normalize_url(url)}"
+        call = self._single_flight.do(key, lambda: self._process_shared_url(url, resolution, output))
+        budget = current_budget()
+        if budget is None:
+            result_data, info = await call
+        else:
+            # Ogni richiesta attende il lavoro condiviso entro la propria scadenza
+            try:
+                result_data, info = await asyncio.wait_for(call, max(0.0, budget.remaining))
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Scadenza della richiesta superata in attesa del risultato")
+        return result_data, dict(info)
+
+    async def _process_shared_url(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Lavoro condiviso tra le richieste identiche.
+
+        Il task eredita il contesto della prima richiesta: senza rimuoverne la
+        scadenza, la corsia scarterebbe il lavoro (e lo farebbe fallire per
+        tutte le richieste unite) quando scade la prima.
+        """
+        clear_budget()
+        return await self._process_url(url, resolution, output)
+
+    async def _process_url(
+        self,
+        url: str,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """Scarica (se serve) e processa un'immagine da URL."""
+        if self.downloader is None:
+            return await self.run(self.image_processor.process_image_from_url_with_info, url, resolution, output)
+
+        # La lettura della cache può toccare il disco: fuori dall'event loop,
+        # ma senza occupare una corsia di inferenza
+        cached = await asyncio.to_thread(self.image_processor.get_cached_result_for_url, url, resolution, output)
+        if cached is not None:
+            return cached
+
+        # Il download non occupa una corsia: mentre il modello lavora,
+        # le immagini delle richieste successive vengono già scaricate
+        source = await self.downloader.download(url)
+        try:
+            return await self.run(self.image_processor.process_downloaded_image, source, url, resolution, output)
+        finally:
+            if isinstance(source, str):
+                self.image_processor.cleanup_file(source)
+
+    async def process_uploaded_image_with_info(
+        self,
+        data: bytes,
+        filename: Optional[str] = None,
+        resolution: Optional[str] = None,
+        output: Optional[OutputFormat] = None
+    ) -> tuple[bytes, Dict[str, Any]]:
+        """
+        Versione awaitable di ImageProcessor.process_uploaded_image.
+
+        Args:
+            data: Byte dell'immagine caricata
+            filename: Nome del file caricato
+            resolution: Risoluzione di inferenza richiesta (None = default)
+            output: Formato di output (None = default)
+
+        Returns:
+            tuple: (Dati dell'immagine processata, informazioni su cache ed ETag)
+        """
+        return await self.run(self.image_processor.process_uploaded_image, data, filename, resolution, output)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Arresta il pool di thread.
+
+        Args:
+            wait: Se attendere il completamento dei lavori in corso
+        """
+        self._pool.shutdown(wait=wait)
+        logger.info("Executor di inferenza arrestato")
@@ -0,0 +1,641 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from admission import QueueFullError
+from inference_executor import InferenceExecutor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    source TEXT NOT NULL,
+    input BLOB,
+    options TEXT NOT NULL,
+    callback_url TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    run_after REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL,
+    status_code INTEGER,
+    error TEXT,
+    result BLOB,
+    result_info TEXT,
+    webhook_status TEXT,
+    webhook_attempts INTEGER NOT NULL DEFAULT 0,
+    webhook_next_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_expiry ON jobs (expires_at);
+"""
+
+# Colonne restituite da status e webhook (senza input e risultato)
+_VIEW_COLUMNS = (
+    'id, owner, status, source, options, callback_url, attempts, created_at, started_at, '
+    'finished_at, expires_at, status_code, error, result_info, webhook_status, webhook_attempts'
+)
+
+
+def owner_of(api_key: str) -> str:
+    """Identificativo del proprietario di un lavoro (l'API key non viene salvata in chiaro)."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    """Istante in formato ISO 8601 (UTC)."""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+
+class JobStore:
+    """
+    Coda dei lavori persistente su SQLite.
+
+    Lavori, input caricati e risultati vivono in un unico file in modalità WAL,
+    condiviso tra i processi worker: sopravvivono ai riavvii e ogni worker li
+    preleva con una transazione esclusiva. Un lavoro prelevato ha un lease
+    rinnovato durante il processamento; se il processo muore il lease scade e
+    il lavoro torna disponibile, fino a `max_attempts` tentativi. I risultati
+    vengono eliminati `result_ttl` secondi dopo il completamento.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        result_ttl: float = 3600.0,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 3
+    ):
+        self.path = path
+        self.result_ttl = result_ttl
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def open(self) -> None:
+        """Apre il database (dopo il fork: le connessioni SQLite non vanno condivise tra processi)."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+        logger.info(f"Coda dei lavori su {self.path}")
+
+    def close(self) -> None:
+        """Chiude il database."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def submit(
+        self,
+        owner: str,
+        source: str,
+        options: Dict[str, Any],
+        data: Optional[bytes] = None,
+        callback_url: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Accoda un nuovo lavoro.
+
+        Args:
+            owner: Proprietario del lavoro (vedi owner_of)
+            source: URL dell'immagine oppure nome del file caricato
+            options: Parametri di processamento (risoluzione e formato)
+            data: Byte dell'immagine caricata (None per gli URL)
+            callback_url: URL a cui notificare il completamento (opzionale)
+
+        Returns:
+            dict: Stato del lavoro appena creato
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, owner, status, source, input, options, callback_url, created_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, owner, source, data, json.dumps(options), callback_url, time.time())
+            )
+        return self.get(job_id, owner)
+
+    def queued(self) -> int:
+        """Numero di lavori in attesa di essere prelevati."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Preleva il lavoro più vecchio in coda (o con lease scaduto).
+
+        Args:
+            worker: Identificativo del worker che lo esegue
+
+        Returns:
+            Optional[dict]: Lavoro completo di input e opzioni, oppure None
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Interrotti troppe volte (es. il processo muore sempre su questa immagine)
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', status_code = 500, finished_at = ?, expires_at = ?, "
+                    "error = 'Processamento interrotto troppe volte', worker = NULL, lease_until = NULL, "
+                    "input = NULL, webhook_status = CASE WHEN callback_url IS NULL THEN NULL ELSE 'pending' END "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now + self.result_ttl, now, self.max_attempts)
+                )
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' AND (run_after IS NULL OR run_after <= ?)) "
+                    "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                    (now, now)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                if row['status'] == 'running':
+                    logger.warning(f"Lease del lavoro {row['id']} scaduto, lavoro ripreso")
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1, started_at = ? WHERE id = ?",
+                    (worker, now + self.lease_seconds, now, row['id'])
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        job['attempts'] += 1
+        return job
+
+    def heartbeat(self, job_id: str, worker: str) -> None:
+        """Rinnova il lease di un lavoro in esecuzione."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker)
+            )
+
+    def complete(self, job_id: str, worker: str, result: bytes, result_info: Dict[str, Any]) -> None:
+        """Memorizza il risultato di un lavoro riuscito."""
+        now = time.time()
+        info = {key: result_info.get(key) for key in ('content_type', 'extension', 'etag')}
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'succeeded', status_code = 200, result = ?, result_info = ?, "
+                "finished_at = ?, expires_at = ?, input = NULL, worker = NULL, lease_until = NULL, "
+                "webhook_status = CASE WHEN callback_url IS NULL THEN NULL ELSE 'pending' END "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (result, json.dumps(info), now, now + self.result_ttl, job_id, worker)
+            )
+
+    def fail(self, job_id: str, worker: str, status_code: int, error: str, retry: bool = False) -> bool:
+        """
+        Registra il fallimento di un lavoro.
+
+        Args:
+            job_id: Identificativo del lavoro
+            worker: Worker che lo stava eseguendo
+            status_code: Codice HTTP dell'errore
+            error: Messaggio per il client
+            retry: Se rimettere in coda il lavoro (entro `max_attempts` tentativi, con backoff esponenziale)
+
+        Returns:
+            bool: True se il lavoro è stato rimesso in coda
+        """
+        now = time.time()
+        with self._lock:
+            if retry:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, worker = NULL, lease_until = NULL, "
+                    "run_after = ? + MIN(300, 1 << (attempts * 2)) "
+                    "WHERE id = ? AND worker = ? AND status = 'running' AND attempts < ?",
+                    (error, now, job_id, worker, self.max_attempts)
+                )
+                if cursor.rowcount:
+                    return True
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', status_code = ?, error = ?, finished_at = ?, expires_at = ?, "
+                "input = NULL, worker = NULL, lease_until = NULL, "
+                "webhook_status = CASE WHEN callback_url IS NULL THEN NULL ELSE 'pending' END "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status_code, error, now, now + self.result_ttl, job_id, worker)
+            )
+        return False
+
+    def postpone(self, job_id: str, worker: str, delay: float) -> None:
+        """Rimette in coda un lavoro dopo `delay` secondi, senza consumare un tentativo."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, lease_until = NULL, "
+                "run_after = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + delay, job_id, worker)
+            )
+
+    def requeue(self, worker: str) -> int:
+        """Rimette in coda i lavori di un worker in arresto, senza consumare un tentativo."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, lease_until = NULL "
+                "WHERE worker = ? AND status = 'running'",
+                (worker,)
+            )
+            return cursor.rowcount
+
+    def get(self, job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """Stato di un lavoro del proprietario indicato (None se inesistente o scaduto)."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_VIEW_COLUMNS} FROM jobs WHERE id = ? AND owner = ? AND "
+                "(expires_at IS NULL OR expires_at > ?)",
+                (job_id, owner, time.time())
+            ).fetchone()
+        return self._view(row) if row is not None else None
+
+    def result(self, job_id: str, owner: str) -> Optional[bytes]:
+        """Byte del risultato di un lavoro riuscito e non ancora scaduto."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM jobs WHERE id = ? AND owner = ? AND status = 'succeeded' AND expires_at > ?",
+                (job_id, owner, time.time())
+            ).fetchone()
+        return row['result'] if row is not None else None
+
+    def delete(self, job_id: str, owner: str) -> bool:
+        """Elimina un lavoro non in esecuzione; False se non esiste o è in esecuzione."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE id = ? AND owner = ? AND status != 'running'",
+                (job_id, owner)
+            )
+            return cursor.rowcount > 0
+
+    def claim_webhook(self, lease: float) -> Optional[Dict[str, Any]]:
+        """
+        Preleva una notifica di completamento da consegnare.
+
+        La notifica resta riservata per `lease` secondi: se il processo muore
+        durante la consegna un altro worker la riprova.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    f"SELECT {_VIEW_COLUMNS} FROM jobs WHERE webhook_status = 'pending' AND "
+                    "(webhook_next_at IS NULL OR webhook_next_at <= ?) ORDER BY finished_at LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET webhook_next_at = ?, webhook_attempts = webhook_attempts + 1 WHERE id = ?",
+                        (now + lease, row['id'])
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._view(row)
+        job['webhook_attempts'] += 1
+        return job
+
+    def webhook_done(self, job_id: str, delivered: bool, retry_at: Optional[float] = None) -> None:
+        """Registra l'esito di una consegna: riuscita, da riprovare a `retry_at` o fallita."""
+        if delivered:
+            status, next_at = 'delivered', None
+        elif retry_at is not None:
+            status, next_at = 'pending', retry_at
+        else:
+            status, next_at = 'failed', None
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET webhook_status = ?, webhook_next_at = ? WHERE id = ?",
+                (status, next_at, job_id)
+            )
+
+    def purge_expired(self) -> int:
+        """Elimina i lavori conclusi oltre il TTL dei risultati."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE expires_at <= ? AND (webhook_status IS NULL OR webhook_status != 'pending')",
+                (time.time(),)
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def _view(row: sqlite3.Row) -> Dict[str, Any]:
+        """Converte una riga nel formato restituito dall'API."""
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        job['result_info'] = json.loads(job['result_info']) if job['result_info'] else None
+        return job
+
+
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Rappresentazione pubblica di un lavoro (risposta di stato e corpo del webhook).
+
+    Args:
+        job: Lavoro come restituito da JobStore
+
+    Returns:
+        dict: Stato serializzabile in JSON
+    """
+    status: Dict[str, Any] = {
+        "id": job['id'],
+        "status": job['status'],
+        "source": job['source'],
+        "attempts": job['attempts'],
+        "created_at": _timestamp(job['created_at']),
+        "started_at": _timestamp(job['started_at']),
+        "finished_at": _timestamp(job['finished_at']),
+        "expires_at": _timestamp(job['expires_at']),
+        "status_url": f"/jobs/{job['id']}"
+    }
+    if job['status'] == 'succeeded':
+        status["result_url"] = f"/jobs/{job['id']}/result"
+        status["content_type"] = job['result_info'].get('content_type')
+        status["etag"] = job['result_info'].get('etag')
+    if job['status'] == 'failed':
+        status["status_code"] = job['status_code']
+        status["error"] = job['error']
+    if job['callback_url']:
+        status["webhook"] = job['webhook_status'] or 'waiting'
+    return status
+
+
+class JobRunner:
+    """
+    Esegue i lavori della coda persistente al proprio ritmo.
+
+    Ogni processo avvia `concurrency` esecutori che prelevano i lavori dal
+    database e li processano sulle corsie di inferenza condivise con le
+    richieste sincrone, più un consegnatario delle notifiche webhook con
+    tentativi a backoff esponenziale. Il tempo di risposta delle richieste
+    resta così indipendente dal tempo di processamento, e i picchi di traffico
+    si accumulano nella coda invece che nelle connessioni aperte.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        executor: InferenceExecutor,
+        concurrency: int = 1,
+        max_queued: int = 0,
+        poll_interval: float = 1.0,
+        webhook_secret: Optional[str] = None,
+        webhook_timeout: float = 10.0,
+        webhook_max_attempts: int = 5
+    ):
+        self.store = store
+        self.executor = executor
+        self.concurrency = max(1, concurrency)
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.webhook_secret = webhook_secret.encode('utf-8') if webhook_secret else None
+        self.webhook_timeout = webhook_timeout
+        self.webhook_max_attempts = max(1, webhook_max_attempts)
+        # Identifica gli esecutori di questo processo nei lease dei lavori
+        self.worker = ''
+        # Media mobile della durata di un lavoro, per stimare il Retry-After
+        self._job_time = 0.0
+        self._jobs_ready: Optional[asyncio.Event] = None
+        self._webhooks_ready: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def start(self) -> None:
+        """Avvia esecutori e consegna dei webhook (nel processo worker, dopo il fork)."""
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._jobs_ready = asyncio.Event()
+        self._webhooks_ready = asyncio.Event()
+        self._client = httpx.AsyncClient(timeout=self.webhook_timeout)
+        self._tasks = [asyncio.create_task(self._work_loop()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._webhook_loop()))
+        self._tasks.append(asyncio.create_task(self._purge_loop()))
+        logger.info(f"Esecutori dei lavori avviati: {self.concurrency}")
+
+    async def stop(self) -> None:
+        """Arresta gli esecutori e rimette in coda i lavori interrotti."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        requeued = await asyncio.to_thread(self.store.requeue, self.worker)
+        if requeued:
+            logger.info(f"Lavori rimessi in coda all'arresto: {requeued}")
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def submit(
+        self,
+        owner: str,
+        source: str,
+        options: Dict[str, Any],
+        data: Optional[bytes] = None,
+        callback_url: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Accoda un lavoro e risveglia gli esecutori.
+
+        Raises:
+            QueueFullError: Se la coda ha già `max_queued` lavori in attesa
+        """
+        if self.max_queued:
+            queued = await asyncio.to_thread(self.store.queued)
+            if queued >= self.max_queued:
+                raise QueueFullError(
+                    f"Coda dei lavori piena: {queued} lavori in attesa",
+                    retry_after=(self._job_time or 1.0) * queued / self.concurrency
+                )
+        job = await asyncio.to_thread(self.store.submit, owner, source, options, data, callback_url)
+        metrics.JOBS.labels('submitted').inc()
+        self._jobs_ready.set()
+        return job
+
+    async def _wait(self, event: asyncio.Event) -> None:
+        """Attende un risveglio o, al massimo, l'intervallo di polling."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def _work_loop(self) -> None:
+        """Preleva ed esegue lavori finché il processo è attivo."""
+        while True:
+            try:
+                if not self.executor.image_processor.ready:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                job = await asyncio.to_thread(self.store.claim, self.worker)
+                if job is None:
+                    await self._wait(self._jobs_ready)
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nella coda dei lavori: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        """Rinnova il lease del lavoro finché è in esecuzione."""
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.store.heartbeat, job_id, self.worker)
+            except Exception as e:
+                logger.warning(f"Rinnovo del lease del lavoro {job_id} non riuscito: {e}")
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        """
+        Riserva un posto sulle corsie e processa il lavoro.
+
+        I lavori passano dalla stessa coda limitata delle richieste sincrone:
+        con corsie e coda piene il lavoro torna in attesa per il Retry-After
+        stimato, senza consumare un tentativo, e l'esecutore si ferma per lo
+        stesso tempo invece di prelevare e rimandare gli altri lavori.
+        """
+        try:
+            self.executor.reserve()
+        except QueueFullError as e:
+            logger.info(f"Lavoro {job['id']} rimandato: {e}")
+            metrics.JOBS.labels('postponed').inc()
+            delay = max(e.retry_after, self.poll_interval)
+            await asyncio.to_thread(self.store.postpone, job['id'], self.worker, delay)
+            await asyncio.sleep(delay)
+            return
+        try:
+            await self._process(job)
+        finally:
+            self.executor.release()
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        """Processa un lavoro e ne registra l'esito."""
+        options = job['options']
+        logger.info(f"Lavoro {job['id']} avviato (tentativo {job['attempts']})")
+        heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+        start = time.perf_counter()
+        try:
+            output = self.executor.image_processor.output_format(
+                options.get('format'), options.get('compress_level'), options.get('quality')
+            )
+            if job['input'] is not None:
+                result, info = await self.executor.process_uploaded_image_with_info(
+                    job['input'], job['source'], options.get('resolution'), output
+                )
+            else:
+                result, info = await self.executor.process_image_from_url_with_info(
+                    job['source'], options.get('resolution'), output
+                )
+        except ValueError as e:
+            logger.warning(f"Lavoro {job['id']} non valido: {e}")
+            metrics.record_error(e)
+            metrics.JOBS.labels('failed').inc()
+            await asyncio.to_thread(self.store.fail, job['id'], self.worker, 400, str(e))
+        except Exception as e:
+            logger.error(f"Errore nel lavoro {job['id']}: {e}")
+            metrics.record_error(e)
+            retried = await asyncio.to_thread(
+                self.store.fail, job['id'], self.worker, 500,
+                "Errore interno del server durante il processamento dell'immagine", True
+            )
+            metrics.JOBS.labels('retried' if retried else 'failed').inc()
+        else:
+            await asyncio.to_thread(self.store.complete, job['id'], self.worker, result, info)
+            metrics.JOBS.labels('succeeded').inc()
+            elapsed = time.perf_counter() - start
+            self._job_time = elapsed if not self._job_time else 0.8 * self._job_time + 0.2 * elapsed
+            logger.info(f"Lavoro {job['id']} completato in {elapsed:.2f}s")
+        finally:
+            heartbeat.cancel()
+        if job['callback_url']:
+            self._webhooks_ready.set()
+
+    async def _webhook_loop(self) -> None:
+        """Consegna le notifiche di completamento in attesa."""
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim_webhook, self.webhook_timeout * 2)
+                if job is None:
+                    await self._wait(self._webhooks_ready)
+                    continue
+                await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nella consegna dei webhook: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _deliver(self, job: Dict[str, Any]) -> None:
+        """Invia il webhook di un lavoro concluso, firmato con HMAC-SHA256 se configurato."""
+        payload = job_status(job)
+        payload.pop('webhook', None)
+        body = json.dumps(payload).encode('utf-8')
+        headers = {"Content-Type": "application/json", "X-Job-Id": job['id']}
+        if self.webhook_secret:
+            signature = hmac.new(self.webhook_secret, body, hashlib.sha256).hexdigest()
+            headers["X-Webhook-Signature"] = f"sha256={signature}"
+
+        try:
+            response = await self._client.post(job['callback_url'], content=body, headers=headers)
+            delivered = 200 <= response.status_code < 300
+            outcome = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            delivered = False
+            outcome = str(e) or type(e).__name__
+
+        retry_at = None
+        if delivered:
+            metrics.WEBHOOKS.labels('delivered').inc()
+        elif job['webhook_attempts'] < self.webhook_max_attempts:
+            retry_at = time.time() + min(2 ** job['webhook_attempts'], 300)
+            metrics.WEBHOOKS.labels('retried').inc()
+            logger.warning(f"Webhook del lavoro {job['id']} non consegnato ({outcome}), nuovo tentativo")
+        else:
+            metrics.WEBHOOKS.labels('failed').inc()
+            logger.error(f"Webhook del lavoro {job['id']} non consegnato dopo {job['webhook_attempts']} tentativi")
+        await asyncio.to_thread(self.store.webhook_done, job['id'], delivered, retry_at)
+
+    async def _purge_loop(self) -> None:
+        """Elimina periodicamente i risultati scaduti."""
+        while True:
+            try:
+                purged = await asyncio.to_thread(self.store.purge_expired)
+                if purged:
+                    logger.info(f"Lavori scaduti eliminati: {purged}")
+            except Exception as e:
+                logger.error(f"Errore nell'eliminazione dei lavori scaduti: {e}")
+            await asyncio.sleep(60)
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Generatore di carico end-to-end per il server con un modello stub.
+
+Avvia `main.py` in un processo separato con INFERENCE_BACKEND=stub (maschera
+fissa e costo per forward pass configurabile), serve le immagini da un server
+HTTP di fixture locale e genera traffico a passi:
+
+- closed loop: N client che inviano una richiesta alla volta (`--concurrency`)
+- open loop: arrivi a tasso fisso, costante o di Poisson (`--rates`), senza
+  attendere le risposte; la latenza parte dall'istante di arrivo previsto,
+  così un generatore in ritardo non nasconde le code
+
+Per ogni passo riporta i percentili di latenza, il ritardo di coda nelle
+corsie di inferenza (dall'header Server-Timing), gli errori, la latenza di
+/health e il ritardo dell'event loop misurato dal server (/metrics).
+
+Esempi:
+    python loadtest.py --mode closed --concurrency 1,4,16 --duration 20
+    python loadtest.py --mode open --rates 5,10,20 --stub-ms 100 --env INFERENCE_WORKERS=4
+    python loadtest.py --url http://localhost:8000 --api-key ... --mode open --rates 2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmark import DEFAULT_CORPUS_DIR, build_corpus, parse_size
+
+PERCENTILES = (50, 90, 99)
+# Intervallo tra le richieste di controllo a /health durante ogni passo
+HEALTH_PROBE_INTERVAL = 0.2
+
+
+def free_port() -> int:
+    """Porta TCP libera su localhost."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Percentili, media e massimo in millisecondi (valori in secondi)."""
+    if not values:
+        return {}
+    array = np.array(values) * 1000
+    return {
+        **{f"p{p}": round(float(np.percentile(array, p)), 2) for p in PERCENTILES},
+        'mean': round(float(array.mean()), 2),
+        'max': round(float(array.max()), 2),
+    }
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Durate in secondi dall'header Server-Timing (`nome;dur=ms, ...`)."""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                timings[name] = float(value) / 1000
+    return timings
+
+
+def histogram_snapshot(text: str, name: str, labels: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Bucket cumulativi, somma e conteggio di un istogramma dal testo di /metrics."""
+    labels = labels or {}
+    snapshot = {'buckets': {}, 'sum': 0.0, 'count': 0.0}
+    for family in text_string_to_metric_families(text):
+        if family.name != name:
+            continue
+        for sample in family.samples:
+            if any(sample.labels.get(key) != value for key, value in labels.items()):
+                continue
+            if sample.name == f"{name}_bucket":
+                bound = float(sample.labels['le'])
+                snapshot['buckets'][bound] = snapshot['buckets'].get(bound, 0.0) + sample.value
+            elif sample.name == f"{name}_sum":
+                snapshot['sum'] += sample.value
+            elif sample.name == f"{name}_count":
+                snapshot['count'] += sample.value
+    return snapshot
+
+
+def histogram_delta(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Statistiche di un istogramma tra due scrape (in millisecondi).
+
+    I percentili sono stimati per interpolazione lineare nei bucket, come
+    `histogram_quantile` di Prometheus.
+    """
+    count = after['count'] - before['count']
+    if count <= 0:
+        return {}
+    bounds = sorted(after['buckets'])
+    cumulative = [after['buckets'][b] - before['buckets'].get(b, 0.0) for b in bounds]
+
+    def quantile(q: float) -> float:
+        rank = q * cumulative[-1]
+        lower_bound, lower_count = 0.0, 0.0
+        for bound, total in zip(bounds, cumulative):
+            if total >= rank:
+                if bound == float('inf'):
+                    return lower_bound
+                fraction = (rank - lower_count) / (total - lower_count) if total > lower_count else 0.0
+                return lower_bound + (bound - lower_bound) * fraction
+            lower_bound, lower_count = bound, total
+        return lower_bound
+
+    return {
+        'samples': int(count),
+        'mean': round((after['sum'] - before['sum']) / count * 1000, 2),
+        'p50': round(quantile(0.5) * 1000, 2),
+        'p99': round(quantile(0.99) * 1000, 2),
+    }
+
+
+class ServerProcesses:
+    """Server dell'applicazione (con lo stub) e server delle fixture in processi separati."""
+
+    def __init__(self, args: argparse.Namespace, corpus_dir: str):
+        self.args = args
+        self.corpus_dir = corpus_dir
+        self.api_key = args.api_key or f"loadtest-{random.randrange(1 << 30)}"
+        self.fixture_port = free_port()
+        self.app_port = free_port()
+        self._processes: List[subprocess.Popen] = []
+        self._log = None
+
+    @property
+    def fixture_url(self) -> str:
+        return f"http://127.0.0.1:{self.fixture_port}"
+
+    @property
+    def app_url(self) -> str:
+        return f"http://127.0.0.1:{self.app_port}"
+
+    def start(self) -> None:
+        """Avvia il server delle fixture e l'applicazione."""
+        self._processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'http.server', str(self.fixture_port),
+             '--bind', '127.0.0.1', '--directory', self.corpus_dir],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        ))
+
+        env = {
+            **os.environ,
+            'HOST': '127.0.0.1',
+            'PORT': str(self.app_port),
+            'API_KEY': self.api_key,
+            'DEBUG': 'False',
+            'INFERENCE_BACKEND': 'stub',
+            'STUB_INFERENCE_MS': str(self.args.stub_ms),
+            'STUB_COST_MODE': self.args.stub_cost,
+            'WORKERS': str(self.args.workers),
+        }
+        if not self.args.keep_cache:
+            # Ogni richiesta deve arrivare al modello
+            env.update({'CACHE_MEMORY_MAX_MB': '0', 'CACHE_DIR': '', 'COALESCE_REQUESTS': 'False'})
+        if self.args.workers > 1:
+            env['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='removebg-metrics-')
+        for item in self.args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.args.server_log)), exist_ok=True)
+        self._log = open(self.args.server_log, 'w')
+        self._processes.append(subprocess.Popen(
+            [sys.executable, 'main.py'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=self._log,
+            stderr=subprocess.STDOUT
+        ))
+
+    def stop(self) -> None:
+        """Arresta i processi avviati (SIGTERM, poi SIGKILL)."""
+        for process in reversed(self._processes):
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self._log is not None:
+            self._log.close()
+
+    def check_alive(self) -> None:
+        """Errore se un processo è terminato prima del tempo."""
+        for process in self._processes:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f"Processo {' '.join(process.args)} terminato (codice {process.returncode}), "
+                    f"vedi {self.args.server_log}"
+                )
+
+
+class LoadGenerator:
+    """Genera il traffico di un passo e raccoglie le misure."""
+
+    def __init__(self, client: httpx.AsyncClient, app_url: str, api_key: str, image_urls: List[str], args: argparse.Namespace):
+        self.client = client
+        self.app_url = app_url
+        self.api_key = api_key
+        self.image_urls = image_urls
+        self.args = args
+        self._next = 0
+
+    def next_image_url(self) -> str:
+        """Immagini del corpus a rotazione."""
+        url = self.image_urls[self._next % len(self.image_urls)]
+        self._next += 1
+        return url
+
+    async def send(self, scheduled: float) -> Dict[str, Any]:
+        """Una richiesta di processamento; la latenza parte da `scheduled`."""
+        sent = time.perf_counter()
+        sample: Dict[str, Any] = {'scheduled_delay': sent - scheduled}
+        try:
+            response = await self.client.get(
+                f"{self.app_url}/remove-background",
+                params={'image_url': self.next_image_url(), **self.args.params},
+                headers={'X-API-Key': self.api_key}
+            )
+            sample['status'] = response.status_code
+            timings = parse_server_timing(response.headers.get('server-timing'))
+            sample['queue'] = timings.get('queue', 0.0)
+            sample['server'] = timings.get('total')
+        except httpx.HTTPError as e:
+            sample['status'] = type(e).__name__
+        sample['latency'] = time.perf_counter() - scheduled
+        return sample
+
+    async def closed_loop(self, concurrency: int, duration: float) -> Tuple[List[Dict[str, Any]], int]:
+        """`concurrency` client, ognuno invia la richiesta successiva dopo la risposta."""
+        deadline = time.perf_counter() + duration
+        samples: List[Dict[str, Any]] = []
+
+        async def user():
+            while time.perf_counter() < deadline:
+                samples.append(await self.send(time.perf_counter()))
+                if self.args.think_ms:
+                    await asyncio.sleep(self.args.think_ms / 1000)
+
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return samples, 0
+
+    async def open_loop(self, rate: float, duration: float) -> Tuple[List[Dict[str, Any]], int]:
+        """Arrivi a `rate` richieste al secondo per `duration` secondi."""
+        rng = random.Random(self.args.seed)
+        start = time.perf_counter()
+        scheduled = start
+        tasks: List[asyncio.Task] = []
+        pending: set = set()
+        skipped = 0
+        while True:
+            scheduled += rng.expovariate(rate) if self.args.arrival == 'poisson' else 1 / rate
+            if scheduled - start >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(pending) >= self.args.max_outstanding:
+                # Il server non tiene il passo: non accumula connessioni all'infinito
+                skipped += 1
+                continue
+            task = asyncio.create_task(self.send(scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            tasks.append(task)
+        return list(await asyncio.gather(*tasks)), skipped
+
+    async def probe_health(self, stop: asyncio.Event) -> List[float]:
+        """Latenze di /health: un loop bloccato le fa crescere anche senza errori."""
+        latencies = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                await self.client.get(f"{self.app_url}/health")
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                pass
+            try:
+                await asyncio.wait_for(stop.wait(), HEALTH_PROBE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return latencies
+
+    async def scrape(self) -> str:
+        """Testo di /metrics (vuoto se non disponibile)."""
+        try:
+            response = await self.client.get(f"{self.app_url}/metrics")
+            return response.text if response.status_code == 200 else ''
+        except httpx.HTTPError:
+            return ''
+
+    async def run_step(self, mode: str, load: float) -> Dict[str, Any]:
+        """Esegue un passo di carico e ne riassume le misure."""
+        before = await self.scrape()
+        stop = asyncio.Event()
+        probe = asyncio.create_task(self.probe_health(stop))
+        start = time.perf_counter()
+        if mode == 'closed':
+            samples, skipped = await self.closed_loop(int(load), self.args.duration)
+        else:
+            samples, skipped = await self.open_loop(load, self.args.duration)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        health = await probe
+        after = await self.scrape()
+
+        ok = [s for s in samples if s['status'] == 200]
+        errors: Dict[str, int] = {}
+        for sample in samples:
+            if sample['status'] != 200:
+                errors[str(sample['status'])] = errors.get(str(sample['status']), 0) + 1
+
+        step = {
+            'mode': mode,
+            'load': load,
+            'seconds': round(elapsed, 2),
+            'sent': len(samples),
+            'ok': len(ok),
+            'skipped': skipped,
+            'errors': errors,
+            'error_rate': round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+            'throughput_rps': round(len(ok) / elapsed, 2),
+            'latency_ms': summarize([s['latency'] for s in ok]),
+            'queue_ms': summarize([s['queue'] for s in ok]),
+            'server_ms': summarize([s['server'] for s in ok if s.get('server') is not None]),
+            'send_delay_ms': summarize([s['scheduled_delay'] for s in samples]),
+            'health_ms': summarize(health),
+        }
+        if before and after:
+            name = 'removebg_event_loop_lag_seconds'
+            step['event_loop_lag_ms'] = histogram_delta(
+                histogram_snapshot(before, name), histogram_snapshot(after, name)
+            )
+            name = 'removebg_stage_duration_seconds'
+            step['server_queue_ms'] = histogram_delta(
+                histogram_snapshot(before, name, {'stage': 'queue'}),
+                histogram_snapshot(after, name, {'stage': 'queue'})
+            )
+        return step
+
+
+def print_step(step: Dict[str, Any]) -> None:
+    """Riga di riepilogo di un passo."""
+    latency, queue = step['latency_ms'], step['queue_ms']
+    lag = step.get('event_loop_lag_ms', {})
+    health = step['health_ms']
+    label = f"{step['load']:g} {'client' if step['mode'] == 'closed' else 'req/s'}"
+    print(
+        f"{label:>12} {step['sent']:>7} {step['error_rate'] * 100:>6.1f}% {step['throughput_rps']:>7.1f} "
+        f"{latency.get('p50', 0):>8.0f} {latency.get('p90', 0):>8.0f} {latency.get('p99', 0):>8.0f} "
+        f"{queue.get('p50', 0):>8.0f} {queue.get('p99', 0):>8.0f} "
+        f"{health.get('p99', 0):>8.1f} {lag.get('p99', 0):>8.1f}"
+    )
+    if step['errors']:
+        print(f"{'':>12} errori: {', '.join(f'{k}: {v}' for k, v in step['errors'].items())}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Prepara corpus e processi, attende /ready ed esegue i passi."""
+    names = build_corpus(
+        args.corpus_dir,
+        [parse_size(size) for size in args.sizes.split(',') if size.strip()],
+        [name for name in args.formats.split(',') if name]
+    )
+
+    processes = None
+    if args.url:
+        app_url, api_key = args.url.rstrip('/'), args.api_key
+        fixture_url = args.fixture_url.rstrip('/')
+    else:
+        processes = ServerProcesses(args, os.path.abspath(args.corpus_dir))
+        processes.start()
+        app_url, api_key, fixture_url = processes.app_url, processes.api_key, processes.fixture_url
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+            print("⏳ Attesa di /ready...")
+            deadline = time.perf_counter() + args.ready_timeout
+            while True:
+                if processes is not None:
+                    processes.check_alive()
+                try:
+                    if (await client.get(f"{app_url}/ready")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f"Server non pronto dopo {args.ready_timeout}s")
+                await asyncio.sleep(0.5)
+
+            generator = LoadGenerator(client, app_url, api_key, [f"{fixture_url}/{name}" for name in names], args)
+            loads = args.concurrency if args.mode == 'closed' else args.rates
+            print(
+                f"\n{'carico':>12} {'inviate':>7} {'errori':>7} {'ok/s':>7} "
+                f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'coda p50':>8} {'coda p99':>8} "
+                f"{'health99':>8} {'loop p99':>8}"
+            )
+            print("-" * 106)
+            steps = []
+            for load in loads:
+                if steps and args.pause:
+                    await asyncio.sleep(args.pause)
+                step = await generator.run_step(args.mode, load)
+                print_step(step)
+                steps.append(step)
+    finally:
+        if processes is not None:
+            processes.stop()
+
+    return {
+        'created': datetime.now().isoformat(),
+        'config': {
+            'mode': args.mode,
+            'arrival': args.arrival if args.mode == 'open' else None,
+            'duration': args.duration,
+            'stub_ms': None if args.url else args.stub_ms,
+            'stub_cost': None if args.url else args.stub_cost,
+            'workers': None if args.url else args.workers,
+            'env': args.env,
+            'params': args.params,
+            'corpus': names,
+        },
+        'steps': steps,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Test di carico del server con modello stub")
+    parser.add_argument('--mode', choices=('closed', 'open'), default='closed')
+    parser.add_argument('--concurrency', default='1,4,16', help="Client concorrenti per passo (closed loop)")
+    parser.add_argument('--rates', default='2,5,10', help="Richieste al secondo per passo (open loop)")
+    parser.add_argument('--arrival', choices=('constant', 'poisson'), default='poisson',
+                        help="Distribuzione degli arrivi in open loop")
+    parser.add_argument('--duration', type=float, default=15, help="Secondi per passo")
+    parser.add_argument('--pause', type=float, default=2, help="Secondi di pausa tra i passi")
+    parser.add_argument('--think-ms', type=float, default=0, help="Pausa tra le richieste di un client (closed loop)")
+    parser.add_argument('--max-outstanding', type=int, default=1000,
+                        help="Richieste in volo oltre cui gli arrivi vengono scartati (open loop)")
+    parser.add_argument('--timeout', type=float, default=60, help="Timeout di una richiesta in secondi")
+    parser.add_argument('--seed', type=int, default=0, help="Seme degli arrivi di Poisson")
+    parser.add_argument('--param', dest='params', action='append', default=[],
+                        help="Parametro di query aggiuntivo, es. --param format=webp")
+
+    parser.add_argument('--stub-ms', type=float, default=50, help="Costo del forward pass dello stub in ms")
+    parser.add_argument('--stub-cost', choices=('sleep', 'cpu'), default='sleep',
+                        help="sleep: attesa senza CPU; cpu: calcolo reale (entrambi rilasciano il GIL)")
+    parser.add_argument('--workers', type=int, default=1, help="Processi worker del server (WORKERS)")
+    parser.add_argument('--env', action='append', default=[], help="Variabile d'ambiente del server, es. INFERENCE_WORKERS=4")
+    parser.add_argument('--keep-cache', action='store_true',
+                        help="Lascia attive cache dei risultati e coalescing (di default disattivati)")
+    parser.add_argument('--server-log', default='./.cache/loadtest/server.log', help="Log del server avviato")
+    parser.add_argument('--ready-timeout', type=float, default=120)
+
+    parser.add_argument('--url', default=None, help="Server già avviato da testare (niente stub)")
+    parser.add_argument('--api-key', default=None, help="API key del server indicato con --url")
+    parser.add_argument('--fixture-url', default=None,
+                        help="URL da cui il server indicato con --url scarica il corpus")
+
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR)
+    parser.add_argument('--sizes', default='1280x960', help="Dimensioni delle immagini del corpus")
+    parser.add_argument('--formats', default='jpeg', help="Formati delle immagini del corpus")
+    parser.add_argument('--output', default=None, help="File JSON dei risultati")
+
+    args = parser.parse_args(argv)
+    args.concurrency = [int(value) for value in args.concurrency.split(',') if value.strip()]
+    args.rates = [float(value) for value in args.rates.split(',') if value.strip()]
+    args.params = dict(param.partition('=')[::2] for param in args.params)
+    if args.url and not (args.api_key and args.fixture_url):
+        parser.error("--url richiede --api-key e --fixture-url")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    try:
+        results = asyncio.run(run(args))
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Risultati salvati in {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
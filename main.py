@@ -1,11 +1,28 @@
 import os
-from typing import Optional
-from functools import wraps
-from fastapi import FastAPI, HTTPException, Depends, status
+import asyncio
+import base64
+import json
+import math
+import threading
+import time
+from typing import AsyncIterator, Callable, Optional, List, Tuple, Awaitable
+from functools import partial, wraps
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, UploadFile, File, status
 from fastapi.security import APIKeyHeader
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from urllib.parse import urlparse
+from pydantic import BaseModel
 from dotenv import load_dotenv
+from admission import AdmissionController, BodySizeLimit, CancelOnDisconnect, Overloaded
 from image_processor import ImageProcessor
+from inference_executor import InferenceExecutor
+from jobs import JobRunner, JobStore, job_status, owner_of
+from downloader import AsyncImageDownloader
+from result_cache import ResultCache
+from encoders import OutputFormat
+from workers import WorkerSupervisor
+from cpu_layout import apply_layout, plan_layout
+import metrics
 import logging
 
 # Carica le variabili d'ambiente
@@ -17,10 +34,100 @@ logger = logging.getLogger(__name__)
 
 # Configurazione
 API_KEY = os.getenv("API_KEY", "default-api-key")
+# Più chiavi separate da virgola: quote e limiti sono applicati per chiave
+API_KEYS = {key.strip() for key in API_KEY.split(",") if key.strip()}
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8000))
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 TEMP_DIR = os.getenv("TEMP_DIR", "./temp_images")
+SPILL_THRESHOLD_MB = float(os.getenv("SPILL_THRESHOLD_MB", 0))
+MAX_DOWNLOAD_MB = float(os.getenv("MAX_DOWNLOAD_MB", 50))
+MAX_IMAGE_MEGAPIXELS = float(os.getenv("MAX_IMAGE_MEGAPIXELS", 50))
+STRIP_COMPOSITE_MEGAPIXELS = float(os.getenv("STRIP_COMPOSITE_MEGAPIXELS", 4))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 2))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 1))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 10))
+CACHE_MEMORY_MAX_MB = float(os.getenv("CACHE_MEMORY_MAX_MB", 128))
+CACHE_DIR = os.getenv("CACHE_DIR", "")
+CACHE_DISK_MAX_MB = float(os.getenv("CACHE_DISK_MAX_MB", 1024))
+CACHE_URL_TTL = float(os.getenv("CACHE_URL_TTL", 3600))
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "True").lower() == "true"
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", 5))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", 30))
+DOWNLOAD_TOTAL_TIMEOUT = float(os.getenv("DOWNLOAD_TOTAL_TIMEOUT", 60))
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", 64))
+DOWNLOAD_KEEPALIVE_EXPIRY = float(os.getenv("DOWNLOAD_KEEPALIVE_EXPIRY", 30))
+DOWNLOAD_HTTP2 = os.getenv("DOWNLOAD_HTTP2", "False").lower() == "true"
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", 25))
+MAX_UPLOAD_BYTES = int(MAX_UPLOAD_MB * 1024 * 1024)
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", 100))
+PRECISION = os.getenv("PRECISION", "fp32").lower()
+PARITY_IMAGES_DIR = os.getenv("PARITY_IMAGES_DIR", "")
+PARITY_MAX_MAE = float(os.getenv("PARITY_MAX_MAE", 0.02))
+PARITY_MIN_IOU = float(os.getenv("PARITY_MIN_IOU", 0.95))
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch").lower()
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "./.cache/onnx/model.onnx")
+ORT_GRAPH_OPTIMIZATION_LEVEL = os.getenv("ORT_GRAPH_OPTIMIZATION_LEVEL", "all").lower()
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", 0))
+ORT_INTER_OP_THREADS = int(os.getenv("ORT_INTER_OP_THREADS", 0))
+STUB_INFERENCE_MS = float(os.getenv("STUB_INFERENCE_MS", 50))
+STUB_COST_MODE = os.getenv("STUB_COST_MODE", "sleep").lower()
+INFERENCE_RESOLUTION = os.getenv("INFERENCE_RESOLUTION", "1024").lower()
+INFERENCE_RESOLUTIONS = [int(r) for r in os.getenv("INFERENCE_RESOLUTIONS", "512,768,1024").split(",") if r.strip()]
+LETTERBOX = os.getenv("LETTERBOX", "False").lower() == "true"
+MASK_UPSAMPLE = os.getenv("MASK_UPSAMPLE", "bilinear").lower()
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png").lower()
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", 6))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", 90))
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", 4))
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "none").lower()
+TORCH_COMPILE_CACHE_DIR = os.getenv("TORCH_COMPILE_CACHE_DIR", "./.cache/torch")
+WARMUP = os.getenv("WARMUP", "True").lower() == "true"
+WORKERS = int(os.getenv("WORKERS", 1))
+CPU_LIMIT = int(os.getenv("CPU_LIMIT", 0))
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", 0))
+MODEL_LOCAL_ONLY = os.getenv("MODEL_LOCAL_ONLY", "False").lower() == "true"
+MODEL_ARTIFACT_DIR = os.getenv("MODEL_ARTIFACT_DIR", "./.cache/model-artifact")
+ADMISSION_QUEUE_DEPTH = int(os.getenv("ADMISSION_QUEUE_DEPTH", 64))
+MAX_IN_FLIGHT_PER_KEY = int(os.getenv("MAX_IN_FLIGHT_PER_KEY", 0))
+RATE_LIMIT_PER_KEY = float(os.getenv("RATE_LIMIT_PER_KEY", 0))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 0))
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 60))
+JOBS_DB = os.getenv("JOBS_DB", "./.cache/jobs/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", 1000))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 3600))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_WEBHOOK_SECRET = os.getenv("JOB_WEBHOOK_SECRET", "")
+JOB_WEBHOOK_TIMEOUT = float(os.getenv("JOB_WEBHOOK_TIMEOUT", 10))
+JOB_WEBHOOK_MAX_ATTEMPTS = int(os.getenv("JOB_WEBHOOK_MAX_ATTEMPTS", 5))
+
+# Ogni corsia resta bloccata sulla propria predizione mentre il batch si riempie:
+# un batch non può superare il numero di corsie, quindi le corsie seguono BATCH_MAX_SIZE
+if BATCH_MAX_SIZE > INFERENCE_WORKERS:
+    logger.warning(
+        f"BATCH_MAX_SIZE={BATCH_MAX_SIZE} richiede almeno altrettante corsie: "
+        f"INFERENCE_WORKERS portato da {INFERENCE_WORKERS} a {BATCH_MAX_SIZE}"
+    )
+    INFERENCE_WORKERS = BATCH_MAX_SIZE
+
+# Con più worker il modello viene caricato una volta qui e condiviso tramite fork
+# (solo avviando con `python main.py`; `uvicorn main:app` resta a processo singolo)
+PREFORK = WORKERS > 1 and __name__ == "__main__"
+
+# Thread di calcolo divisi tra worker e corsie secondo la quota CPU del cgroup
+cpu_layout = plan_layout(
+    workers=WORKERS if PREFORK else 1,
+    lanes=INFERENCE_WORKERS,
+    batching=BATCH_MAX_SIZE > 1,
+    cpus=CPU_LIMIT or None,
+    intra_op_threads=INTRA_OP_THREADS or None
+)
+# Il thread pool OpenMP non sopravvive al fork: il supervisore carica il modello
+# a thread singolo e ogni worker ripristina i propri thread dopo il fork
+apply_layout(cpu_layout, intra_op_threads=1 if PREFORK else None)
 
 # Inizializza FastAPI
 app = FastAPI(
@@ -31,20 +138,201 @@ app = FastAPI(
     redoc_url="/redoc" if DEBUG else None
 )
 
+# Limite del corpo degli upload, applicato prima che FastAPI legga il form
+# (con un margine per boundary e intestazioni delle parti multipart)
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_TOO_LARGE_DETAIL = f"Immagine troppo grande (massimo {MAX_UPLOAD_MB:g} MB)"
+app.add_middleware(
+    BodySizeLimit,
+    limits={
+        "/remove-background/upload": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+        "/remove-background/raw": MAX_UPLOAD_BYTES,
+        "/remove-background/batch/upload": MAX_BATCH_ITEMS * (MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES),
+        "/jobs/upload": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    },
+    detail=UPLOAD_TOO_LARGE_DETAIL
+)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Metriche HTTP e header Server-Timing con la durata di ogni fase."""
+    timings = metrics.start_timings()
+    start_time = time.perf_counter()
+    metrics.IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.IN_FLIGHT.dec()
+    elapsed = time.perf_counter() - start_time
+    
+    # Template della route, non il percorso: etichette a cardinalità limitata
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.labels(
+        request.method,
+        getattr(route, "path", "unmatched"),
+        str(response.status_code)
+    ).observe(elapsed)
+    response.headers["Server-Timing"] = metrics.server_timing(timings, elapsed)
+    return response
+
+
+# Più esterno del middleware delle metriche: annulla le richieste dei client disconnessi
+app.add_middleware(CancelOnDisconnect)
+
 # Configurazione autenticazione API Key
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 def get_api_key(api_key: Optional[str] = Depends(api_key_header)):
     """Verifica l'API key."""
-    if api_key != API_KEY:
+    if api_key not in API_KEYS:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="API Key non valida"
         )
     return api_key
 
+# Cache dei risultati (disattiva se entrambi i livelli hanno budget nullo)
+result_cache = None
+if CACHE_MEMORY_MAX_MB > 0 or (CACHE_DIR and CACHE_DISK_MAX_MB > 0):
+    result_cache = ResultCache(
+        memory_max_bytes=int(CACHE_MEMORY_MAX_MB * 1024 * 1024),
+        # Con più worker il livello su disco viene aperto in ciascun worker (after_fork)
+        disk_dir=None if PREFORK else (CACHE_DIR or None),
+        disk_max_bytes=int(CACHE_DISK_MAX_MB * 1024 * 1024),
+        url_ttl=CACHE_URL_TTL
+    )
+metrics.register_cache_collector(result_cache)
+
 # Inizializza il processore di immagini
-image_processor = ImageProcessor(temp_dir=TEMP_DIR)
+image_processor = ImageProcessor(
+    temp_dir=TEMP_DIR,
+    result_cache=result_cache,
+    spill_threshold_bytes=int(SPILL_THRESHOLD_MB * 1024 * 1024) if SPILL_THRESHOLD_MB > 0 else None,
+    max_download_bytes=int(MAX_DOWNLOAD_MB * 1024 * 1024) if MAX_DOWNLOAD_MB > 0 else None,
+    max_image_pixels=int(MAX_IMAGE_MEGAPIXELS * 1_000_000) if MAX_IMAGE_MEGAPIXELS > 0 else None,
+    strip_composite_pixels=int(STRIP_COMPOSITE_MEGAPIXELS * 1_000_000) if STRIP_COMPOSITE_MEGAPIXELS > 0 else None,
+    precision=PRECISION,
+    parity_images_dir=PARITY_IMAGES_DIR or None,
+    parity_max_mae=PARITY_MAX_MAE,
+    parity_min_iou=PARITY_MIN_IOU,
+    inference_backend=INFERENCE_BACKEND,
+    onnx_model_path=ONNX_MODEL_PATH,
+    onnx_options={
+        "graph_optimization_level": ORT_GRAPH_OPTIMIZATION_LEVEL,
+        "intra_op_threads": ORT_INTRA_OP_THREADS or cpu_layout.ort_intra_op_threads,
+        "inter_op_threads": ORT_INTER_OP_THREADS or cpu_layout.inter_op_threads
+    },
+    stub_options={"cost_ms": STUB_INFERENCE_MS, "cost_mode": STUB_COST_MODE},
+    compile_mode=TORCH_COMPILE,
+    compile_cache_dir=TORCH_COMPILE_CACHE_DIR,
+    warmup_enabled=WARMUP,
+    inference_resolution=INFERENCE_RESOLUTION,
+    resolutions=INFERENCE_RESOLUTIONS,
+    letterbox=LETTERBOX,
+    mask_upsample=MASK_UPSAMPLE,
+    output_format=OUTPUT_FORMAT,
+    png_compress_level=PNG_COMPRESS_LEVEL,
+    webp_quality=WEBP_QUALITY,
+    webp_method=WEBP_METHOD,
+    batch_max_size=BATCH_MAX_SIZE,
+    batch_max_wait_ms=BATCH_MAX_WAIT_MS,
+    prefork=PREFORK,
+    model_local_only=MODEL_LOCAL_ONLY,
+    model_artifact_dir=MODEL_ARTIFACT_DIR or None,
+    # Caricato in background all'avvio (o nel supervisore prima del fork)
+    load_model=False
+)
+
+# Esegue il lavoro bloccante fuori dall'event loop
+image_downloader = AsyncImageDownloader(
+    image_processor,
+    connect_timeout=DOWNLOAD_CONNECT_TIMEOUT,
+    read_timeout=DOWNLOAD_READ_TIMEOUT,
+    total_timeout=DOWNLOAD_TOTAL_TIMEOUT,
+    max_connections=DOWNLOAD_MAX_CONNECTIONS,
+    keepalive_expiry=DOWNLOAD_KEEPALIVE_EXPIRY,
+    http2=DOWNLOAD_HTTP2
+)
+inference_executor = InferenceExecutor(
+    image_processor,
+    workers=INFERENCE_WORKERS,
+    coalesce=COALESCE_REQUESTS,
+    downloader=image_downloader,
+    max_queue=ADMISSION_QUEUE_DEPTH
+)
+
+# Quote per API key e scadenza delle richieste di processamento
+admission_controller = AdmissionController(
+    max_in_flight_per_key=MAX_IN_FLIGHT_PER_KEY,
+    rate_per_key=RATE_LIMIT_PER_KEY,
+    burst=RATE_LIMIT_BURST,
+    deadline_seconds=REQUEST_DEADLINE_SECONDS
+)
+
+# Lavori asincroni: coda persistente su SQLite, aperta in ogni worker all'avvio
+job_store = JobStore(
+    JOBS_DB,
+    result_ttl=JOB_RESULT_TTL,
+    lease_seconds=JOB_LEASE_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS
+)
+job_runner = JobRunner(
+    job_store,
+    inference_executor,
+    concurrency=JOB_WORKERS,
+    max_queued=JOB_MAX_QUEUED,
+    poll_interval=JOB_POLL_INTERVAL,
+    webhook_secret=JOB_WEBHOOK_SECRET or None,
+    webhook_timeout=JOB_WEBHOOK_TIMEOUT,
+    webhook_max_attempts=JOB_WEBHOOK_MAX_ATTEMPTS
+)
+
+
+def load_model() -> None:
+    """Carica il modello fuori dall'event loop; /ready diventa 200 al termine."""
+    start_time = time.time()
+    try:
+        image_processor.load()
+        logger.info(f"Modello pronto in {time.time() - start_time:.1f}s")
+    except Exception as e:
+        logger.error(f"Caricamento del modello non riuscito: {e}")
+
+
+@app.on_event("startup")
+async def start_model_loading():
+    """Avvia il caricamento del modello senza bloccare l'avvio del server."""
+    # Con prefork il modello è già caricato e i worker sono pronti dopo il fork
+    if image_processor.status == 'loading':
+        threading.Thread(target=load_model, name="model-loader", daemon=True).start()
+
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    """Misura il ritardo dell'event loop (removebg_event_loop_lag_seconds)."""
+    app.state.event_loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+
+
+@app.on_event("startup")
+async def start_job_runner():
+    """Apre la coda dei lavori e avvia gli esecutori di questo processo."""
+    await asyncio.to_thread(job_store.open)
+    job_runner.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_runner():
+    """Arresta gli esecutori dei lavori, rimettendo in coda quelli interrotti."""
+    await job_runner.stop()
+    job_store.close()
+
+
+@app.on_event("shutdown")
+async def shutdown_executor():
+    """Arresta l'executor di inferenza e chiude le connessioni di download."""
+    app.state.event_loop_monitor.cancel()
+    await image_downloader.aclose()
+    inference_executor.shutdown(wait=False)
 
 
 @app.get("/")
@@ -59,24 +347,186 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint."""
+    """Liveness: il processo risponde (fallisce solo se nessun modello può essere caricato)."""
+    if image_processor.status == 'failed':
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": "unhealthy", "error": image_processor.load_error}
+        )
     return {"status": "healthy"}
 
 
-@app.get("/remove-background")
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 solo quando il modello è caricato e il warmup completato."""
+    if not image_processor.ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"status": image_processor.status}
+        )
+    return {"status": "ready", "model": image_processor.model_name}
+
+
+def require_model_ready(api_key: str = Depends(get_api_key)) -> None:
+    """Rifiuta le richieste di processamento finché il modello non è pronto (dopo l'autenticazione)."""
+    if image_processor.ready:
+        return
+    if image_processor.status == 'failed':
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Nessun modello di background removal disponibile"
+        )
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Modello in caricamento, riprova tra qualche secondo",
+        headers={"Retry-After": "5"}
+    )
+
+
+def overloaded(e: Overloaded) -> HTTPException:
+    """Errore per richieste rifiutate dal controllo di ammissione (503 o 429 con Retry-After)."""
+    metrics.REJECTED.labels(e.reason).inc()
+    return HTTPException(
+        status_code=e.status_code,
+        detail=str(e),
+        headers={"Retry-After": e.retry_after_header}
+    )
+
+
+async def admit_request(
+    api_key: str = Depends(get_api_key),
+    ready: None = Depends(require_model_ready)
+) -> AsyncIterator[None]:
+    """
+    Ammette una richiesta di processamento o la rifiuta subito.
+
+    Oltre le quote della chiave risponde 429, con corsie e coda piene 503,
+    entrambi con Retry-After. I posti occupati restano tali fino all'invio
+    completo della risposta.
+    """
+    try:
+        admission_controller.admit(api_key)
+    except Overloaded as e:
+        raise overloaded(e)
+    try:
+        inference_executor.reserve()
+    except Overloaded as e:
+        admission_controller.release(api_key)
+        raise overloaded(e)
+    try:
+        yield
+    finally:
+        inference_executor.release()
+        admission_controller.release(api_key)
+
+
+async def admit_batch(
+    api_key: str = Depends(get_api_key),
+    ready: None = Depends(require_model_ready)
+) -> AsyncIterator[None]:
+    """
+    Come admit_request per le quote della chiave, senza scadenza (il batch risponde in streaming).
+
+    I posti di corsie e coda vengono riservati elemento per elemento da
+    batch_stream, così un batch non scavalca il limite della coda.
+    """
+    try:
+        admission_controller.admit(api_key, deadline=False)
+    except Overloaded as e:
+        raise overloaded(e)
+    try:
+        yield
+    finally:
+        admission_controller.release(api_key)
+
+
+@app.get("/cache/stats")
+async def cache_stats(api_key: str = Depends(get_api_key)):
+    """Statistiche di hit/miss e occupazione della cache dei risultati."""
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Metriche in formato Prometheus (senza autenticazione, per lo scraping)."""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+def get_output_format(
+    output_format: Optional[str] = Query(None, alias="format"),
+    compress_level: Optional[int] = None,
+    quality: Optional[int] = None,
+    accept: Optional[str] = Header(None)
+) -> OutputFormat:
+    """Risolve il formato di output dai parametri della richiesta e dall'header Accept."""
+    try:
+        return image_processor.output_format(output_format, compress_level, quality, accept)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Verifica se l'header If-None-Match corrisponde all'ETag."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(
+        tag.removeprefix("W/") == etag for tag in candidates
+    )
+
+
+def image_response(processed_image_data: bytes, result_info: dict, if_none_match: Optional[str]) -> Response:
+    """Costruisce la risposta con l'immagine processata, ETag e 304 se applicabile."""
+    headers = {
+        "Content-Disposition": f"inline; filename=image_no_background.{result_info.get('extension', 'png')}",
+        # Il formato può dipendere dall'header Accept
+        "Vary": "Accept"
+    }
+    if result_info.get('etag'):
+        etag = f'"{result_info["etag"]}"'
+        headers["ETag"] = etag
+        if etag_matches(if_none_match, etag):
+            metrics.record_result(result_info, 0)
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": etag, "Vary": "Accept"}
+            )
+    
+    # Restituisce l'immagine processata
+    metrics.record_result(result_info, len(processed_image_data))
+    return Response(
+        content=processed_image_data,
+        media_type=result_info.get('content_type', 'image/png'),
+        headers=headers
+    )
+
+
+@app.get("/remove-background", dependencies=[Depends(admit_request)])
 async def remove_background(
     image_url: str,
-    api_key: str = Depends(get_api_key)
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key),
+    if_none_match: Optional[str] = Header(None)
 ):
     """
     Rimuove lo sfondo da un'immagine.
     
     Args:
         image_url: URL dell'immagine da processare
+        resolution: Risoluzione di inferenza (es. 512, 768, 1024 o "auto"; default da configurazione)
+        output: Formato di output (parametri format, compress_level, quality o header Accept)
         api_key: Chiave API per l'autenticazione (header X-API-Key)
+        if_none_match: ETag già in possesso del client (header If-None-Match)
     
     Returns:
-        Immagine con sfondo rimosso in formato PNG
+        Immagine con sfondo rimosso (PNG di default)
         
     Raises:
         HTTPException: Per errori di validazione, download o processamento
@@ -91,22 +541,34 @@ async def remove_background(
                 detail="URL dell'immagine è richiesto"
             )
         
+        # Il client ha già il risultato: evita il trasferimento
+        if result_cache is not None and if_none_match:
+            cache_key = result_cache.lookup_url(image_url.strip(), image_processor.cache_variant(resolution, output))
+            if cache_key and etag_matches(if_none_match, f'"{cache_key}"'):
+                metrics.CACHE_RESULTS.labels('not_modified').inc()
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": f'"{cache_key}"'})
+        
         # Processa l'immagine
-        processed_image_data = image_processor.process_image_from_url(image_url.strip())
+        processed_image_data, result_info = await inference_executor.process_image_from_url_with_info(
+            image_url.strip(),
+            resolution,
+            output
+        )
         
-        logger.info("Immagine processata con successo")
+        logger.info(f"Immagine processata con successo (cache: {result_info.get('cache')})")
         
-        # Restituisce l'immagine processata
-        return Response(
-            content=processed_image_data,
-            media_type="image/png",
-            headers={
-                "Content-Disposition": "inline; filename=image_no_background.png"
-            }
-        )
+        return image_response(processed_image_data, result_info, if_none_match)
         
+    except HTTPException:
+        raise
+    
+    except Overloaded as e:
+        logger.warning(f"Richiesta rifiutata: {str(e)}")
+        raise overloaded(e)
+    
     except ValueError as e:
         logger.warning(f"Errore di validazione: {str(e)}")
+        metrics.record_error(e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
@@ -114,22 +576,516 @@ async def remove_background(
     
     except Exception as e:
         logger.error(f"Errore interno: {str(e)}")
+        metrics.record_error(e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Errore interno del server durante il processamento dell'immagine"
         )
 
 
-@app.post("/remove-background")
+@app.post("/remove-background", dependencies=[Depends(admit_request)])
 async def remove_background_post(
     image_url: str,
-    api_key: str = Depends(get_api_key)
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key),
+    if_none_match: Optional[str] = Header(None)
 ):
     """
     Alternativa POST per rimuovere lo sfondo da un'immagine.
     Utile per URL molto lunghi che potrebbero avere problemi con GET.
     """
-    return await remove_background(image_url, api_key)
+    return await remove_background(image_url, resolution, output, api_key, if_none_match)
+
+
+async def process_upload(
+    data: bytes,
+    filename: Optional[str],
+    if_none_match: Optional[str],
+    resolution: Optional[str] = None,
+    output: Optional[OutputFormat] = None
+) -> Response:
+    """Processa i byte caricati e gestisce gli errori come per gli URL."""
+    try:
+        if not data:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Nessuna immagine caricata"
+            )
+        metrics.RECEIVED_BYTES.labels('upload').inc(len(data))
+        
+        processed_image_data, result_info = await inference_executor.process_uploaded_image_with_info(
+            data,
+            filename,
+            resolution,
+            output
+        )
+        
+        logger.info(f"Immagine caricata processata con successo (cache: {result_info.get('cache')})")
+        
+        return image_response(processed_image_data, result_info, if_none_match)
+        
+    except HTTPException:
+        raise
+    
+    except Overloaded as e:
+        logger.warning(f"Richiesta rifiutata: {str(e)}")
+        raise overloaded(e)
+    
+    except ValueError as e:
+        logger.warning(f"Errore di validazione: {str(e)}")
+        metrics.record_error(e)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    
+    except Exception as e:
+        logger.error(f"Errore interno: {str(e)}")
+        metrics.record_error(e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Errore interno del server durante il processamento dell'immagine"
+        )
+
+
+def upload_too_large() -> HTTPException:
+    """Errore per upload oltre il limite configurato."""
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=UPLOAD_TOO_LARGE_DETAIL
+    )
+
+
+@app.post("/remove-background/upload", dependencies=[Depends(admit_request)])
+async def remove_background_upload(
+    file: UploadFile = File(...),
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Rimuove lo sfondo da un'immagine caricata come multipart/form-data.
+    
+    Args:
+        file: Immagine caricata (campo "file")
+        resolution: Risoluzione di inferenza (es. 512, 768, 1024 o "auto")
+        output: Formato di output (parametri format, compress_level, quality o header Accept)
+        api_key: Chiave API per l'autenticazione (header X-API-Key)
+        if_none_match: ETag già in possesso del client (header If-None-Match)
+    
+    Returns:
+        Immagine con sfondo rimosso (PNG di default)
+    """
+    logger.info(f"Processando immagine caricata: {file.filename}")
+    
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    
+    # Legge al massimo un byte oltre il limite per rilevare upload eccessivi
+    data = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    
+    return await process_upload(data, file.filename, if_none_match, resolution, output)
+
+
+@app.post("/remove-background/raw", dependencies=[Depends(admit_request)])
+async def remove_background_raw(
+    request: Request,
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Rimuove lo sfondo da un'immagine inviata come corpo grezzo della richiesta.
+    
+    Il Content-Type deve essere di tipo image/* (es. image/jpeg).
+    """
+    content_type = request.headers.get("content-type", "").lower()
+    if not content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Il Content-Type deve essere image/*"
+        )
+    
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    
+    # Legge il corpo a blocchi interrompendo oltre il limite
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > MAX_UPLOAD_BYTES:
+            raise upload_too_large()
+    
+    logger.info(f"Processando immagine grezza ({content_type}, {len(body)} bytes)")
+    
+    return await process_upload(bytes(body), None, if_none_match, resolution, output)
+
+
+class BatchRequest(BaseModel):
+    """Corpo della richiesta batch per URL."""
+    image_urls: List[str]
+
+
+def check_batch_size(count: int) -> None:
+    """Verifica che il batch non sia vuoto e non superi il limite configurato."""
+    if count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Il batch non contiene immagini"
+        )
+    if count > MAX_BATCH_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Troppe immagini nel batch (massimo {MAX_BATCH_ITEMS})"
+        )
+
+
+def check_resolution(resolution: Optional[str]) -> None:
+    """Valida la risoluzione richiesta prima di avviare lo streaming del batch."""
+    try:
+        image_processor.cache_variant(resolution)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+
+def batch_stream(jobs: List[Tuple[str, Callable[[], Awaitable]]]) -> StreamingResponse:
+    """
+    Esegue i lavori del batch insieme e invia ogni risultato appena pronto.
+    
+    Ogni riga NDJSON contiene l'indice dell'elemento, la sorgente e l'immagine
+    in base64 oppure l'errore. Un elemento lento non blocca gli altri. Ogni
+    elemento riserva il proprio posto nella coda delle corsie: con la coda
+    piena l'elemento viene rifiutato (503 con retry_after) come una richiesta
+    singola.
+    """
+    async def run_job(index: int, source: str, job: Callable[[], Awaitable]) -> dict:
+        try:
+            inference_executor.reserve()
+            try:
+                processed_image_data, result_info = await job()
+            finally:
+                inference_executor.release()
+            metrics.record_result(result_info, len(processed_image_data))
+            return {
+                "index": index,
+                "source": source,
+                "status": "ok",
+                "content_type": result_info.get('content_type', 'image/png'),
+                "etag": result_info.get('etag'),
+                "cache": result_info.get('cache'),
+                "data": base64.b64encode(processed_image_data).decode("ascii")
+            }
+        except Overloaded as e:
+            logger.warning(f"Elemento del batch rifiutato: {str(e)}")
+            metrics.REJECTED.labels(e.reason).inc()
+            return {
+                "index": index,
+                "source": source,
+                "status": "error",
+                "status_code": e.status_code,
+                "error": str(e),
+                "retry_after": e.retry_after_header
+            }
+        except ValueError as e:
+            logger.warning(f"Errore di validazione nel batch: {str(e)}")
+            metrics.record_error(e)
+            return {"index": index, "source": source, "status": "error", "status_code": 400, "error": str(e)}
+        except Exception as e:
+            logger.error(f"Errore interno nel batch: {str(e)}")
+            metrics.record_error(e)
+            return {
+                "index": index,
+                "source": source,
+                "status": "error",
+                "status_code": 500,
+                "error": "Errore interno del server durante il processamento dell'immagine"
+            }
+    
+    async def generate():
+        tasks = [
+            asyncio.ensure_future(run_job(index, source, job))
+            for index, (source, job) in enumerate(jobs)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                yield json.dumps(item) + "\n"
+        finally:
+            # Client disconnesso: annulla gli elementi non ancora completati
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.post("/remove-background/batch", dependencies=[Depends(admit_batch)])
+async def remove_background_batch(
+    batch: BatchRequest,
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Rimuove lo sfondo da una lista di URL in un'unica richiesta.
+    
+    I risultati vengono inviati in streaming (NDJSON) man mano che ogni
+    immagine è pronta, non nell'ordine della richiesta.
+    """
+    urls = [url.strip() for url in batch.image_urls]
+    check_batch_size(len(urls))
+    check_resolution(resolution)
+    logger.info(f"Processando batch di {len(urls)} URL")
+    
+    return batch_stream([
+        (url, partial(inference_executor.process_image_from_url_with_info, url, resolution, output))
+        for url in urls
+    ])
+
+
+@app.post("/remove-background/batch/upload", dependencies=[Depends(admit_batch)])
+async def remove_background_batch_upload(
+    files: List[UploadFile] = File(...),
+    resolution: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Rimuove lo sfondo da più immagini caricate (multipart, campo "files").
+    
+    I risultati vengono inviati in streaming (NDJSON) man mano che ogni
+    immagine è pronta.
+    """
+    check_batch_size(len(files))
+    check_resolution(resolution)
+    logger.info(f"Processando batch di {len(files)} immagini caricate")
+    
+    uploads = []
+    for upload in files:
+        data = await upload.read(MAX_UPLOAD_BYTES + 1)
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise upload_too_large()
+        metrics.RECEIVED_BYTES.labels('upload').inc(len(data))
+        uploads.append((upload.filename or "image", data))
+    
+    return batch_stream([
+        (filename, partial(inference_executor.process_uploaded_image_with_info, data, filename, resolution, output))
+        for filename, data in uploads
+    ])
+
+
+async def admit_job(api_key: str = Depends(get_api_key)) -> AsyncIterator[None]:
+    """
+    Ammette l'invio di un lavoro: quote della chiave come admit_request.
+
+    Non richiede il modello pronto: i lavori restano in coda finché non lo è.
+    """
+    if image_processor.status == 'failed':
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Nessun modello di background removal disponibile"
+        )
+    try:
+        admission_controller.admit(api_key, deadline=False)
+    except Overloaded as e:
+        raise overloaded(e)
+    try:
+        yield
+    finally:
+        admission_controller.release(api_key)
+
+
+def check_callback_url(callback_url: Optional[str]) -> Optional[str]:
+    """Valida l'URL del webhook di completamento."""
+    if not callback_url or not callback_url.strip():
+        return None
+    parsed = urlparse(callback_url.strip())
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="URL del webhook non valido"
+        )
+    return callback_url.strip()
+
+
+async def submit_job(
+    api_key: str,
+    source: str,
+    resolution: Optional[str],
+    output: OutputFormat,
+    callback_url: Optional[str],
+    data: Optional[bytes] = None
+) -> JSONResponse:
+    """Accoda un lavoro e risponde subito 202 con il suo stato."""
+    check_resolution(resolution)
+    options = {
+        "resolution": resolution,
+        "format": output.name,
+        "compress_level": output.compress_level,
+        "quality": output.quality
+    }
+    try:
+        job = await job_runner.submit(owner_of(api_key), source, options, data, callback_url)
+    except Overloaded as e:
+        logger.warning(f"Lavoro rifiutato: {str(e)}")
+        raise overloaded(e)
+    
+    logger.info(f"Lavoro {job['id']} accodato: {source}")
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content=job_status(job),
+        headers={"Location": f"/jobs/{job['id']}"}
+    )
+
+
+async def get_job(job_id: str, api_key: str) -> dict:
+    """Stato di un lavoro della chiave, 404 se inesistente, di un'altra chiave o scaduto."""
+    job = await asyncio.to_thread(job_store.get, job_id, owner_of(api_key))
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Lavoro non trovato"
+        )
+    return job
+
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(admit_job)])
+async def create_job(
+    image_url: str,
+    resolution: Optional[str] = None,
+    callback_url: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Accoda la rimozione dello sfondo di un'immagine da URL.
+    
+    Risponde subito con l'identificativo del lavoro; il risultato si ottiene
+    da /jobs/{id}/result oppure tramite webhook su `callback_url`.
+    
+    Args:
+        image_url: URL dell'immagine da processare
+        resolution: Risoluzione di inferenza (es. 512, 768, 1024 o "auto")
+        callback_url: URL a cui inviare lo stato del lavoro al completamento (opzionale)
+        output: Formato di output (parametri format, compress_level, quality o header Accept)
+        api_key: Chiave API per l'autenticazione (header X-API-Key)
+    """
+    image_url = image_url.strip()
+    if not image_processor.is_valid_image_url(image_url):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="URL dell'immagine non valido"
+        )
+    return await submit_job(api_key, image_url, resolution, output, check_callback_url(callback_url))
+
+
+@app.post("/jobs/upload", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(admit_job)])
+async def create_upload_job(
+    file: UploadFile = File(...),
+    resolution: Optional[str] = None,
+    callback_url: Optional[str] = None,
+    output: OutputFormat = Depends(get_output_format),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Accoda la rimozione dello sfondo di un'immagine caricata (multipart, campo "file").
+    
+    L'immagine viene salvata nella coda insieme al lavoro.
+    """
+    callback_url = check_callback_url(callback_url)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    
+    data = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise upload_too_large()
+    if not data:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Nessuna immagine caricata"
+        )
+    metrics.RECEIVED_BYTES.labels('upload').inc(len(data))
+    
+    return await submit_job(api_key, file.filename or "image", resolution, output, callback_url, data)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str, api_key: str = Depends(get_api_key)):
+    """Stato di un lavoro: queued, running, succeeded o failed."""
+    return job_status(await get_job(job_id, api_key))
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(
+    job_id: str,
+    api_key: str = Depends(get_api_key),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Risultato di un lavoro completato.
+    
+    Risponde 409 con Retry-After finché il lavoro è in coda o in esecuzione e
+    422 con l'errore del lavoro se è fallito: il codice originale del
+    fallimento resta nello stato del lavoro (GET /jobs/{id}).
+    """
+    job = await get_job(job_id, api_key)
+    if job['status'] in ('queued', 'running'):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Lavoro non ancora completato",
+            headers={"Retry-After": str(max(1, math.ceil(JOB_POLL_INTERVAL)))}
+        )
+    if job['status'] == 'failed':
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Lavoro fallito: {job['error']}"
+        )
+    
+    result = await asyncio.to_thread(job_store.result, job_id, owner_of(api_key))
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Lavoro non trovato"
+        )
+    return image_response(result, job['result_info'], if_none_match)
+
+
+@app.delete("/jobs/{job_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_job(job_id: str, api_key: str = Depends(get_api_key)):
+    """Annulla un lavoro in coda o elimina il risultato di uno concluso."""
+    job = await get_job(job_id, api_key)
+    if job['status'] == 'running':
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Lavoro in esecuzione, impossibile eliminarlo"
+        )
+    await asyncio.to_thread(job_store.delete, job_id, owner_of(api_key))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+def after_fork(index: int) -> None:
+    """
+    Prepara il worker `index` dopo il fork.
+
+    Ogni worker ha una propria sottodirectory della cache su disco con una
+    quota di CACHE_DISK_MAX_MB: l'eviction è per processo, e su una directory
+    condivisa il disco arriverebbe a WORKERS volte il budget. L'indice del
+    worker resta lo stesso ai riavvii, quindi la sua cache sopravvive.
+    """
+    if result_cache is not None and CACHE_DIR:
+        result_cache.attach_disk(
+            os.path.join(CACHE_DIR, f"worker-{index}"),
+            int(CACHE_DISK_MAX_MB * 1024 * 1024) // WORKERS
+        )
+    image_processor.after_fork()
 
 
 if __name__ == "__main__":
@@ -138,10 +1094,25 @@ if __name__ == "__main__":
     logger.info(f"Avvio server su {HOST}:{PORT}")
     logger.info(f"Debug mode: {DEBUG}")
     
-    uvicorn.run(
-        "main:app",
-        host=HOST,
-        port=PORT,
-        reload=DEBUG,
-        log_level="info" if DEBUG else "warning"
-    )
\ No newline at end of file
+    if PREFORK:
+        # Caricato una sola volta qui, prima del fork dei worker
+        image_processor.load()
+        if DEBUG:
+            logger.warning("Reload automatico non disponibile con più worker")
+        WorkerSupervisor(
+            app,
+            host=HOST,
+            port=PORT,
+            workers=WORKERS,
+            threads_per_worker=cpu_layout.intra_op_threads,
+            on_fork=after_fork,
+            log_level="info" if DEBUG else "warning"
+        ).run()
+    else:
+        uvicorn.run(
+            "main:app",
+            host=HOST,
+            port=PORT,
+            reload=DEBUG,
+            log_level="info" if DEBUG else "warning"
+        )
\ No newline at end of file
@@ -0,0 +1,253 @@
+import asyncio
+import contextvars
+import glob
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Con più worker le metriche vengono scritte su file e aggregate allo scrape
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+# Fasi di una richiesta, nell'ordine in cui compaiono in Server-Timing
+STAGES = ('queue', 'download', 'decode', 'preprocess', 'inference', 'postprocess', 'metadata', 'encode')
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = Histogram(
+    'removebg_stage_duration_seconds',
+    'Durata delle fasi di processamento',
+    ['stage'],
+    buckets=STAGE_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'removebg_request_duration_seconds',
+    'Durata delle richieste HTTP fino all\'invio degli header',
+    ['method', 'route', 'status'],
+    buckets=REQUEST_BUCKETS
+)
+IMAGES_PROCESSED = Counter(
+    'removebg_images_processed',
+    'Immagini processate dal modello (esclusi i risultati dalla cache)',
+    ['model', 'backend']
+)
+CACHE_RESULTS = Counter(
+    'removebg_cache_results',
+    'Risultati restituiti per esito della cache',
+    ['result']
+)
+RECEIVED_BYTES = Counter(
+    'removebg_received_bytes',
+    'Byte delle immagini in ingresso',
+    ['source']
+)
+SENT_BYTES = Counter(
+    'removebg_sent_bytes',
+    'Byte delle immagini restituite'
+)
+ERRORS = Counter(
+    'removebg_errors',
+    'Errori di processamento per classe di eccezione',
+    ['exception']
+)
+REJECTED = Counter(
+    'removebg_requests_rejected',
+    'Richieste rifiutate o annullate dal controllo di ammissione per motivo',
+    ['reason']
+)
+JOBS = Counter(
+    'removebg_jobs',
+    'Lavori asincroni per esito (submitted, succeeded, failed, retried, postponed)',
+    ['status']
+)
+WEBHOOKS = Counter(
+    'removebg_webhooks',
+    'Consegne dei webhook dei lavori per esito (delivered, retried, failed)',
+    ['result']
+)
+IN_FLIGHT = Gauge(
+    'removebg_requests_in_flight',
+    'Richieste HTTP in corso',
+    multiprocess_mode='livesum'
+)
+QUEUED = Gauge(
+    'removebg_inference_queued',
+    'Lavori in attesa di una corsia di inferenza',
+    multiprocess_mode='livesum'
+)
+EVENT_LOOP_LAG = Histogram(
+    'removebg_event_loop_lag_seconds',
+    'Ritardo dell\'event loop rispetto al timer atteso',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+# Intervallo di campionamento del ritardo dell'event loop
+EVENT_LOOP_INTERVAL = 0.1
+
+# Durate per fase della richiesta corrente (propagate ai thread delle corsie)
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    'removebg_timings', default=None
+)
+
+
+def start_timings() -> Dict[str, float]:
+    """Inizia la raccolta delle durate per fase della richiesta corrente."""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def observe_stage(name: str, elapsed: float) -> None:
+    """Registra la durata di una fase nell'istogramma e nella richiesta corrente."""
+    STAGE_SECONDS.labels(name).observe(elapsed)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Misura la durata del blocco come fase `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """
+    Valore dell'header Server-Timing (durate in millisecondi).
+
+    Args:
+        timings: Durate per fase in secondi
+        total: Durata complessiva della richiesta in secondi
+    """
+    parts = [f"{name};dur={timings[name] * 1000:.1f}" for name in STAGES if name in timings]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+async def monitor_event_loop(interval: float = EVENT_LOOP_INTERVAL) -> None:
+    """
+    Campiona di continuo il ritardo dell'event loop.
+
+    Un timer che scatta in ritardo indica callback che bloccano il loop:
+    ogni ritardo si somma alla latenza di tutte le richieste in corso.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+class QueuedWork:
+    """Lavoro in coda per una corsia: esce dal gauge una sola volta, all'avvio o all'annullamento."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._left = False
+        self.submitted = time.perf_counter()
+        QUEUED.inc()
+
+    def leave(self) -> bool:
+        """Toglie il lavoro dalla coda; False se era già uscito."""
+        with self._lock:
+            if self._left:
+                return False
+            self._left = True
+        QUEUED.dec()
+        return True
+
+
+def record_result(result_info: Dict[str, Any], sent_bytes: int) -> None:
+    """Registra esito della cache e byte inviati per un risultato restituito."""
+    if result_info.get('cache'):
+        CACHE_RESULTS.labels(result_info['cache']).inc()
+    if sent_bytes:
+        SENT_BYTES.inc(sent_bytes)
+
+
+def record_error(error: BaseException) -> None:
+    """Conta un errore di processamento per classe di eccezione."""
+    ERRORS.labels(type(error).__name__).inc()
+
+
+class CacheCollector:
+    """Espone le statistiche della cache dei risultati al momento dello scrape."""
+
+    def __init__(self, result_cache: Any):
+        self.result_cache = result_cache
+
+    def collect(self):
+        stats = self.result_cache.stats()
+        yield GaugeMetricFamily(
+            'removebg_cache_hit_ratio',
+            'Rapporto di hit della cache dei risultati',
+            value=stats['hit_ratio']
+        )
+        size = GaugeMetricFamily(
+            'removebg_cache_bytes',
+            'Occupazione della cache dei risultati',
+            labels=['tier']
+        )
+        size.add_metric(['memory'], stats['memory_bytes'])
+        size.add_metric(['disk'], stats['disk_bytes'])
+        yield size
+
+
+def register_cache_collector(result_cache: Any) -> None:
+    """
+    Registra le statistiche della cache (solo a processo singolo).
+
+    Con più worker ogni processo ha la propria cache in memoria: il rapporto
+    di hit si ricava da removebg_cache_results_total.
+    """
+    if result_cache is not None and not MULTIPROCESS:
+        REGISTRY.register(CacheCollector(result_cache))
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    Serializza le metriche nel formato di esposizione Prometheus.
+
+    Returns:
+        Tuple[bytes, str]: Corpo della risposta e Content-Type
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def reset_multiprocess_dir() -> None:
+    """Rimuove i file delle metriche di un'esecuzione precedente."""
+    if not MULTIPROCESS:
+        return
+    for path in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(path)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Esclude i gauge di un worker terminato dall'aggregazione."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,254 @@
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_FORMAT = 1
+MANIFEST_FILE = 'manifest.json'
+CONFIG_FILE = 'config.json'
+WEIGHTS_FILE = 'model.safetensors'
+CODE_DIR = 'code'
+
+# Tipi safetensors supportati dal loader
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def artifact_exists(directory: Optional[str]) -> bool:
+    """True se la directory contiene un artefatto completo."""
+    return bool(directory) and os.path.exists(os.path.join(directory, MANIFEST_FILE))
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    """Legge il manifest dell'artefatto."""
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def save_artifact(model: torch.nn.Module, model_name: str, directory: str) -> str:
+    """
+    Salva il modello come artefatto autonomo, caricabile senza from_pretrained.
+
+    L'artefatto contiene la configurazione, il codice remoto del modello
+    (trust_remote_code), i pesi in safetensors già nel dtype di esecuzione e
+    un manifest con classi, versioni e tensori condivisi. Viene scritto in una
+    directory temporanea e poi spostato, così un avvio concorrente non legge
+    mai un artefatto incompleto.
+
+    Args:
+        model: Modello Transformers in modalità eval
+        model_name: Nome del modello sorgente (es. briaai/RMBG-2.0)
+        directory: Directory di destinazione
+
+    Returns:
+        str: Directory dell'artefatto
+    """
+    import transformers
+    from safetensors.torch import save_file
+
+    model = model.eval()
+    tmp_dir = f"{directory.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, CODE_DIR))
+
+    # Codice remoto: tutti i sorgenti del modulo dinamico di transformers
+    model_module, config_module = _copy_model_code(model, os.path.join(tmp_dir, CODE_DIR))
+    model.config.to_json_file(os.path.join(tmp_dir, CONFIG_FILE))
+
+    # Tensori che condividono lo stesso storage vengono scritti una sola volta
+    state_dict = model.state_dict()
+    persistent = set(state_dict)
+    for name, buffer in model.named_buffers():
+        if name not in persistent:
+            state_dict[name] = buffer
+
+    tensors: Dict[str, torch.Tensor] = {}
+    aliases: Dict[str, str] = {}
+    seen: Dict[Tuple, str] = {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tuple(tensor.stride()))
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor.detach().clone().contiguous()
+
+    weights_path = os.path.join(tmp_dir, WEIGHTS_FILE)
+    save_file(tensors, weights_path)
+
+    dtypes = sorted({str(tensor.dtype).removeprefix('torch.') for tensor in tensors.values()})
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'model_name': model_name,
+        'module': model_module,
+        'class': type(model).__name__,
+        'config_module': config_module,
+        'config_class': type(model.config).__name__,
+        'dtypes': dtypes,
+        'aliases': aliases,
+        'non_persistent_buffers': sorted(set(state_dict) - persistent),
+        'weights_bytes': os.path.getsize(weights_path),
+        'torch_version': torch.__version__,
+        'transformers_version': transformers.__version__,
+        'created': datetime.now().isoformat(),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+    logger.info(f"Artefatto del modello {model_name} salvato in {directory}")
+    return directory
+
+
+def _copy_model_code(model: torch.nn.Module, code_dir: str) -> Tuple[str, str]:
+    """
+    Copia i sorgenti del codice remoto e restituisce i moduli di modello e config.
+
+    Per le classi incluse in transformers non c'è nulla da copiare e vengono
+    restituiti i nomi completi dei moduli.
+    """
+    model_module = type(model).__module__
+    config_module = type(model.config).__module__
+    if not model_module.startswith('transformers_modules.'):
+        return model_module, config_module
+
+    source_dir = os.path.dirname(inspect.getfile(type(model)))
+    for filename in os.listdir(source_dir):
+        if filename.endswith('.py'):
+            shutil.copy2(os.path.join(source_dir, filename), os.path.join(code_dir, filename))
+    init_path = os.path.join(code_dir, '__init__.py')
+    if not os.path.exists(init_path):
+        open(init_path, 'w').close()
+
+    return f".{model_module.rsplit('.', 1)[-1]}", f".{config_module.rsplit('.', 1)[-1]}"
+
+
+def _import_artifact_module(directory: str, module: str) -> Any:
+    """
+    Importa un modulo dell'artefatto.
+
+    I moduli relativi (`.nome`) vengono importati dal pacchetto `code/`,
+    registrato con un nome derivato dal percorso dell'artefatto, così gli
+    import relativi del codice remoto continuano a funzionare.
+    """
+    if not module.startswith('.'):
+        return importlib.import_module(module)
+
+    code_dir = os.path.abspath(os.path.join(directory, CODE_DIR))
+    package = f"removebg_artifact_{hashlib.sha256(code_dir.encode()).hexdigest()[:12]}"
+    if package not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            package,
+            os.path.join(code_dir, '__init__.py'),
+            submodule_search_locations=[code_dir]
+        )
+        package_module = importlib.util.module_from_spec(spec)
+        sys.modules[package] = package_module
+        spec.loader.exec_module(package_module)
+    return importlib.import_module(f"{package}{module}")
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Apre un file safetensors come tensori mappati in memoria, senza copie.
+
+    Il file viene mappato in privato (copy-on-write): le pagine vengono
+    lette al primo accesso e restano nella page cache, condivisa tra i
+    processi e le repliche sullo stesso host.
+
+    Args:
+        path: Percorso del file .safetensors
+
+    Returns:
+        Dict[str, torch.Tensor]: Tensori per nome
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    base = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        chunk = data[base + start:base + end]
+        if (base + start) % dtype.itemsize:
+            # Offset non allineato al tipo: unica copia possibile
+            chunk = chunk.clone()
+        tensors[name] = chunk.view(dtype).view(info['shape'])
+    return tensors
+
+
+def load_artifact(directory: str) -> Tuple[torch.nn.Module, Dict[str, Any]]:
+    """
+    Carica il modello da un artefatto con i pesi mappati in memoria.
+
+    Il modello viene costruito sul device meta (nessuna allocazione né
+    inizializzazione dei pesi) e i tensori mappati vengono assegnati
+    direttamente ai parametri: l'avvio costa solo i page fault dei pesi usati.
+
+    Args:
+        directory: Directory dell'artefatto
+
+    Returns:
+        Tuple[torch.nn.Module, Dict[str, Any]]: Modello in modalità eval e manifest
+
+    Raises:
+        ValueError: Se l'artefatto non è compatibile o incompleto
+    """
+    manifest = read_manifest(directory)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        raise ValueError(f"Formato dell'artefatto non supportato: {manifest.get('format')}")
+
+    config_class = getattr(_import_artifact_module(directory, manifest['config_module']), manifest['config_class'])
+    model_class = getattr(_import_artifact_module(directory, manifest['module']), manifest['class'])
+    config = config_class.from_json_file(os.path.join(directory, CONFIG_FILE))
+
+    with torch.device('meta'):
+        model = model_class(config)
+
+    tensors = mmap_safetensors(os.path.join(directory, WEIGHTS_FILE))
+    for alias, name in manifest.get('aliases', {}).items():
+        tensors[alias] = tensors[name]
+
+    non_persistent = manifest.get('non_persistent_buffers', [])
+    for name in non_persistent:
+        module_name, _, buffer_name = name.rpartition('.')
+        model.get_submodule(module_name)._buffers[buffer_name] = tensors.pop(name)
+    model.load_state_dict(tensors, strict=True, assign=True)
+
+    missing = [
+        name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f"Tensori mancanti nell'artefatto: {', '.join(missing[:5])}")
+
+    return model.eval(), manifest
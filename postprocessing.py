@@ -0,0 +1,264 @@
+import logging
+import warnings
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Modalità di upsampling della maschera alla risoluzione originale
+MASK_UPSAMPLE_MODES = ('bilinear', 'guided')
+
+# Pixel per striscia nella composizione a strisce (pochi MB per buffer)
+STRIP_PIXELS = 1 << 20
+
+
+def _luma_tensor(image: Image.Image) -> torch.Tensor:
+    """Luminanza (1, 1, H, W) tra 0 e 1 di un'immagine (conversione L di PIL, BT.601)."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        luma = torch.from_numpy(np.asarray(image.convert('L')))
+    return luma.view(1, 1, image.height, image.width).float().div_(255)
+
+
+def _box_filter(x: torch.Tensor, radius: int) -> torch.Tensor:
+    """
+    Media su finestra quadrata di lato 2r+1 (ai bordi sulla sola area valida).
+
+    Separabile e basata su somme cumulative: costo costante per pixel,
+    indipendente dal raggio.
+    """
+    size = 2 * radius + 1
+    for dim in (-1, -2):
+        length = x.shape[dim]
+        padding = (radius + 1, radius) if dim == -1 else (0, 0, radius + 1, radius)
+        cumulative = F.pad(x, padding).cumsum(dim)
+        window = cumulative.narrow(dim, size, length) - cumulative.narrow(dim, 0, length)
+        # Numero di pixel validi nella finestra (ridotto ai bordi)
+        positions = torch.arange(length)
+        counts = ((positions + radius).clamp(max=length - 1) - (positions - radius).clamp(min=0) + 1).to(x.dtype)
+        x = window / (counts if dim == -1 else counts.view(-1, 1))
+    return x
+
+
+def _guided_coefficients(
+    mask: torch.Tensor,
+    guide_low: torch.Tensor,
+    radius: int,
+    eps: float
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Coefficienti lineari (a, b) del guided filter alla risoluzione della maschera."""
+    height, width = mask.shape
+    p = mask.float().view(1, 1, height, width)
+
+    # Le quattro medie locali in un solo passaggio del filtro
+    mean_i, mean_p, mean_ip, mean_ii = _box_filter(
+        torch.cat([guide_low, p, guide_low * p, guide_low * guide_low], dim=1), radius
+    ).split(1, dim=1)
+    cov_ip = mean_ip - mean_i * mean_p
+    var_i = mean_ii - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    a, b = _box_filter(torch.cat([a, b], dim=1), radius).split(1, dim=1)
+    return a, b
+
+
+def guided_upsample(
+    mask: torch.Tensor,
+    image: Image.Image,
+    radius: int = 4,
+    eps: float = 1e-3
+) -> torch.Tensor:
+    """
+    Upsampling della maschera con un fast guided filter sulla luminanza.
+
+    I coefficienti lineari del filtro vengono stimati alla risoluzione della
+    maschera e poi interpolati alla risoluzione originale, dove vengono
+    applicati alla luminanza dell'immagine: i bordi della maschera seguono i
+    contorni reali invece di restare sfumati dall'interpolazione.
+
+    Args:
+        mask: Maschera (h, w) con valori tra 0 e 1
+        image: Immagine RGB a piena risoluzione usata come guida
+        radius: Raggio del filtro alla risoluzione della maschera
+        eps: Regolarizzazione (più alto = più morbido)
+
+    Returns:
+        torch.Tensor: Maschera (H, W) alla risoluzione dell'immagine
+    """
+    height, width = mask.shape
+    guide = _luma_tensor(image)
+    guide_low = F.interpolate(
+        guide, size=(height, width), mode='bilinear', align_corners=False, antialias=True
+    )
+    a, b = _guided_coefficients(mask, guide_low, radius, eps)
+
+    size = (image.height, image.width)
+    a = F.interpolate(a, size=size, mode='bilinear', align_corners=False)
+    b = F.interpolate(b, size=size, mode='bilinear', align_corners=False)
+    return guide.mul_(a).add_(b).clamp_(0, 1)[0, 0]
+
+
+def upsample_mask(mask: torch.Tensor, image: Image.Image, mode: str = 'bilinear') -> np.ndarray:
+    """
+    Porta la maschera float alla risoluzione originale e la quantizza una sola volta.
+
+    Args:
+        mask: Maschera (h, w) con valori tra 0 e 1, già senza padding
+        image: Immagine RGB originale
+        mode: Una delle MASK_UPSAMPLE_MODES
+
+    Returns:
+        np.ndarray: Canale alpha uint8 (H, W)
+
+    Raises:
+        ValueError: Se la modalità non è supportata
+    """
+    if mode == 'guided':
+        alpha = guided_upsample(mask, image)
+    elif mode == 'bilinear':
+        alpha = F.interpolate(
+            mask.float().view(1, 1, *mask.shape),
+            size=(image.height, image.width),
+            mode='bilinear',
+            align_corners=False
+        )[0, 0]
+    else:
+        raise ValueError(f"Modalità di upsampling della maschera non supportata: {mode}")
+
+    # Valori già tra 0 e 1: arrotondamento con +0.5 e troncamento
+    return alpha.mul_(255).add_(0.5).to(torch.uint8).numpy()
+
+
+def compose_rgba(image: Image.Image, alpha: np.ndarray) -> Image.Image:
+    """
+    Costruisce l'immagine RGBA in un unico passaggio sull'immagine originale.
+
+    Il canale alpha viene avvolto senza copie e putalpha di PIL espande i
+    pixel RGB in un solo buffer RGBA (più rapido dell'interleaving in NumPy).
+
+    Args:
+        image: Immagine RGB originale (convertita sul posto)
+        alpha: Canale alpha uint8 (H, W)
+
+    Returns:
+        Image.Image: Immagine RGBA
+    """
+    image.putalpha(Image.fromarray(alpha, 'L'))
+    return image
+
+
+def _linear_weights(out_size: int, in_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Indici e pesi dell'interpolazione lineare lungo un asse (come interpolate con align_corners=False)."""
+    source = ((torch.arange(out_size, dtype=torch.float64) + 0.5) * (in_size / out_size) - 0.5).clamp_(min=0)
+    lower = source.floor().long().clamp_(max=in_size - 1)
+    upper = (lower + 1).clamp_(max=in_size - 1)
+    return lower, upper, (source - lower).float()
+
+
+class StripComposite:
+    """
+    Immagine RGBA composta a strisce orizzontali, senza buffer a piena risoluzione.
+
+    La maschera (o, con il guided filter, i suoi coefficienti) resta alla
+    risoluzione del modello: ogni striscia viene interpolata, quantizzata e
+    unita alle righe RGB corrispondenti solo quando l'encoder la richiede.
+    Oltre all'immagine decodificata la memoria di lavoro è di poche righe,
+    qualunque sia la dimensione dell'immagine; la maschera float, il canale
+    alpha e il buffer RGBA a piena risoluzione non esistono mai.
+    """
+
+    mode = 'RGBA'
+
+    def __init__(
+        self,
+        image: Image.Image,
+        mask: torch.Tensor,
+        mode: str = 'bilinear',
+        strip_pixels: int = STRIP_PIXELS,
+        radius: int = 4,
+        eps: float = 1e-3
+    ):
+        """
+        Args:
+            image: Immagine RGB originale
+            mask: Maschera (h, w) con valori tra 0 e 1, già senza padding
+            mode: Una delle MASK_UPSAMPLE_MODES
+            strip_pixels: Pixel per striscia (il numero di righe ne deriva)
+
+        Raises:
+            ValueError: Se la modalità non è supportata
+        """
+        if mode not in MASK_UPSAMPLE_MODES:
+            raise ValueError(f"Modalità di upsampling della maschera non supportata: {mode}")
+        self.image = image
+        self.size = image.size
+        self.width, self.height = image.size
+        self.upsample = mode
+        self.strip_rows = max(1, strip_pixels // self.width)
+
+        height, width = mask.shape
+        if mode == 'guided':
+            # Guida a bassa risoluzione ridotta da PIL, senza la luminanza a piena risoluzione
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                guide_low = torch.from_numpy(np.asarray(
+                    image.resize((width, height), Image.BILINEAR).convert('L')
+                ))
+            guide_low = guide_low.view(1, 1, height, width).float().div_(255)
+            a, b = _guided_coefficients(mask, guide_low, radius, eps)
+            self._maps = torch.cat([a, b], dim=1)[0]
+        else:
+            self._maps = mask.float().view(1, height, width)
+        self._rows = _linear_weights(self.height, height)
+        self._columns = _linear_weights(self.width, width)
+
+    def _alpha(self, top: int, bottom: int, rgb: Optional[np.ndarray]) -> np.ndarray:
+        """Canale alpha uint8 delle righe [top, bottom)."""
+        lower, upper, weight = (values[top:bottom] for values in self._rows)
+        maps = torch.lerp(self._maps[:, lower], self._maps[:, upper], weight.view(1, -1, 1))
+        left, right, weight = self._columns
+        maps = torch.lerp(maps[:, :, left], maps[:, :, right], weight)
+
+        if self.upsample == 'guided':
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                luma = torch.from_numpy(np.asarray(Image.fromarray(rgb).convert('L')))
+            alpha = luma.float().div_(255).mul_(maps[0]).add_(maps[1]).clamp_(0, 1)
+        else:
+            alpha = maps[0]
+        # Valori già tra 0 e 1: arrotondamento con +0.5 e troncamento
+        return alpha.mul_(255).add_(0.5).to(torch.uint8).numpy()
+
+    def strips(self, alpha_only: bool = False) -> Iterator[np.ndarray]:
+        """
+        Genera le strisce dall'alto verso il basso.
+
+        Args:
+            alpha_only: Solo il canale alpha (righe, W) invece di RGBA (righe, W, 4)
+        """
+        need_rgb = not alpha_only or self.upsample == 'guided'
+        for top in range(0, self.height, self.strip_rows):
+            bottom = min(self.height, top + self.strip_rows)
+            rgb = np.asarray(self.image.crop((0, top, self.width, bottom))) if need_rgb else None
+            alpha = self._alpha(top, bottom, rgb)
+            if alpha_only:
+                yield alpha
+                continue
+            rgba = np.empty((bottom - top, self.width, 4), dtype=np.uint8)
+            rgba[..., :3] = rgb
+            rgba[..., 3] = alpha
+            yield rgba
+
+    def to_image(self) -> Image.Image:
+        """Immagine RGBA completa, costruita a strisce (alloca il buffer a piena risoluzione)."""
+        buffer = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        top = 0
+        for strip in self.strips():
+            buffer[top:top + len(strip)] = strip
+            top += len(strip)
+        return Image.fromarray(buffer)
@@ -0,0 +1,168 @@
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+logger = logging.getLogger(__name__)
+
+# Modalità di precisione supportate per l'inferenza su CPU
+PRECISION_MODES = ('fp32', 'int8-dynamic', 'bf16')
+
+
+def bf16_supported() -> bool:
+    """Verifica se la CPU ha istruzioni native per bfloat16 (AVX512-BF16 o AMX)."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def prepare_model(model: torch.nn.Module, mode: str) -> Tuple[torch.nn.Module, Optional[torch.dtype]]:
+    """
+    Prepara il modello per la modalità di precisione richiesta.
+
+    Args:
+        model: Modello fp32 già in modalità eval
+        mode: Una delle PRECISION_MODES
+
+    Returns:
+        tuple: (Modello da usare, dtype per l'autocast oppure None)
+
+    Raises:
+        ValueError: Se la modalità non è supportata su questo sistema
+    """
+    if mode == 'fp32':
+        return model, None
+
+    if mode == 'int8-dynamic':
+        # Quantizza pesi dei layer lineari (backbone transformer) a INT8;
+        # le attivazioni vengono quantizzate dinamicamente a runtime
+        quantized = torch.ao.quantization.quantize_dynamic(
+            model,
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+            inplace=False
+        )
+        return quantized.eval(), None
+
+    if mode == 'bf16':
+        if not bf16_supported():
+            raise ValueError("La CPU non supporta bfloat16 in modo nativo")
+        return model, torch.bfloat16
+
+    raise ValueError(f"Modalità di precisione non supportata: {mode}")
+
+
+def synthetic_parity_images(count: int = 4, size: int = 512) -> List[Image.Image]:
+    """
+    Genera un set deterministico di immagini sintetiche per il controllo di parità.
+
+    Args:
+        count: Numero di immagini
+        size: Lato delle immagini in pixel
+
+    Returns:
+        list: Immagini RGB con soggetti geometrici su sfondi a gradiente
+    """
+    rng = np.random.RandomState(1234)
+    images = []
+    for index in range(count):
+        gradient = np.linspace(0, 255, size, dtype=np.float32)
+        background = np.stack([
+            np.tile(gradient, (size, 1)),
+            np.tile(gradient[:, None], (1, size)),
+            np.full((size, size), 40.0 * index, dtype=np.float32)
+        ], axis=-1)
+        noise = rng.normal(0, 12, background.shape)
+        image = Image.fromarray(np.clip(background + noise, 0, 255).astype(np.uint8))
+
+        draw = ImageDraw.Draw(image)
+        for _ in range(3):
+            x0, y0 = rng.randint(0, size // 2, 2)
+            width, height = rng.randint(size // 6, size // 2, 2)
+            x1, y1 = x0 + width, y0 + height
+            color = tuple(int(c) for c in rng.randint(0, 256, 3))
+            if rng.rand() > 0.5:
+                draw.ellipse([x0, y0, x1, y1], fill=color)
+            else:
+                draw.rectangle([x0, y0, x1, y1], fill=color)
+        images.append(image)
+    return images
+
+
+def load_parity_images(directory: Optional[str] = None, count: int = 4) -> List[Image.Image]:
+    """
+    Carica il set fisso di immagini locali per il controllo di parità.
+
+    Args:
+        directory: Directory con le immagini di riferimento (opzionale)
+        count: Numero massimo di immagini da usare
+
+    Returns:
+        list: Immagini RGB; sintetiche se la directory non è disponibile
+    """
+    images = []
+    if directory and os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if len(images) >= count:
+                break
+            try:
+                with Image.open(os.path.join(directory, name)) as img:
+                    images.append(img.convert('RGB'))
+            except Exception:
+                continue
+
+    if not images:
+        logger.info("Controllo di parità su immagini sintetiche")
+        images = synthetic_parity_images(count)
+    return images
+
+
+def compare_masks(reference: torch.Tensor, candidate: torch.Tensor) -> Dict[str, float]:
+    """
+    Confronta due maschere alpha con valori tra 0 e 1.
+
+    Returns:
+        dict: Errore assoluto medio sull'alpha e IoU delle maschere binarizzate
+    """
+    reference = reference.float()
+    candidate = candidate.float()
+    mae = (reference - candidate).abs().mean().item()
+
+    ref_bin = reference > 0.5
+    cand_bin = candidate > 0.5
+    union = (ref_bin | cand_bin).sum().item()
+    intersection = (ref_bin & cand_bin).sum().item()
+    iou = intersection / union if union else 1.0
+
+    return {'mae': mae, 'iou': iou}
+
+
+def check_parity(
+    reference_predict: Callable[[torch.Tensor], torch.Tensor],
+    candidate_predict: Callable[[torch.Tensor], torch.Tensor],
+    inputs: List[torch.Tensor]
+) -> Dict[str, float]:
+    """
+    Confronta le maschere di una modalità ridotta con il riferimento fp32.
+
+    Args:
+        reference_predict: Predizione di riferimento (fp32)
+        candidate_predict: Predizione in precisione ridotta
+        inputs: Tensori di input già preprocessati
+
+    Returns:
+        dict: Peggior errore assoluto medio e peggior IoU sul set
+    """
+    worst_mae = 0.0
+    worst_iou = 1.0
+    for input_tensor in inputs:
+        metrics = compare_masks(reference_predict(input_tensor), candidate_predict(input_tensor))
+        worst_mae = max(worst_mae, metrics['mae'])
+        worst_iou = min(worst_iou, metrics['iou'])
+    return {'mae': worst_mae, 'iou': worst_iou}
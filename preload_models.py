@@ -2,12 +2,17 @@
 """
 Script per pre-scaricare i modelli HuggingFace durante la build del Docker.
 Questo script viene eseguito solo se è fornito un token HF.
+
+Il primo modello disponibile viene anche salvato come artefatto autonomo
+(config, codice e pesi safetensors) in MODEL_ARTIFACT_DIR.
 """
 
 import os
 import sys
 import torch
 from transformers import AutoModelForImageSegmentation
+from engines import export_onnx
+from model_artifact import save_artifact
 
 def preload_models():
     """Pre-scarica i modelli disponibili con il token HF fornito."""
@@ -22,6 +27,13 @@ def preload_models():
     device = "cpu"  # Forza CPU durante il build
     models_loaded = 0
     
+    # Export ONNX del modello preferito (opzionale), riusato dal backend onnx
+    export_onnx_model = os.getenv("EXPORT_ONNX", "false").lower() == "true"
+    onnx_model_path = os.getenv("ONNX_MODEL_PATH", "/app/.cache/onnx/model.onnx")
+    
+    # Artefatto autonomo del modello preferito, caricato all'avvio con i pesi mappati
+    model_artifact_dir = os.getenv("MODEL_ARTIFACT_DIR", "/app/.cache/model-artifact")
+    
     print("🚀 Inizio pre-download dei modelli HuggingFace...")
     
     for model_name in models_to_try:
@@ -39,6 +51,24 @@ def preload_models():
             print(f"✅ {model_name} scaricato con successo")
             models_loaded += 1
             
+            # Artefatto solo per il primo modello disponibile, quello usato dal servizio
+            if model_artifact_dir and models_loaded == 1:
+                try:
+                    print(f"📦 Artefatto di {model_name} in {model_artifact_dir}")
+                    save_artifact(model.eval(), model_name, model_artifact_dir)
+                    print("✅ Artefatto del modello salvato")
+                except Exception as e:
+                    print(f"⚠️  Artefatto del modello non salvato: {str(e)[:100]}...")
+            
+            # Esporta solo il primo modello disponibile, quello usato dal servizio
+            if export_onnx_model and models_loaded == 1:
+                try:
+                    print(f"📦 Export ONNX di {model_name} in {onnx_model_path}")
+                    export_onnx(model.eval(), onnx_model_path, model_name)
+                    print("✅ Export ONNX completato")
+                except Exception as e:
+                    print(f"⚠️  Export ONNX fallito: {str(e)[:100]}...")
+            
             # Per risparmiare spazio, non carichiamo tutti i modelli in memoria
             del model
             
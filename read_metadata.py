@@ -5,10 +5,12 @@ Script per leggere e visualizzare i metadata di un'immagine processata.
 
 import sys
 import json
+import re
+import html
 from PIL import Image
 
 def read_metadata(image_path):
-    """Legge e visualizza i metadata di un'immagine PNG."""
+    """Legge e visualizza i metadata di un'immagine PNG o WebP."""
     try:
         with Image.open(image_path) as img:
             print(f"📄 File: {image_path}")
@@ -61,6 +63,22 @@ def read_metadata(image_path):
                             value = value[:100] + "..."
                         print(f"   {key}: {value}")
                 
+            elif 'xmp' in img.info:
+                # WebP: metadata JSON nel pacchetto XMP
+                xmp = img.info['xmp']
+                xmp = xmp.decode('utf-8') if isinstance(xmp, bytes) else xmp
+                match = re.search(r'<removebg:ProcessingInfo>(.*?)</removebg:ProcessingInfo>', xmp, re.S)
+                if match:
+                    print("\n🔧 METADATA XMP:")
+                    print("-" * 40)
+                    try:
+                        json_data = json.loads(html.unescape(match.group(1)))
+                        print(json.dumps(json_data, indent=2, ensure_ascii=False))
+                    except json.JSONDecodeError as e:
+                        print(f"❌ Errore parsing JSON: {e}")
+                else:
+                    print("\n⚠️  Nessun metadata RemoveBG nel pacchetto XMP")
+
             else:
                 print("\n⚠️  Nessun metadata trovato nell'immagine")
                 
@@ -0,0 +1,372 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizza un URL per usarlo come chiave di cache.
+
+    Schema e host in minuscolo, porta di default rimossa, frammento rimosso
+    e parametri della query ordinati.
+
+    Args:
+        url: URL da normalizzare
+
+    Returns:
+        str: URL normalizzato
+    """
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    if parsed.port and not (
+        (scheme == 'http' and parsed.port == 80) or
+        (scheme == 'https' and parsed.port == 443)
+    ):
+        netloc = f"{netloc}:{parsed.port}"
+    if parsed.username:
+        credentials = parsed.username
+        if parsed.password:
+            credentials += f":{parsed.password}"
+        netloc = f"{credentials}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((scheme, netloc, parsed.path or '/', parsed.params, query, ''))
+
+
+class ResultCache:
+    """
+    Cache dei risultati indirizzata per contenuto.
+
+    I risultati sono indicizzati dall'hash dei byte scaricati (più una variante
+    che identifica modello e parametri di processamento). Un LRU in memoria
+    limitato in byte sta davanti a un livello su disco persistente con un
+    proprio budget ed eviction. Un indice separato associa l'URL normalizzato
+    alla chiave di contenuto, così un hit sull'URL evita anche il download.
+    """
+
+    def __init__(
+        self,
+        memory_max_bytes: int = 128 * 1024 * 1024,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 1024 * 1024 * 1024,
+        url_ttl: float = 3600.0,
+        url_index_size: int = 10000
+    ):
+        self.memory_max_bytes = max(memory_max_bytes, 0)
+        self.disk_dir: Optional[str] = None
+        self.disk_max_bytes = 0
+        self.url_ttl = url_ttl
+        self.url_index_size = url_index_size
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+        self._stats = {
+            'url_hits': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'evictions_memory': 0,
+            'evictions_disk': 0,
+        }
+
+        if disk_dir:
+            self.attach_disk(disk_dir, disk_max_bytes)
+
+    def attach_disk(self, disk_dir: str, disk_max_bytes: int) -> None:
+        """
+        Imposta directory e budget del livello su disco e ne carica l'indice.
+
+        Indice LRU e conteggio dei byte sono del singolo processo: con più
+        worker ognuno deve usare una propria directory con una quota del
+        budget, altrimenti ciascuno rimuoverebbe solo i file che conosce e il
+        disco arriverebbe a un multiplo del budget.
+
+        Args:
+            disk_dir: Directory riservata a questo processo
+            disk_max_bytes: Budget in byte (0 = livello su disco disattivo)
+        """
+        with self._lock:
+            self.disk_dir = disk_dir
+            self.disk_max_bytes = max(disk_max_bytes, 0)
+            self._disk = OrderedDict()
+            self._disk_bytes = 0
+        if self.disk_max_bytes > 0:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(data: bytes, variant: str) -> str:
+        """
+        Calcola la chiave di cache per il contenuto scaricato.
+
+        Args:
+            data: Byte dell'immagine sorgente
+            variant: Identificativo di modello e parametri di processamento
+
+        Returns:
+            str: Chiave esadecimale (usata anche come ETag)
+        """
+        digest = hashlib.sha256()
+        digest.update(variant.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key_for_file(path: str, variant: str) -> str:
+        """
+        Calcola la chiave di cache leggendo il file a blocchi.
+
+        Args:
+            path: Percorso dell'immagine sorgente
+            variant: Identificativo di modello e parametri di processamento
+
+        Returns:
+            str: Chiave esadecimale
+        """
+        digest = hashlib.sha256()
+        digest.update(variant.encode('utf-8'))
+        digest.update(b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup_url(self, url: str, variant: str) -> Optional[str]:
+        """
+        Restituisce la chiave di contenuto associata a un URL, se ancora valida.
+
+        Args:
+            url: URL dell'immagine sorgente
+            variant: Identificativo di modello e parametri di processamento
+
+        Returns:
+            Optional[str]: Chiave di cache o None
+        """
+        url_key = f"{variant}|{normalize_url(url)}"
+        with self._lock:
+            entry = self._urls.get(url_key)
+            if entry is None:
+                return None
+            key, stored_at = entry
+            if time.monotonic() - stored_at > self.url_ttl:
+                del self._urls[url_key]
+                return None
+            self._urls.move_to_end(url_key)
+            return key
+
+    def link_url(self, url: str, variant: str, key: str) -> None:
+        """Associa un URL normalizzato a una chiave di contenuto."""
+        url_key = f"{variant}|{normalize_url(url)}"
+        with self._lock:
+            self._urls[url_key] = (key, time.monotonic())
+            self._urls.move_to_end(url_key)
+            while len(self._urls) > self.url_index_size:
+                self._urls.popitem(last=False)
+
+    def get_by_url(self, url: str, variant: str) -> Optional[Tuple[bytes, str]]:
+        """
+        Cerca un risultato partendo dall'URL, senza scaricare l'immagine.
+
+        Returns:
+            Optional[tuple]: (Dati del risultato, chiave) oppure None
+        """
+        key = self.lookup_url(url, variant)
+        if key is None:
+            return None
+        data = self._get(key)
+        if data is None:
+            return None
+        with self._lock:
+            self._stats['url_hits'] += 1
+        return data, key
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Cerca un risultato per chiave di contenuto (memoria, poi disco).
+
+        Args:
+            key: Chiave di cache
+
+        Returns:
+            Optional[bytes]: Dati del risultato o None
+        """
+        data = self._get(key, count=True)
+        if data is None:
+            with self._lock:
+                self._stats['misses'] += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Memorizza un risultato in entrambi i livelli.
+
+        Args:
+            key: Chiave di cache
+            data: Dati del risultato
+        """
+        self._put_memory(key, data)
+        self._put_disk(key, data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Restituisce le statistiche di hit/miss e occupazione."""
+        with self._lock:
+            stats = dict(self._stats)
+            hits = stats['url_hits'] + stats['memory_hits'] + stats['disk_hits']
+            lookups = hits + stats['misses']
+            stats.update({
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'memory_max_bytes': self.memory_max_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'disk_max_bytes': self.disk_max_bytes,
+                'url_entries': len(self._urls),
+            })
+        return stats
+
+    def _get(self, key: str, count: bool = False) -> Optional[bytes]:
+        """Lettura interna con promozione dal disco alla memoria."""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                if count:
+                    self._stats['memory_hits'] += 1
+                return data
+            on_disk = key in self._disk
+
+        if not on_disk:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_bytes -= size
+            return None
+
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            if count:
+                self._stats['disk_hits'] += 1
+        self._put_memory(key, data)
+        return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        """Inserisce nel LRU in memoria rispettando il budget in byte."""
+        size = len(data)
+        if size > self.memory_max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self._stats['evictions_memory'] += 1
+
+    def _put_disk(self, key: str, data: bytes) -> None:
+        """Scrive sul livello su disco rispettando il budget in byte."""
+        size = len(data)
+        if not self.disk_dir or size > self.disk_max_bytes:
+            return
+        with self._lock:
+            if key in self._disk:
+                return
+
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Impossibile scrivere la cache su disco: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk[key] = size
+            self._disk_bytes += size
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                old_key, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                self._stats['evictions_disk'] += 1
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def _disk_path(self, key: str) -> str:
+        """Percorso del file su disco per una chiave."""
+        return os.path.join(self.disk_dir, key[:2], f"{key}.bin")
+
+    def _load_disk_index(self) -> None:
+        """Ricostruisce l'indice del livello su disco in ordine di ultimo accesso."""
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                # Solo i file di questa directory (non quelli di eventuali sottodirectory dei worker)
+                if not name.endswith('.bin') or path != self._disk_path(name[:-len('.bin')]):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name[:-len('.bin')], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+        # Il budget potrebbe essere stato ridotto dall'ultimo avvio
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            old_key, old_size = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+        logger.info(
+            f"Cache su disco caricata: {len(self._disk)} risultati, "
+            f"{self._disk_bytes / (1024 * 1024):.1f} MB"
+        )
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Deduplica le richieste concorrenti identiche.
+
+    La prima richiesta per una chiave esegue il lavoro; le richieste identiche
+    che arrivano mentre è in corso attendono lo stesso risultato (o la stessa
+    eccezione). Il lavoro gira in un task separato, così la disconnessione del
+    primo client non annulla il risultato per gli altri; viene annullato solo
+    quando se ne vanno tutti i client in attesa. Il task eredita una copia del
+    contesto della prima chiamata: `func` deve rimuovere lo stato legato a
+    quella sola richiesta (es. la scadenza).
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Esegue `func` una sola volta per le chiamate concorrenti con la stessa chiave.
+
+        Args:
+            key: Chiave che identifica il lavoro
+            func: Funzione che restituisce la coroutine da eseguire
+
+        Returns:
+            Il risultato condiviso del lavoro
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            logger.debug(f"Richiesta accodata a un lavoro già in corso: {key}")
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(task) == 1 and not task.done():
+                # Nessun altro attende il risultato: il lavoro non serve più
+                task.cancel()
+            raise
+        finally:
+            remaining = self._waiters.pop(task, 1) - 1
+            if remaining > 0:
+                self._waiters[task] = remaining
+
+    def in_flight(self) -> int:
+        """Numero di lavori distinti attualmente in corso."""
+        return len(self._calls)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        """Rimuove il lavoro completato, senza memorizzarne il risultato."""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Evita il warning se tutti i client in attesa si sono disconnessi
+        if not task.cancelled():
+            task.exception()
@@ -3,6 +3,7 @@
 Test script per l'API Remove Background
 """
 import requests
+import time
 import sys
 import os
 
@@ -32,6 +33,17 @@ def test_api():
         print(f"   ❌ Errore nella connessione: {e}")
         return False
     
+    # Il modello viene caricato in background dopo l'avvio
+    print("   ⏳ Attesa del caricamento del modello...")
+    for _ in range(120):
+        if requests.get(f"{base_url}/ready").status_code == 200:
+            print("   ✅ Modello pronto")
+            break
+        time.sleep(1)
+    else:
+        print("   ❌ Modello non pronto dopo 120 secondi")
+        return False
+    
     # Test 2: Endpoint senza API key
     print("2. Test senza API key...")
     try:
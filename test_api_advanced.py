@@ -23,7 +23,13 @@ def test_api_connection():
         response = requests.get(f"{API_BASE_URL}/health")
         if response.status_code == 200:
             print("✅ API raggiungibile")
-            return True
+            # Il modello viene caricato in background dopo l'avvio
+            for _ in range(120):
+                if requests.get(f"{API_BASE_URL}/ready").status_code == 200:
+                    return True
+                time.sleep(1)
+            print("❌ Modello non pronto dopo 120 secondi")
+            return False
         else:
             print(f"❌ API non risponde: {response.status_code}")
             return False
@@ -72,6 +78,43 @@ def test_background_removal():
         print(f"❌ Errore richiesta: {e}")
         return False
 
+def test_upload():
+    """Test upload diretto dell'immagine (multipart e corpo grezzo)."""
+    print("\n📤 Test upload diretto...")
+    
+    try:
+        source = requests.get(TEST_IMAGE_URL, timeout=30)
+        source.raise_for_status()
+        
+        response = requests.post(
+            f"{API_BASE_URL}/remove-background/upload",
+            files={"file": ("test.jpg", source.content, "image/jpeg")},
+            headers={"X-API-Key": API_KEY},
+            timeout=60
+        )
+        if response.status_code == 200 and response.content.startswith(b'\x89PNG'):
+            print("✅ Upload multipart processato correttamente")
+        else:
+            print(f"❌ Upload multipart fallito: {response.status_code}")
+            return False
+        
+        response = requests.post(
+            f"{API_BASE_URL}/remove-background/raw",
+            data=source.content,
+            headers={"X-API-Key": API_KEY, "Content-Type": "image/jpeg"},
+            timeout=60
+        )
+        if response.status_code == 200 and response.content.startswith(b'\x89PNG'):
+            print("✅ Upload grezzo processato correttamente")
+            return True
+        else:
+            print(f"❌ Upload grezzo fallito: {response.status_code}")
+            return False
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Errore richiesta: {e}")
+        return False
+
 def verify_metadata(image_path):
     """Verifica i metadata nell'immagine processata."""
     try:
@@ -173,6 +216,9 @@ def main():
     # Test funzionalità principale
     success = test_background_removal()
     
+    # Test upload diretto
+    success = test_upload() and success
+    
     # Test casi edge
     test_invalid_requests()
     
@@ -0,0 +1,178 @@
+import asyncio
+import contextvars
+
+import pytest
+
+import admission
+from admission import (
+    AdmissionController,
+    CancelOnDisconnect,
+    DeadlineExceeded,
+    InFlightLimited,
+    Overloaded,
+    QueueFullError,
+    RateLimited,
+    current_budget,
+)
+from image_processor import ImageProcessor
+from inference_executor import InferenceExecutor
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize("retry_after,header", [(0.0, "1"), (0.2, "1"), (1.0, "1"), (2.1, "3")])
+def test_retry_after_header_is_a_positive_integer(retry_after, header):
+    assert Overloaded("x", retry_after=retry_after).retry_after_header == header
+
+
+def test_status_codes():
+    assert QueueFullError("x").status_code == 503
+    assert DeadlineExceeded("x").status_code == 503
+    assert RateLimited("x").status_code == 429
+    assert InFlightLimited("x").status_code == 429
+
+
+def test_in_flight_limit_per_key():
+    controller = AdmissionController(max_in_flight_per_key=2)
+    controller.admit("a")
+    controller.admit("a")
+    with pytest.raises(InFlightLimited):
+        controller.admit("a")
+    # Le altre chiavi non sono influenzate
+    controller.admit("b")
+
+    controller.release("a")
+    controller.admit("a")
+
+
+def test_rate_limit_with_burst(clock):
+    controller = AdmissionController(rate_per_key=2, burst=3)
+    for _ in range(3):
+        controller.admit("a")
+        controller.release("a")
+    with pytest.raises(RateLimited) as error:
+        controller.admit("a")
+    assert error.value.retry_after == pytest.approx(0.5)
+    assert error.value.retry_after_header == "1"
+
+    clock[0] += 0.5
+    controller.admit("a")
+
+
+def test_rejected_request_does_not_hold_a_slot(clock):
+    controller = AdmissionController(max_in_flight_per_key=1, rate_per_key=1, burst=1)
+    controller.admit("a")
+    controller.release("a")
+    with pytest.raises(RateLimited):
+        controller.admit("a")
+    clock[0] += 1
+    controller.admit("a")
+
+
+def test_deadline_is_set_in_the_request_context(clock):
+    controller = AdmissionController(deadline_seconds=5)
+
+    def admitted(deadline):
+        controller.admit("a", deadline=deadline)
+        return current_budget()
+
+    budget = contextvars.copy_context().run(admitted, True)
+    assert budget.remaining == pytest.approx(5)
+    assert not budget.expired
+    clock[0] += 5
+    assert budget.expired
+
+    assert contextvars.copy_context().run(admitted, False) is None
+    assert current_budget() is None
+
+
+def make_executor(tmp_path, workers=1, max_queue=1):
+    processor = ImageProcessor(temp_dir=str(tmp_path), load_model=False)
+    return InferenceExecutor(processor, workers=workers, coalesce=False, max_queue=max_queue)
+
+
+def test_executor_rejects_beyond_lanes_and_queue(tmp_path):
+    executor = make_executor(tmp_path, workers=2, max_queue=1)
+    for _ in range(3):
+        executor.reserve()
+    with pytest.raises(QueueFullError) as error:
+        executor.reserve()
+    # Un lavoro in attesa più quello nuovo, su due corsie (1s senza misure)
+    assert error.value.retry_after == pytest.approx(1.0)
+
+    executor.release()
+    executor.reserve()
+    assert executor.admitted == 3
+
+
+def test_executor_drops_expired_work(tmp_path):
+    executor = make_executor(tmp_path)
+    controller = AdmissionController(deadline_seconds=0.01)
+
+    async def scenario():
+        controller.admit("a")
+        await asyncio.sleep(0.02)
+        return await executor.run(lambda: "eseguito")
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(scenario())
+
+
+async def call_app(app, messages):
+    """Esegue un'applicazione ASGI con i messaggi di `receive` indicati."""
+    sent = []
+    pending = list(messages)
+
+    async def receive():
+        if pending:
+            return pending.pop(0)
+        await asyncio.sleep(10)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'path': '/test', 'headers': [(b'content-length', b'4')]}
+    await app(scope, receive, send)
+    return sent
+
+
+def test_cancel_on_disconnect_cancels_the_handler():
+    cancelled = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await receive()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def scenario():
+        messages = [
+            {'type': 'http.request', 'body': b'data', 'more_body': False},
+            {'type': 'http.disconnect'},
+        ]
+        await asyncio.wait_for(call_app(CancelOnDisconnect(slow_app), messages), 1)
+        return cancelled.is_set()
+
+    assert asyncio.run(scenario())
+
+
+def test_cancel_on_disconnect_passes_through_normal_requests():
+    async def echo_app(scope, receive, send):
+        message = await receive()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': message['body']})
+
+    async def scenario():
+        messages = [{'type': 'http.request', 'body': b'data', 'more_body': False}]
+        return await asyncio.wait_for(call_app(CancelOnDisconnect(echo_app), messages), 1)
+
+    sent = asyncio.run(scenario())
+    assert sent[0]['status'] == 200
+    assert sent[1]['body'] == b'data'
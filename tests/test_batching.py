@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from batching import MicroBatcher
+
+
+def submit_all(batcher, tensors):
+    """Invia i tensori da thread diversi, come le richieste concorrenti."""
+    with ThreadPoolExecutor(max_workers=len(tensors)) as pool:
+        return list(pool.map(batcher.submit, tensors))
+
+
+def test_batches_same_shape_and_splits_results():
+    batches = []
+    lock = threading.Lock()
+
+    def predict(batch):
+        with lock:
+            batches.append(tuple(batch.shape))
+        # Ogni elemento restituisce il proprio valore: verifica la separazione
+        return batch[:, :1] * 2
+
+    batcher = MicroBatcher(predict, max_batch_size=4, max_wait_ms=200)
+    tensors = [torch.full((1, 3, 8, 8), float(i)) for i in range(4)]
+    results = submit_all(batcher, tensors)
+
+    for i, result in enumerate(results):
+        assert result.shape == (1, 1, 8, 8)
+        assert torch.all(result == 2 * i)
+    assert sum(shape[0] for shape in batches) == 4
+    assert max(shape[0] for shape in batches) > 1
+
+
+def test_groups_by_shape():
+    batches = []
+    lock = threading.Lock()
+
+    def predict(batch):
+        with lock:
+            batches.append(tuple(batch.shape))
+        return batch[:, :1]
+
+    batcher = MicroBatcher(predict, max_batch_size=4, max_wait_ms=200)
+    tensors = [torch.zeros(1, 3, 8, 8), torch.zeros(1, 3, 16, 16), torch.zeros(1, 3, 8, 8), torch.zeros(1, 3, 16, 16)]
+    results = submit_all(batcher, tensors)
+
+    assert [tuple(r.shape[-2:]) for r in results] == [(8, 8), (16, 16), (8, 8), (16, 16)]
+    # Mai forme diverse nello stesso forward pass
+    assert all(shape[1:] in ((3, 8, 8), (3, 16, 16)) for shape in batches)
+
+
+def test_error_reaches_every_request_of_the_batch():
+    def predict(batch):
+        raise RuntimeError("forward fallito")
+
+    batcher = MicroBatcher(predict, max_batch_size=2, max_wait_ms=200)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(batcher.submit, torch.zeros(1, 3, 4, 4)) for _ in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="forward fallito"):
+                future.result()
+
+
+def test_rejects_invalid_batch_size():
+    with pytest.raises(ValueError):
+        MicroBatcher(lambda batch: batch, max_batch_size=0)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from downloader import AsyncImageDownloader
+from image_processor import ImageProcessor
+
+URL = "https://example.com/image.png"
+
+
+def make_downloader(tmp_path, handler, max_download_bytes=1000, spill_threshold_bytes=None):
+    processor = ImageProcessor(
+        temp_dir=str(tmp_path),
+        max_download_bytes=max_download_bytes,
+        spill_threshold_bytes=spill_threshold_bytes,
+        load_model=False
+    )
+    downloader = AsyncImageDownloader(processor)
+    downloader._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return downloader
+
+
+def download(downloader):
+    async def scenario():
+        try:
+            return await downloader.download(URL)
+        finally:
+            await downloader.aclose()
+
+    return asyncio.run(scenario())
+
+
+def chunked(size, chunk=100):
+    async def body():
+        for start in range(0, size, chunk):
+            yield b"x" * min(chunk, size - start)
+
+    return body()
+
+
+def test_download_within_the_limit(tmp_path):
+    downloader = make_downloader(
+        tmp_path, lambda request: httpx.Response(200, headers={"content-type": "image/png"}, content=b"x" * 1000)
+    )
+    assert download(downloader) == b"x" * 1000
+
+
+def test_declared_length_over_the_limit_is_rejected_before_reading(tmp_path):
+    def handler(request):
+        return httpx.Response(
+            200,
+            headers={"content-type": "image/png", "content-length": "1000000"},
+            content=chunked(1_000_000)
+        )
+
+    with pytest.raises(ValueError, match="troppo grande"):
+        download(make_downloader(tmp_path, handler))
+
+
+@pytest.mark.parametrize("spill_threshold_bytes", [None, 300])
+def test_streamed_body_over_the_limit_is_interrupted(tmp_path, spill_threshold_bytes):
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "image/png"}, content=chunked(5000))
+
+    downloader = make_downloader(tmp_path, handler, spill_threshold_bytes=spill_threshold_bytes)
+    with pytest.raises(ValueError, match="troppo grande"):
+        download(downloader)
+    # Nessuno spill su disco lasciato indietro
+    assert os.listdir(tmp_path) == []
+
+
+def test_no_limit(tmp_path):
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "image/png"}, content=chunked(5000))
+
+    assert len(download(make_downloader(tmp_path, handler, max_download_bytes=None))) == 5000
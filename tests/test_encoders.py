@@ -0,0 +1,88 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, PngImagePlugin
+
+from encoders import OutputFormat, encode, negotiate_format
+from image_processor import ImageProcessor
+
+
+@pytest.mark.parametrize("accept,expected", [
+    (None, None),
+    ("", None),
+    ("*/*", None),
+    ("image/webp,*/*", 'webp'),
+    ("image/png", 'png'),
+    ("image/png;q=0.9, image/webp;q=0.8", 'png'),
+    ("image/png;q=0.8, IMAGE/WEBP", 'webp'),
+    ("image/webp;q=0, image/png;q=0.5", 'png'),
+    ("image/webp;q=abc", None),
+])
+def test_negotiate_format(accept, expected):
+    assert negotiate_format(accept) == expected
+
+
+def test_output_format_validation():
+    with pytest.raises(ValueError, match="Formato di output non supportato"):
+        OutputFormat('jpeg')
+    with pytest.raises(ValueError):
+        OutputFormat('png', compress_level=10)
+    with pytest.raises(ValueError):
+        OutputFormat('webp', quality=101)
+
+
+def test_variant_only_includes_parameters_that_change_the_bytes():
+    assert OutputFormat('png', compress_level=1).variant() == 'png:z1'
+    assert OutputFormat('mask', compress_level=6).variant() == 'mask:z6'
+    assert OutputFormat('webp', quality=80).variant() == 'webp:q80:m4'
+    assert OutputFormat('webp-lossless').variant() == 'webp-lossless:q90:m4'
+    # La qualità non cambia un PNG, il livello zlib non cambia un WebP
+    assert OutputFormat('png', quality=10).variant() == OutputFormat('png', quality=90).variant()
+    assert OutputFormat('webp', compress_level=1).variant() == OutputFormat('webp', compress_level=9).variant()
+
+
+def test_media_types_and_extensions():
+    assert (OutputFormat('mask').media_type, OutputFormat('mask').extension) == ('image/png', 'png')
+    assert (OutputFormat('webp-lossless').media_type, OutputFormat('webp-lossless').extension) == ('image/webp', 'webp')
+
+
+def test_request_format_precedence(tmp_path):
+    processor = ImageProcessor(temp_dir=str(tmp_path), output_format='png', png_compress_level=3, load_model=False)
+    assert processor.output_format().variant() == 'png:z3'
+    assert processor.output_format(accept="image/webp").name == 'webp'
+    assert processor.output_format(name=" MASK ", accept="image/webp").name == 'mask'
+    assert processor.output_format(compress_level=9).variant() == 'png:z9'
+    with pytest.raises(ValueError):
+        processor.output_format(name='gif')
+
+
+def rgba_image():
+    pixels = np.zeros((40, 60, 4), dtype=np.uint8)
+    pixels[..., 0] = np.arange(60, dtype=np.uint8)
+    pixels[..., 3] = np.linspace(0, 255, 40, dtype=np.uint8)[:, None]
+    return Image.fromarray(pixels)
+
+
+def test_png_and_mask_round_trip_with_metadata():
+    image = rgba_image()
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Source URL", "https://example.com/a.jpg")
+
+    png = Image.open(io.BytesIO(encode(image, OutputFormat('png'), pnginfo=info)))
+    assert png.mode == 'RGBA'
+    assert np.array_equal(np.asarray(png), np.asarray(image))
+    assert png.info['Source URL'] == "https://example.com/a.jpg"
+
+    mask = Image.open(io.BytesIO(encode(image, OutputFormat('mask'), pnginfo=info)))
+    assert mask.mode == 'L'
+    assert np.array_equal(np.asarray(mask), np.asarray(image.getchannel('A')))
+
+
+def test_webp_lossless_keeps_alpha_and_writes_xmp():
+    image = rgba_image()
+    data = encode(image, OutputFormat('webp-lossless'), metadata={"processing": {"model": "test"}})
+    decoded = Image.open(io.BytesIO(data))
+    assert decoded.format == 'WEBP'
+    assert np.array_equal(np.asarray(decoded.getchannel('A')), np.asarray(image.getchannel('A')))
+    assert b'"model":"test"' in data.replace(b'&quot;', b'"')
@@ -0,0 +1,206 @@
+import asyncio
+
+import pytest
+
+import jobs
+from admission import QueueFullError
+from jobs import JobRunner, JobStore, job_status
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(jobs.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    store = JobStore(str(tmp_path / "jobs.db"), result_ttl=60, lease_seconds=10, max_attempts=2)
+    store.open()
+    yield store
+    store.close()
+
+
+def submit(store, owner="alice", data=b"image"):
+    return store.submit(owner, "foto.jpg", {"resolution": "preview"}, data=data)
+
+
+def test_submit_and_claim(store):
+    job = submit(store)
+    assert job['status'] == 'queued'
+    assert store.queued() == 1
+
+    claimed = store.claim("w1")
+    assert claimed['id'] == job['id']
+    assert claimed['attempts'] == 1
+    assert claimed['input'] == b"image"
+    assert claimed['options'] == {"resolution": "preview"}
+    assert store.get(job['id'], "alice")['status'] == 'running'
+    assert store.claim("w2") is None
+
+
+def test_claim_in_submission_order(store, clock):
+    first = submit(store)
+    clock[0] += 1
+    second = submit(store)
+    assert store.claim("w1")['id'] == first['id']
+    assert store.claim("w1")['id'] == second['id']
+
+
+def test_expired_lease_is_reclaimed(store, clock):
+    job = submit(store)
+    store.claim("w1")
+    clock[0] += 5
+    store.heartbeat(job['id'], "w1")
+    clock[0] += 9
+    assert store.claim("w2") is None
+
+    clock[0] += 2
+    reclaimed = store.claim("w2")
+    assert reclaimed['id'] == job['id']
+    assert reclaimed['attempts'] == 2
+    # Il worker originale non può più concludere il lavoro
+    store.complete(job['id'], "w1", b"result", {})
+    assert store.get(job['id'], "alice")['status'] == 'running'
+
+
+def test_lease_expired_too_many_times_fails(store, clock):
+    job = submit(store)
+    store.claim("w1")
+    clock[0] += 11
+    store.claim("w2")
+    clock[0] += 11
+    assert store.claim("w3") is None
+
+    failed = store.get(job['id'], "alice")
+    assert failed['status'] == 'failed'
+    assert failed['status_code'] == 500
+
+
+def test_retry_backs_off_then_fails(store, clock):
+    job = submit(store)
+    store.claim("w1")
+    assert store.fail(job['id'], "w1", 502, "Sorgente non raggiungibile", retry=True)
+    assert store.get(job['id'], "alice")['status'] == 'queued'
+
+    # Backoff dopo il primo tentativo: 1 << 2 secondi
+    clock[0] += 3
+    assert store.claim("w1") is None
+    clock[0] += 1
+    assert store.claim("w1")['attempts'] == 2
+
+    # Tentativi esauriti: il lavoro fallisce anche se il ritento è richiesto
+    assert not store.fail(job['id'], "w1", 502, "Sorgente non raggiungibile", retry=True)
+    failed = store.get(job['id'], "alice")
+    assert failed['status'] == 'failed'
+    assert failed['status_code'] == 502
+    assert failed['expires_at'] == pytest.approx(clock[0] + 60)
+
+
+def test_postpone_keeps_the_attempt(store, clock):
+    job = submit(store)
+    for _ in range(5):
+        claimed = store.claim("w1")
+        assert claimed['attempts'] == 1
+        store.postpone(job['id'], "w1", 2)
+        assert store.claim("w1") is None
+        clock[0] += 2
+
+
+def test_requeue_releases_worker_jobs(store):
+    job = submit(store)
+    submit(store)
+    store.claim("w1")
+    store.claim("w2")
+    assert store.requeue("w1") == 1
+
+    requeued = store.claim("w3")
+    assert requeued['id'] == job['id']
+    assert requeued['attempts'] == 1
+
+
+def test_complete_and_result(store):
+    job = submit(store)
+    store.claim("w1")
+    store.complete(job['id'], "w1", b"png", {"content_type": "image/png", "etag": '"x"', "extra": 1})
+
+    done = store.get(job['id'], "alice")
+    assert done['status'] == 'succeeded'
+    assert done['result_info'] == {"content_type": "image/png", "extension": None, "etag": '"x"'}
+    assert store.result(job['id'], "alice") == b"png"
+
+
+def test_owner_isolation(store):
+    job = submit(store)
+    assert store.get(job['id'], "bob") is None
+    assert store.result(job['id'], "bob") is None
+    assert not store.delete(job['id'], "bob")
+    assert store.delete(job['id'], "alice")
+    assert store.get(job['id'], "alice") is None
+
+
+def test_running_job_cannot_be_deleted(store):
+    job = submit(store)
+    store.claim("w1")
+    assert not store.delete(job['id'], "alice")
+
+
+def test_purge_expired(store, clock):
+    done = submit(store)
+    store.claim("w1")
+    store.complete(done['id'], "w1", b"png", {})
+    pending = submit(store)
+
+    clock[0] += 59
+    assert store.purge_expired() == 0
+    clock[0] += 1
+    assert store.get(done['id'], "alice") is None
+    assert store.result(done['id'], "alice") is None
+    assert store.purge_expired() == 1
+    assert store.get(pending['id'], "alice")['status'] == 'queued'
+
+
+def test_purge_keeps_pending_webhooks(store, clock):
+    job = store.submit("alice", "foto.jpg", {}, data=b"image", callback_url="https://example.com/hook")
+    store.claim("w1")
+    store.complete(job['id'], "w1", b"png", {})
+    clock[0] += 61
+    assert store.purge_expired() == 0
+
+
+def test_job_status(store):
+    job = submit(store)
+    store.claim("w1")
+    store.fail(job['id'], "w1", 422, "Immagine non valida")
+
+    status = job_status(store.get(job['id'], "alice"))
+    assert status['status'] == 'failed'
+    assert status['status_code'] == 422
+    assert status['error'] == "Immagine non valida"
+    assert status['status_url'] == f"/jobs/{job['id']}"
+    assert 'result_url' not in status
+    assert 'webhook' not in status
+
+
+class FakeExecutor:
+    """Corsie sempre piene: reserve rifiuta ogni lavoro."""
+
+    def reserve(self):
+        raise QueueFullError("Servizio sovraccarico", retry_after=0.01)
+
+
+def test_runner_postpones_jobs_when_the_queue_is_full(store, clock):
+    runner = JobRunner(store, FakeExecutor(), poll_interval=0.01)
+    job = submit(store)
+
+    async def scenario():
+        for _ in range(3):
+            await runner._run(store.claim("w1"))
+            clock[0] += 1
+
+    runner.worker = "w1"
+    asyncio.run(scenario())
+    postponed = store.get(job['id'], "alice")
+    assert postponed['status'] == 'queued'
+    assert postponed['attempts'] == 0
@@ -0,0 +1,109 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from engines import InferenceEngine
+from image_processor import ImageProcessor
+
+
+class ContentEngine(InferenceEngine):
+    """Maschera 1 dove l'input contiene l'immagine, 0 sul bordo del letterbox."""
+
+    name = 'content'
+
+    def predict(self, input_tensor):
+        return (input_tensor[:, :1] != 0).float()
+
+
+def make_processor(tmp_path, **options):
+    processor = ImageProcessor(
+        temp_dir=str(tmp_path),
+        inference_backend='stub',
+        stub_options={'cost_ms': 0},
+        warmup_enabled=False,
+        **options
+    )
+    processor.load()
+    return processor
+
+
+def encoded(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def test_resolution_spec(tmp_path):
+    processor = ImageProcessor(temp_dir=str(tmp_path), inference_resolution=768, load_model=False)
+    assert processor.resolution_spec(None) == '768'
+    assert processor.resolution_spec(' AUTO ') == 'auto'
+    assert processor.resolution_spec('0512') == '512'
+    with pytest.raises(ValueError, match="Risoluzione non supportata"):
+        processor.resolution_spec('640')
+
+
+def test_custom_default_resolution_is_allowed(tmp_path):
+    processor = ImageProcessor(temp_dir=str(tmp_path), inference_resolution=640, load_model=False)
+    assert 640 in processor.resolutions
+    assert processor.resolution_spec('640') == '640'
+
+
+@pytest.mark.parametrize("size,expected", [((300, 200), 512), ((700, 500), 768), ((4000, 3000), 1024)])
+def test_auto_resolution_picks_smallest_that_does_not_downscale(tmp_path, size, expected):
+    processor = ImageProcessor(temp_dir=str(tmp_path), load_model=False)
+    assert processor.select_resolution('auto', size) == expected
+    assert processor.select_resolution('768', size) == 768
+
+
+def test_content_box(tmp_path):
+    stretched = ImageProcessor(temp_dir=str(tmp_path), load_model=False)
+    assert stretched.content_box((2000, 1000), 1024) == (0, 0, 1024, 1024)
+
+    letterboxed = ImageProcessor(temp_dir=str(tmp_path), letterbox=True, load_model=False)
+    assert letterboxed.content_box((2000, 1000), 1024) == (0, 256, 1024, 512)
+    assert letterboxed.content_box((1000, 2000), 1024) == (256, 0, 512, 1024)
+
+
+def test_letterbox_padding_is_neutral(tmp_path):
+    processor = ImageProcessor(temp_dir=str(tmp_path), letterbox=True, load_model=False)
+    tensor, (left, top, width, height) = processor.preprocess(Image.new('RGB', (200, 100), (200, 10, 10)), 512)
+    assert tensor.shape == (1, 3, 512, 512)
+    assert (left, top, width, height) == (0, 128, 512, 256)
+    assert torch.all(tensor[:, :, :top] == 0)
+    assert torch.all(tensor[:, :, top + height:] == 0)
+    assert torch.all(tensor[:, 0, top:top + height] != 0)
+
+
+@pytest.mark.parametrize("size", [(300, 120), (120, 300)])
+def test_letterbox_padding_is_removed_from_the_mask(tmp_path, size):
+    processor = make_processor(tmp_path, letterbox=True, inference_resolution=512)
+    processor.engine = ContentEngine()
+    image = Image.new('RGB', size, (200, 10, 10))
+
+    output, info = processor.remove_background(image)
+    alpha = np.asarray(output.getchannel('A'))
+    assert output.size == size
+    assert info['letterbox'] is True
+    # Nessuna traccia del bordo a zero, nemmeno sui lati dell'immagine
+    assert alpha.min() == 255
+
+
+def test_large_jpeg_uses_reduced_decode_for_the_model(tmp_path):
+    processor = make_processor(tmp_path, inference_resolution=512)
+    source = encoded(Image.new('RGB', (3000, 2000), (200, 10, 10)), 'JPEG', quality=90)
+
+    model_image = processor.decode_model_image(source, 512)
+    assert model_image is not None
+    assert max(model_image.size) < 3000 and min(model_image.size) >= 512
+
+    result = processor.process_image_source(source, "upload://large.jpg")
+    assert Image.open(io.BytesIO(result)).size == (3000, 2000)
+
+
+def test_small_or_non_jpeg_images_skip_reduced_decode(tmp_path):
+    processor = make_processor(tmp_path, inference_resolution=512)
+    assert processor.decode_model_image(encoded(Image.new('RGB', (600, 400)), 'JPEG'), 512) is None
+    assert processor.decode_model_image(encoded(Image.new('RGB', (3000, 2000)), 'PNG'), 512) is None
@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+import result_cache
+from result_cache import ResultCache, normalize_url
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Example.COM:443/a.jpg?b=2&a=1#frag") == "https://example.com/a.jpg?a=1&b=2"
+    assert normalize_url("http://example.com:8080") == "http://example.com:8080/"
+
+
+def test_key_depends_on_content_and_variant(tmp_path):
+    path = tmp_path / "image.bin"
+    path.write_bytes(b"abc")
+    key = ResultCache.make_key(b"abc", "v1")
+    assert ResultCache.key_for_file(str(path), "v1") == key
+    assert ResultCache.make_key(b"abc", "v2") != key
+    assert ResultCache.make_key(b"abd", "v1") != key
+
+
+def test_memory_lru_evicts_least_recently_used():
+    cache = ResultCache(memory_max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"  # "a" diventa il più recente
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    stats = cache.stats()
+    assert stats['evictions_memory'] == 1
+    assert stats['memory_bytes'] == 8
+
+
+def test_entries_larger_than_budget_are_skipped():
+    cache = ResultCache(memory_max_bytes=4)
+    cache.put("a", b"too large")
+    assert cache.get("a") is None
+    assert cache.stats()['memory_entries'] == 0
+
+
+def test_disk_tier_promotes_and_evicts(tmp_path):
+    cache = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=10)
+    cache.put("aa11", b"1234")
+    cache.put("bb22", b"5678")
+    assert cache.get("aa11") == b"1234"
+    assert cache.stats()['disk_hits'] == 1
+
+    cache.put("cc33", b"9012")
+    assert cache.get("bb22") is None
+    assert not os.path.exists(tmp_path / "bb" / "bb22.bin")
+    assert cache.stats()['evictions_disk'] == 1
+
+
+def test_disk_index_is_rebuilt_on_restart(tmp_path):
+    cache = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+    cache.put("aa11", b"first")
+    cache.put("bb22", b"second")
+    (tmp_path / "aa" / "leftover.tmp").write_bytes(b"partial")
+
+    restarted = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+    assert restarted.get("aa11") == b"first"
+    assert restarted.get("bb22") == b"second"
+    assert restarted.stats()['disk_bytes'] == len(b"first") + len(b"second")
+    assert not (tmp_path / "aa" / "leftover.tmp").exists()
+
+
+def test_disk_index_applies_reduced_budget(tmp_path):
+    cache = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+    cache.put("aa11", b"12345678")
+    os.utime(tmp_path / "aa" / "aa11.bin", (1, 1))
+    cache.put("bb22", b"12345678")
+
+    restarted = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=10)
+    assert restarted.get("aa11") is None
+    assert restarted.get("bb22") == b"12345678"
+
+
+def test_url_index_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, 'monotonic', lambda: now[0])
+    cache = ResultCache(url_ttl=60)
+    cache.put("key", b"data")
+    cache.link_url("https://Example.com/a.jpg", "v1", "key")
+
+    assert cache.get_by_url("https://example.com/a.jpg", "v1") == (b"data", "key")
+    assert cache.lookup_url("https://example.com/a.jpg", "v2") is None
+
+    now[0] += 61
+    assert cache.lookup_url("https://example.com/a.jpg", "v1") is None
+    assert cache.stats()['url_entries'] == 0
+
+
+def test_url_index_is_bounded():
+    cache = ResultCache(url_index_size=2)
+    for i in range(3):
+        cache.link_url(f"https://example.com/{i}.jpg", "v1", f"key{i}")
+    assert cache.lookup_url("https://example.com/0.jpg", "v1") is None
+    assert cache.lookup_url("https://example.com/2.jpg", "v1") == "key2"
+
+
+@pytest.mark.parametrize("hits,misses,ratio", [(0, 0, 0.0), (1, 1, 0.5)])
+def test_hit_ratio(hits, misses, ratio):
+    cache = ResultCache()
+    cache.put("key", b"data")
+    for _ in range(hits):
+        cache.get("key")
+    for _ in range(misses):
+        cache.get("missing")
+    assert cache.stats()['hit_ratio'] == ratio
+
+
+def test_cached_metadata_matches_the_request_source(tmp_path):
+    import io
+
+    from PIL import Image
+
+    from image_processor import ImageProcessor
+
+    processor = ImageProcessor(
+        temp_dir=str(tmp_path),
+        result_cache=ResultCache(),
+        inference_backend='stub',
+        stub_options={'cost_ms': 0},
+        warmup_enabled=False
+    )
+    processor.load()
+    source = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 30, 30)).save(source, 'PNG')
+
+    first, first_info = processor.process_downloaded_image(source.getvalue(), "https://a.example/x.png")
+    second, second_info = processor.process_downloaded_image(source.getvalue(), "https://b.example/x.png")
+    again, again_info = processor.process_downloaded_image(source.getvalue(), "https://a.example/x.png")
+
+    assert (first_info['cache'], second_info['cache'], again_info['cache']) == ('miss', 'miss', 'hit')
+    assert again == first
+    assert Image.open(io.BytesIO(second)).info['Source URL'] == "https://b.example/x.png"
+
+
+def test_workers_use_separate_disk_shards(tmp_path):
+    # Come after_fork in main: una sottodirectory e una quota del budget per worker
+    workers = [ResultCache(memory_max_bytes=0) for _ in range(2)]
+    for index, cache in enumerate(workers):
+        cache.attach_disk(str(tmp_path / f"worker-{index}"), 20 // len(workers))
+        for n in range(5):
+            cache.put(f"{index}{n}" + "0" * 62, b"x" * 4)
+
+    on_disk = sum(path.stat().st_size for path in tmp_path.rglob("*.bin"))
+    assert on_disk <= 20
+    assert all(cache.stats()['disk_bytes'] <= 10 for cache in workers)
+
+
+def test_disk_index_ignores_worker_subdirectories(tmp_path):
+    shard = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path / "worker-0"), disk_max_bytes=100)
+    shard.put("ab" + "0" * 62, b"data")
+
+    cache = ResultCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+    assert cache.stats()['disk_entries'] == 0
@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import pytest
+
+from admission import AdmissionController, DeadlineExceeded
+from image_processor import ImageProcessor
+from inference_executor import InferenceExecutor
+from single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+        return calls, results, flight.in_flight()
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["result"] * 5
+    assert in_flight == 0
+
+
+def test_results_are_not_memoized():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        return await flight.do("key", work), await flight.do("key", work)
+
+    assert asyncio.run(scenario()) == (1, 2)
+
+
+def test_error_is_shared_and_not_cached():
+    async def scenario():
+        flight = SingleFlight()
+        attempts = 0
+
+        async def failing():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("immagine non valida")
+
+        results = await asyncio.gather(
+            flight.do("key", failing), flight.do("key", failing), return_exceptions=True
+        )
+        # La chiamata successiva riesegue il lavoro: gli errori non restano in memoria
+        with pytest.raises(ValueError):
+            await flight.do("key", failing)
+        return attempts, results
+
+    attempts, results = asyncio.run(scenario())
+    assert attempts == 2
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelling_one_waiter_keeps_the_work_for_the_others():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def work():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await started.wait()
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(scenario()) == ("done", True)
+
+
+def test_work_is_cancelled_when_every_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight.in_flight()
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_shared_work_ignores_the_first_caller_deadline(tmp_path):
+    processor = ImageProcessor(temp_dir=str(tmp_path), load_model=False)
+    processor.process_image_from_url_with_info = lambda url, resolution, output: (b"result", {"cache": "miss"})
+    executor = InferenceExecutor(processor, workers=1)
+    controller = AdmissionController(deadline_seconds=0.05)
+
+    async def with_deadline():
+        controller.admit("a")
+        return await executor.process_image_from_url_with_info("https://example.com/a.jpg")
+
+    async def scenario():
+        # La corsia resta occupata oltre la scadenza della prima richiesta
+        busy = asyncio.ensure_future(executor.run(time.sleep, 0.2))
+        first = asyncio.ensure_future(with_deadline())
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(executor.process_image_from_url_with_info("https://example.com/a.jpg"))
+        await busy
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    first, second = asyncio.run(scenario())
+    executor.shutdown()
+    assert isinstance(first, DeadlineExceeded)
+    assert second == (b"result", {"cache": "miss"})
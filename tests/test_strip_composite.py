@@ -0,0 +1,154 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image, ImageDraw, ImageFilter, PngImagePlugin
+
+from encoders import OutputFormat, encode, encode_png_strips
+from image_processor import ImageProcessor
+from postprocessing import StripComposite, compose_rgba, upsample_mask
+
+
+def scene(width, height):
+    """Soggetto su uno sfondo sfumato e la sua maschera alla risoluzione del modello."""
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.stack([x * 255 // width, y * 255 // height, np.full_like(x, 90)], axis=-1)
+    image = Image.fromarray(background.astype(np.uint8))
+    subject = (width * 0.25, height * 0.2, width * 0.75, height * 0.85)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse(subject, fill=(230, 200, 170))
+    draw.rectangle((width * 0.1, height * 0.6, width * 0.3, height * 0.9), fill=(20, 40, 60))
+
+    silhouette = Image.new('L', (width, height))
+    ImageDraw.Draw(silhouette).ellipse(subject, fill=255)
+    low = silhouette.resize((64, 64), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    mask = torch.from_numpy(np.array(low)).float().div_(255)
+    return image, mask
+
+
+def strips_of(array, rows):
+    return [array[top:top + rows] for top in range(0, len(array), rows)]
+
+
+def decode(data):
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        return image
+
+
+@pytest.mark.parametrize("mode,shape", [('RGBA', (37, 53, 4)), ('L', (37, 53))])
+@pytest.mark.parametrize("compress_level", [0, 1, 6, 9])
+def test_png_strips_round_trip(mode, shape, compress_level):
+    rng = np.random.default_rng(compress_level)
+    # Metà rumore e metà gradiente, per esercitare tutti i filtri di riga
+    pixels = rng.integers(0, 256, shape, dtype=np.uint8)
+    pixels[:20] = np.arange(shape[1], dtype=np.uint8).reshape((1, -1) + (1,) * (len(shape) - 2)) * 4
+
+    data = encode_png_strips((shape[1], shape[0]), mode, strips_of(pixels, 7), compress_level)
+    decoded = decode(data)
+    assert decoded.mode == mode
+    assert decoded.size == (shape[1], shape[0])
+    np.testing.assert_array_equal(np.asarray(decoded), pixels)
+
+
+def test_png_strips_match_pil_regardless_of_strip_height(monkeypatch):
+    image, _ = scene(120, 90)
+    pixels = np.asarray(image.convert('RGBA'))
+    reference = np.asarray(decode(encode(image.convert('RGBA'), OutputFormat('png'))))
+
+    # Blocchi di filtraggio più piccoli delle strisce
+    monkeypatch.setattr('encoders.FILTER_BLOCK_BYTES', 120 * 4 * 3)
+    for rows in (1, 10, 90):
+        decoded = decode(encode_png_strips(image.size, 'RGBA', strips_of(pixels, rows)))
+        np.testing.assert_array_equal(np.asarray(decoded), reference)
+
+
+def test_png_strips_keep_text_chunks():
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Software', 'removebg')
+    info.add_itxt('Description', 'sfondo rimosso', zip=True)
+    pixels = np.zeros((4, 4), dtype=np.uint8)
+
+    decoded = decode(encode_png_strips((4, 4), 'L', [pixels], pnginfo=info))
+    assert decoded.text['Software'] == 'removebg'
+    assert decoded.text['Description'] == 'sfondo rimosso'
+
+
+@pytest.mark.parametrize("mode", ['bilinear', 'guided'])
+@pytest.mark.parametrize("size", [(301, 157), (640, 480)])
+def test_strip_composite_matches_full_resolution(mode, size):
+    image, mask = scene(*size)
+    reference = np.asarray(compose_rgba(image.copy(), upsample_mask(mask, image, mode)))
+
+    composite = StripComposite(image, mask, mode, strip_pixels=size[0] * 7)
+    assert composite.size == image.size
+    output = np.asarray(composite.to_image())
+
+    np.testing.assert_array_equal(output[..., :3], reference[..., :3])
+    # Stessa interpolazione calcolata per righe; con il guided filter la guida
+    # a bassa risoluzione è ridotta da PIL invece che dalla luminanza completa
+    difference = np.abs(output[..., 3].astype(np.int16) - reference[..., 3])
+    assert difference.max() <= 1
+
+
+def test_strip_composite_alpha_only_strips():
+    image, mask = scene(200, 50)
+    composite = StripComposite(image, mask, strip_pixels=200 * 8)
+    strips = list(composite.strips(alpha_only=True))
+    assert [len(strip) for strip in strips] == [8] * 6 + [2]
+    assert all(strip.shape[1:] == (200,) for strip in strips)
+    np.testing.assert_array_equal(np.concatenate(strips), np.asarray(composite.to_image())[..., 3])
+
+
+def test_strip_composite_rejects_unknown_mode():
+    image, mask = scene(20, 20)
+    with pytest.raises(ValueError, match="non supportata"):
+        StripComposite(image, mask, mode='nearest')
+
+
+@pytest.mark.parametrize("name", ['png', 'mask'])
+def test_encode_strip_composite_matches_full_image(name):
+    image, mask = scene(160, 120)
+    composite = StripComposite(image, mask, strip_pixels=160 * 16)
+    output_format = OutputFormat(name)
+
+    expected = decode(encode(composite.to_image(), output_format))
+    decoded = decode(encode(composite, output_format))
+    assert decoded.mode == expected.mode
+    np.testing.assert_array_equal(np.asarray(decoded), np.asarray(expected))
+
+
+def test_encode_refuses_webp_for_strip_composite():
+    image, mask = scene(40, 30)
+    with pytest.raises(ValueError, match="strisce"):
+        encode(StripComposite(image, mask), OutputFormat('webp'), metadata={'source': 'test'})
+
+
+def test_large_images_requested_as_webp_are_returned_as_png(tmp_path):
+    processor = ImageProcessor(
+        temp_dir=str(tmp_path),
+        inference_backend='stub',
+        stub_options={'cost_ms': 0},
+        warmup_enabled=False,
+        strip_composite_pixels=100 * 80
+    )
+    processor.load()
+    image, _ = scene(100, 80)
+    upload = io.BytesIO()
+    image.save(upload, 'PNG')
+
+    output = OutputFormat('webp', compress_level=1)
+    data, info = processor.process_uploaded_image(upload.getvalue(), 'a.png', output=output)
+    assert info['content_type'] == 'image/png'
+    assert info['extension'] == 'png'
+    decoded = decode(data)
+    assert decoded.format == 'PNG'
+    assert decoded.mode == 'RGBA'
+
+    image, _ = scene(90, 80)
+    upload = io.BytesIO()
+    image.save(upload, 'PNG')
+    data, info = processor.process_uploaded_image(upload.getvalue(), 'b.png', output=OutputFormat('webp'))
+    assert info['content_type'] == 'image/webp'
+    assert decode(data).format == 'WEBP'
@@ -0,0 +1,168 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict
+
+import torch
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Un worker che termina prima di questo tempo conta come crash all'avvio
+MIN_WORKER_UPTIME = 10.0
+# Attesa massima tra due riavvii consecutivi falliti
+MAX_RESTART_DELAY = 30.0
+
+
+class WorkerSupervisor:
+    """
+    Supervisore multi-processo con il modello condiviso tra i worker.
+
+    Il processo padre carica il modello una sola volta, apre il socket in
+    ascolto e crea i worker con fork: i pesi restano condivisi in
+    copy-on-write, perché l'inferenza li legge senza mai scriverli. Ogni
+    worker esegue il proprio server uvicorn sullo stesso socket (il kernel
+    distribuisce le connessioni) e il supervisore riavvia quelli che terminano.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        host: str,
+        port: int,
+        workers: int,
+        threads_per_worker: int,
+        on_fork: Callable[[int], None],
+        log_level: str = "warning"
+    ):
+        if workers < 1:
+            raise ValueError("Il numero di worker deve essere almeno 1")
+
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.on_fork = on_fork
+        self.log_level = log_level
+
+        self._socket = None
+        self._children: Dict[int, int] = {}
+        self._started_at: Dict[int, float] = {}
+        self._failures: Dict[int, int] = {}
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        """Avvia i worker e li supervisiona fino a SIGTERM/SIGINT."""
+        self._socket = self._bind()
+        logger.info(
+            f"Avvio di {self.workers} worker su {self.host}:{self.port} "
+            f"({self.threads_per_worker} thread ciascuno)"
+        )
+
+        # Gli oggetti già allocati non vengono più visitati dal garbage collector:
+        # i worker non sporcano le pagine condivise solo per attraversarle
+        gc.collect()
+        gc.freeze()
+
+        # Le metriche dei worker di un'esecuzione precedente non vanno sommate
+        metrics.reset_multiprocess_dir()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self._children.pop(pid, None)
+            if index is None:
+                continue
+            metrics.mark_process_dead(pid)
+            if self._stopping.is_set():
+                continue
+            self._restart(index, os.waitstatus_to_exitcode(status))
+
+        self._socket.close()
+        logger.info("Tutti i worker sono terminati")
+
+    def _bind(self) -> socket.socket:
+        """Apre il socket in ascolto condiviso da tutti i worker."""
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, index: int) -> None:
+        """Crea il worker `index` con fork."""
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                self._run_worker(index)
+                exit_code = 0
+            except BaseException as e:
+                logger.error(f"Worker {index} terminato con errore: {e}")
+            finally:
+                os._exit(exit_code)
+
+        self._children[pid] = index
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Worker {index} avviato (pid {pid})")
+
+    def _run_worker(self, index: int) -> None:
+        """Corpo del processo worker: thread, risorse per processo e server uvicorn."""
+        import uvicorn
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Ctrl+C raggiunge solo il supervisore, che inoltra un unico SIGTERM
+        os.setpgid(0, 0)
+
+        torch.set_num_threads(self.threads_per_worker)
+        self.on_fork(index)
+
+        config = uvicorn.Config(self.app, log_level=self.log_level)
+        server = uvicorn.Server(config)
+        server.run(sockets=[self._socket])
+
+    def _restart(self, index: int, exit_code: int) -> None:
+        """Riavvia un worker terminato, con attesa crescente se cade all'avvio."""
+        uptime = time.monotonic() - self._started_at.get(index, 0.0)
+        if uptime < MIN_WORKER_UPTIME:
+            self._failures[index] = self._failures.get(index, 0) + 1
+        else:
+            self._failures[index] = 0
+
+        delay = min(MAX_RESTART_DELAY, 2 ** self._failures[index] - 1)
+        logger.warning(
+            f"Worker {index} terminato (codice {exit_code}, attivo da {uptime:.1f}s), "
+            f"riavvio tra {delay:.0f}s"
+        )
+        if self._stopping.wait(delay):
+            return
+        self._spawn(index)
+
+    def _handle_stop(self, signum, frame) -> None:
+        """Inoltra l'arresto ai worker, che completano le richieste in corso."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        logger.info(f"Segnale {signal.Signals(signum).name}: arresto dei worker")
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass